@@ -0,0 +1,64 @@
+"""
+Compares parsing rule strings with :class:`~rules.parser.RuleParser` and with
+the single-pass :class:`~rules.parser.DescentParser`.
+
+Run from the project root::
+
+    python benchmarks/bench_parser.py [number of rules]
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
+
+import django
+django.setup()
+
+from rules.parser import parse_rule
+
+CONDITIONS = (
+    'object:0.status == "open"',
+    'object:0.amount > {}',
+    'object:0.customer.tier in ["gold", "platinum", {}]',
+    'len(object:0.lines.all) >= {}',
+    'extra.user.groups:"staff"; exists',
+    'object:0.created < 2014-01-0{}T12:00:00',
+    'NOT object:0.flags.{} bool',
+    'max(object:0.a, object:0.b, {}) <= 1.5e3',
+    'object:0.name like regex("^[A-Z]{{{}}}")',
+)
+
+
+def rules(n, seed=0):
+    rnd = random.Random(seed)
+    for i in range(n):
+        conditions = [rnd.choice(CONDITIONS).format(rnd.randint(1, 9))
+                      for j in range(rnd.randint(1, 5))]
+        tree = conditions[0]
+        for c in conditions[1:]:
+            tree = '({}) {} {}'.format(tree, rnd.choice(('AND', 'OR')), c)
+        if i % 3 == 0:
+            tree = 'with(object:0.customer, len(\\0.orders.all)) ' \
+                '\\1 > 2 AND \\0.active bool AND ' + tree
+        yield tree
+
+
+def main(n=500, number=5):
+    strings = list(rules(n))
+    for s in strings:
+        assert parse_rule(s, 'madlibs') == parse_rule(s, 'descent'), s
+    times = {}
+    for name in ('madlibs', 'descent'):
+        t = timeit.timeit(lambda: [parse_rule(s, name) for s in strings],
+                          number=number)
+        times[name] = t
+        print('{:<8} {:>8.1f} us per rule'.format(
+            name, t * 1e6 / number / len(strings)))
+    print('speedup  {:>8.1f}x'.format(times['madlibs'] / times['descent']))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
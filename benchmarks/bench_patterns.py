@@ -0,0 +1,59 @@
+"""
+Compares checking many ``like`` rules on the same value through a plain
+:class:`~rules.cache.RuleList` and through an
+:class:`~rules.index.IndexedRuleList`.
+
+Run from the project root::
+
+    python benchmarks/bench_patterns.py [number of rules]
+"""
+import json
+import os
+import random
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
+
+import django
+django.setup()
+
+from rules.cache import RuleList
+from rules.core import Rule
+from rules.index import IndexedRuleList
+
+
+def patterns(n, seed=0):
+    rnd = random.Random(seed)
+    for i in range(n):
+        sku = ''.join(rnd.choice(string.ascii_uppercase) for j in range(3))
+        kind = i % 4
+        if kind == 0:
+            yield '{}-\\d{{4}}$'.format(sku)
+        elif kind == 1:
+            yield '{}-[0-9]+-X'.format(sku)
+        elif kind == 2:
+            yield '.*@{}\\.example\\.com$'.format(sku.lower())
+        else:
+            yield '[A-Z]{{2}}{}'.format(sku[0])
+
+
+def main(n=500, number=200):
+    rules = [Rule('t', conditions='object:0 like regex({})'
+                  .format(json.dumps(p))) for p in patterns(n)]
+    values = ['ABC-1234', 'QQQ-77-X', 'someone@abc.example.com',
+              'no match at all', 'ZZZ-0000']
+    plain, indexed = RuleList(rules), IndexedRuleList(rules)
+    for v in values:
+        assert plain.matches(v) == indexed.matches(v), v
+    for name, l in (('RuleList', plain), ('IndexedRuleList', indexed)):
+        t = timeit.timeit(lambda: [l.matches(v) for v in values],
+                          number=number)
+        print('{:<16} {:>8.2f} ms per check'.format(
+            name, t * 1000 / number / len(values)))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
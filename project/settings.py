@@ -7,6 +7,7 @@ SECRET_KEY = 'Not really a secret key, here for docs and testing.'
 INSTALLED_APPS = ('django.contrib.auth', 'django.contrib.contenttypes', 'rules')
 
 RULES_OWNER_MODEL = 'auth.User'
+RULES_SERIALIZED_TREES = True
 
 SPHINX = {'exclude_patterns': ('setup.py',)}
 
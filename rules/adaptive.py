@@ -0,0 +1,238 @@
+"""
+Condition trees which reorder themselves as they're used.
+
+An AND node can stop at the first false child, and an OR node at the first
+true one, so the cheapest and most decisive children should come first.  An
+:class:`AdaptiveConditionNode` times each of its children and counts how
+often each is true, and every so often sorts them to keep the expected cost
+of an evaluation as low as possible.  Until there are enough samples, the cost
+of a child is estimated by :func:`static_cost`, which assumes anything going
+through the database is expensive.  To use it, convert a rule's tree::
+
+    rule = Rule('trigger', conditions=adaptive(parse_rule(string)))
+
+Only :class:`~rules.core.Condition` objects (which never raise) and nodes made
+entirely of them are moved; any other child stays where it is, and the
+children on either side of it are only reordered among themselves.  So
+reordering never changes the result of an evaluation.
+"""
+import threading
+from timeit import default_timer
+
+import six
+
+from .core import AND, ConditionNode, Condition, compile_tree
+from .deferred import DeferredDict, DeferredTuple, Function, Selector
+
+__all__ = ['AdaptiveConditionNode', 'adaptive', 'static_cost']
+
+# Chain links which (usually) mean a database query.
+DB_CHAIN = frozenset([
+    'all', 'filter', 'exclude', 'get', 'exists', 'count', 'first', 'last',
+    'earliest', 'latest', 'aggregate', 'annotate', 'values', 'values_list',
+    'order_by', 'distinct', 'select_related', 'prefetch_related', 'iterator',
+    'in_bulk',
+])
+DB_COST = 100
+OPERATOR_COST = {'like': 4, 're': 4, 'in': 2}
+
+
+def static_cost(obj):
+    """
+    Estimates the relative cost of evaluating a condition, node or deferred
+    value, with a simple attribute lookup costing about 1.
+    """
+    if isinstance(obj, ConditionNode):
+        # With no other information, each child is as likely as not to decide
+        # the outcome, so each is reached half as often as the last.
+        return sum(static_cost(c) / 2.0 ** i
+                   for i, c in enumerate(obj.children))
+    elif isinstance(obj, Condition):
+        return (OPERATOR_COST.get(obj.operator, 1) + static_cost(obj.left) +
+                static_cost(obj.right))
+    elif isinstance(obj, Selector):
+        cost = DB_COST if obj.stype == 'model' else static_cost(obj.stype)
+        for link in obj.chain:
+            if isinstance(link, tuple):
+                link, args = link
+                cost += static_cost(args)
+            cost += DB_COST if link in DB_CHAIN else 1
+        return cost
+    elif isinstance(obj, Function):
+        return 1 + static_cost(obj.args)
+    elif isinstance(obj, DeferredTuple):
+        return sum(static_cost(x) for x in obj)
+    elif isinstance(obj, DeferredDict):
+        return sum(static_cost(x) for x in six.itervalues(obj))
+    return 0
+
+
+def _safe(child):
+    # Whether a child can be moved without changing anything but timing.
+    if isinstance(child, ConditionNode):
+        return all(_safe(c) for c in child.children)
+    return isinstance(child, Condition)
+
+
+class _Entry(object):
+    """
+    Statistics for one child of an adaptive node.  They're updated without
+    locking, since an occasional lost sample doesn't matter.
+    """
+    __slots__ = ('child', 'safe', 'static', 'count', 'true', 'time',
+                 'compiled', 'framed')
+
+    def __init__(self, child):
+        self.child = child
+        self.safe = _safe(child)
+        self.static = static_cost(child)
+        self.count = self.true = 0
+        self.time = 0.0
+        # The child compiled without a slot table, and (table, compiled) for
+        # the latest table only: functions compiled for a table hold on to
+        # it, and rule lists get a new one each time they're rebuilt.
+        self.compiled = self.framed = None
+
+    def compile(self, table):
+        if table is None:
+            if self.compiled is None:
+                self.compiled = compile_tree(self.child)
+            return self.compiled
+        framed = self.framed
+        if framed is None or framed[0] is not table:
+            framed = self.framed = table, compile_tree(self.child, table)
+        return framed[1]
+
+    def record(self, result, elapsed, window):
+        self.count += 1
+        self.time += elapsed
+        if result:
+            self.true += 1
+        if self.count >= window:
+            # Decay, so old samples count for less and nothing grows forever.
+            self.count //= 2
+            self.true //= 2
+            self.time /= 2
+
+    def rank(self, connector, min_samples, unit):
+        if self.count >= min_samples:
+            cost = self.time / self.count
+        else:
+            cost = self.static * unit
+        # Smoothed chance of this child deciding the outcome on its own.
+        p_true = (self.true + 1.0) / (self.count + 2.0)
+        return cost / ((1 - p_true) if connector == AND else p_true)
+
+
+class AdaptiveConditionNode(ConditionNode):
+    """
+    A :class:`~rules.core.ConditionNode` which reorders its children based on
+    how long they take and how often they're true.
+    """
+    # Evaluations between reorderings.
+    REORDER_EVERY = 100
+    # Samples kept (roughly) per child.
+    WINDOW = 1000
+    # Below this many samples, the static cost estimate is used.
+    MIN_SAMPLES = 10
+    # Seconds per unit of static cost.
+    COST_UNIT = 1e-6
+
+    # Reordering is rare, so one lock for every node is plenty.
+    _lock = threading.Lock()
+    # (children, entries); nodes aren't always created through __init__.
+    _state = None
+    _evaluations = 0
+
+    def __getstate__(self):
+        state = ConditionNode.__getstate__(self)
+        # The statistics hold compiled children, so they start afresh.
+        state.pop('_state', None)
+        state.pop('_evaluations', None)
+        return state
+
+    def _entries(self):
+        children, state = self.children, self._state
+        if state is not None and state[0] is children:
+            return state[1]
+        with self._lock:
+            # The children were replaced; keep any statistics still relevant.
+            old = {}
+            for e in (self._state or ((), ()))[1]:
+                old.setdefault(id(e.child), e)
+            entries = [old.pop(id(c), None) or _Entry(c) for c in children]
+            self._state = children, entries
+        return entries
+
+    def _evaluate(self, info):
+        return self._run(info, False)
+
+    def _compile(self, table=None):
+        """
+        Returns a function equivalent to :meth:`_evaluate` using compiled
+        children, which goes on recording statistics and follows any
+        reordering.
+        """
+        return lambda info: self._run(info, True, table)
+
+    def _run(self, info, compiled, table=None):
+        entries = self._entries()
+        decisive = self.connector != AND
+        window = self.WINDOW
+        result = not decisive
+        for e in entries:
+            if compiled:
+                evaluate = e.compile(table)
+            else:
+                evaluate = e.child._evaluate
+            start = default_timer()
+            value = bool(evaluate(info))
+            e.record(value, default_timer() - start, window)
+            if value is decisive:
+                result = decisive
+                break
+        self._evaluations += 1
+        if self._evaluations >= self.REORDER_EVERY:
+            self._evaluations = 0
+            self.reorder()
+        return result
+
+    def reorder(self):
+        """
+        Sorts the children by expected cost, leaving any children that aren't
+        safe to move in place.
+        """
+        entries = self._entries()
+        connector, n, unit = self.connector, self.MIN_SAMPLES, self.COST_UNIT
+        key = lambda e: e.rank(connector, n, unit)
+        with self._lock:
+            if self._state is None or self._state[1] is not entries:
+                # Changed in the meantime; try again later.
+                return
+            ordered, run = [], []
+            for e in entries:
+                if e.safe:
+                    run.append(e)
+                else:
+                    ordered.extend(sorted(run, key=key))
+                    ordered.append(e)
+                    run = []
+            ordered.extend(sorted(run, key=key))
+            children = [e.child for e in ordered]
+            # Replaced rather than modified, so evaluations in progress go on
+            # with the old order undisturbed.
+            self._state = children, ordered
+            self.children = children
+
+
+def adaptive(tree):
+    """
+    Returns a copy of a condition tree with every node replaced by an
+    :class:`AdaptiveConditionNode`, initially ordered by static cost.
+    """
+    if not isinstance(tree, ConditionNode):
+        return tree
+    node = AdaptiveConditionNode([adaptive(c) for c in tree.children],
+                                 tree.connector)
+    node.reorder()
+    return node
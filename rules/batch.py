@@ -0,0 +1,108 @@
+"""
+Support for checking the same rules against many objects at once.
+
+Checking rules one object at a time means following each selector's chain for
+each object, and for model instances that often means a query per related
+object or queryset.  :func:`lookups` works out which relations the rules'
+selectors go through, and :class:`rules.prefetch.PrefetchPlanner` fetches them
+for a whole batch of objects, one query per level of relations, so that the
+checks themselves find everything already loaded.  See
+:meth:`rules.context.RuleChecker.check_batch`.
+"""
+import re
+from collections import defaultdict
+
+import six
+
+from .cache import _rule_conditions
+from .core import Condition, ConditionNode
+from .deferred import Deferred, DeferredDict, Function, Selector
+
+__all__ = ['lookups']
+
+_NAME = re.compile(r'[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _deferred(obj):
+    """Yields the deferred values used by a tree, condition or rule."""
+    if isinstance(obj, ConditionNode):
+        for c in obj.children:
+            for d in _deferred(c):
+                yield d
+    elif isinstance(obj, Condition):
+        for d in _deferred(obj.left):
+            yield d
+        for d in _deferred(obj.right):
+            yield d
+    elif isinstance(obj, Selector):
+        yield obj
+        for d in _deferred(obj.stype):
+            yield d
+        for d in _deferred(obj.chain):
+            yield d
+    elif isinstance(obj, Function):
+        for d in _deferred(obj.args):
+            yield d
+    elif isinstance(obj, DeferredDict):
+        for v in six.itervalues(obj):
+            for d in _deferred(v):
+                yield d
+    elif isinstance(obj, (tuple, list)):
+        for v in obj:
+            for d in _deferred(v):
+                yield d
+
+
+def _path(selector):
+    """
+    Returns ``(index, names, complete)`` for a selector starting from one of
+    the objects being checked, where ``names`` are the plain attribute names at
+    the start of its chain, or ``None`` for other selectors.
+    """
+    stype = selector.stype
+    if isinstance(stype, Selector):
+        path = _path(stype)
+        if path is None or not path[2]:
+            return path
+        index, names = path[0], list(path[1])
+    elif isinstance(stype, six.integer_types) and not isinstance(stype, bool):
+        index, names = stype, []
+    else:
+        return None
+    if not isinstance(selector.chain, tuple):
+        return index, names, False
+    for link in selector.chain:
+        if isinstance(link, Deferred) or \
+                not isinstance(link, six.string_types) or \
+                not _NAME.match(link) or '__' in link:
+            return index, names, False
+        names.append(link)
+    return index, names, True
+
+
+def _conditions(rules):
+    for r in rules:
+        conditions = _rule_conditions(r)
+        if conditions is None and isinstance(r, tuple):
+            # e.g. a RuleMutex.
+            for c in _conditions(r):
+                yield c
+        else:
+            yield conditions
+
+
+def lookups(rules):
+    """
+    Returns ``{object index: set of lookups}`` for the relations that the
+    rules' selectors may go through, as accepted by ``prefetch_related``.
+    Some might not be relations at all, which the planner sorts out.
+    """
+    result = defaultdict(set)
+    for conditions in _conditions(rules):
+        for d in _deferred(conditions):
+            if isinstance(d, Selector):
+                path = _path(d)
+                if path is not None and path[1]:
+                    result[path[0]].add('__'.join(path[1]))
+    return dict(result)
+
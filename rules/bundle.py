@@ -0,0 +1,144 @@
+"""
+Loading rules in bulk from bundles of JSON lines.
+
+A bundle has a rule on each line, as a JSON object with the rule's
+``trigger`` and ``tree`` string, and optionally its ``continuation``,
+``weight``, ``value`` and any other field of the rule model::
+
+    {"trigger": "update.shop.order", "continuation": "notify", "weight": 1,
+     "value": {"to": "sales"}, "tree": "object:0.total > 1000"}
+
+:func:`load_bundle` streams the lines in batches.  The trees of each batch are
+parsed (by a pool of processes if asked; see :func:`~rules.parser.parse_many`)
+and formatted as if assigned to :attr:`~rules.models.BaseRule.conditions`,
+serialized tree and all, and the rules written with ``bulk_create``.  A line
+which isn't a valid rule raises ``ValueError`` and nothing is saved.  Guards
+are rebuilt at the end if the percolator is on (see :mod:`rules.percolator`),
+and the rule caches forget the loaded triggers once.
+"""
+import itertools
+import json
+
+import six
+from django.db import transaction
+
+from .conf import settings
+
+__all__ = ['read_bundle', 'load_bundle']
+
+
+def read_bundle(lines):
+    """
+    Yields ``(line number, fields)`` for each rule in an iterable of bundle
+    lines, skipping blank ones.
+    """
+    for number, line in enumerate(lines, 1):
+        if isinstance(line, six.binary_type):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            fields = json.loads(line)
+        except ValueError as e:
+            raise ValueError('Line {}: {}'.format(number, e))
+        if not isinstance(fields, dict):
+            raise ValueError('Line {}: not an object'.format(number))
+        for name in ('trigger', 'tree'):
+            if not isinstance(fields.get(name), six.string_types):
+                raise ValueError('Line {}: "{}" must be a string'
+                                 .format(number, name))
+        yield number, fields
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _field_names(model):
+    opts = model._meta
+    names = set()
+    for field in opts.concrete_fields:
+        names.update((field.name, field.attname))
+    # Made here, not loaded.
+    names.difference_update((opts.pk.name, opts.pk.attname, 'tree',
+                             'serialized_tree'))
+    return names
+
+
+def _build_rules(model, batch, executor):
+    from .parser import parse_many
+    from .trees import _build
+    strings = list(set(fields['tree'] for number, fields in batch))
+    trees = dict(zip(strings, parse_many(strings, 1, parse=_build,
+                                         return_exceptions=True,
+                                         executor=executor)))
+    names = _field_names(model)
+    rules = []
+    for number, fields in batch:
+        fields = dict(fields)
+        string = fields.pop('tree')
+        tree = trees[string]
+        if isinstance(tree, Exception):
+            raise ValueError('Line {}: {}'.format(number, tree))
+        unknown = set(fields) - names
+        if unknown:
+            raise ValueError('Line {}: unknown fields {}'
+                             .format(number, ', '.join(sorted(unknown))))
+        rule = model(**fields)
+        if getattr(tree, 'unsatisfiable', False):
+            # Kept as written, there being nothing to format.
+            rule.conditions = string
+        else:
+            rule.conditions = tree
+        rules.append(rule)
+    return rules
+
+
+def _default_caches():
+    from .cache import RuleCache, TopicalRuleCache
+    return [c for c in (getattr(TopicalRuleCache, 'default', None),
+                        getattr(RuleCache, 'default', None)) if c is not None]
+
+
+def load_bundle(lines, model=None, batch_size=500, workers=1, caches=None):
+    """
+    Saves the rules in a bundle (any iterable of lines, like a file) as
+    instances of ``model``, by default the concrete rule model, returning how
+    many there were.  The trees of each batch are parsed by ``workers``
+    processes (``None`` for one per CPU), started once for all of them.
+    Afterwards, each of ``caches`` (by default, those of the rule model)
+    forgets the rules for the loaded triggers.
+    """
+    if model is None:
+        from .models import Rule as model
+    executor = None
+    if workers is None or workers > 1:
+        from .parser import parse_executor
+        executor = parse_executor(workers)
+    triggers = set()
+    count = 0
+    try:
+        with transaction.atomic(using=model.objects.db):
+            for batch in _batches(read_bundle(lines), batch_size):
+                rules = _build_rules(model, batch, executor)
+                model.objects.bulk_create(rules, batch_size)
+                triggers.update(r.trigger for r in rules)
+                count += len(rules)
+            if settings.RULES_PERCOLATOR and triggers:
+                # bulk_create skips save(), which stores guards.
+                from .percolator import rebuild_guards
+                rebuild_guards(model.objects.filter(trigger__in=triggers))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if caches is None:
+        caches = _default_caches()
+    for cache in caches:
+        cache.invalidate(triggers)
+    return count
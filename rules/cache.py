@@ -1,5 +1,12 @@
+import bisect
+import copy
+import logging
 from collections import defaultdict
 
+import six
+
+logger = logging.getLogger(__name__)
+
 __all__ = ['RuleList', 'RuleMutex', 'expand_key', 'RuleCache',
            'TopicalRuleCache']
 
@@ -8,12 +15,77 @@ def _sortkey(rule):
     return getattr(rule, 'weight', 0)
 
 
+def _rule_conditions(rule):
+    # A rule's conditions, or None if it has none or they don't load (a tree
+    # string which doesn't parse, say); such a rule fails to match on its
+    # own rather than taking every other rule under its key with it.
+    try:
+        return getattr(rule, 'conditions', None)
+    except Exception:
+        logger.debug('Exception while loading conditions for rule {}'
+                     .format(rule), exc_info=True)
+        return None
+
+
+def _satisfiable(rule):
+    # Rules whose conditions were found to be impossible can be left out.
+    conditions = _rule_conditions(rule)
+    return not getattr(conditions, 'unsatisfiable', False)
+
+
+def _same(a, b):
+    # Whether two instances are versions of the same saved rule.
+    pk = getattr(b, 'pk', None)
+    return pk is not None and type(a) is type(b) and \
+        getattr(a, 'pk', None) == pk
+
+
+def _compile(rules):
+    # Rules which are going to be matched repeatedly are worth compiling.
+    for r in rules:
+        try:
+            compile_ = r.compile
+        except AttributeError:
+            continue
+        try:
+            compile_()
+        except Exception:
+            logger.debug('Exception while compiling rule {}'.format(r),
+                         exc_info=True)
+
+
+def _preparse(rules, workers):
+    # Parses the tree strings of rules fresh from the database in a pool of
+    # processes, rather than one at a time as they're compiled.
+    from .serial import is_current
+    from .trees import TreeCache
+    strings = []
+    for r in rules:
+        tree = getattr(r, 'tree', None)
+        if '_tree' in getattr(r, '__dict__', ()) or \
+                not isinstance(tree, six.string_types):
+            continue
+        if is_current(getattr(r, 'serialized_tree', None), tree):
+            # Loading these is quicker than sending them to other processes.
+            continue
+        strings.append(tree)
+    if strings:
+        try:
+            TreeCache.default.preload(strings, workers)
+        except Exception:
+            logger.debug('Exception while parsing rules in parallel',
+                         exc_info=True)
+
+
 class RuleList(tuple):
     __slots__ = ()
 
     def __new__(cls, iterable=None):
         if iterable:
-            return tuple.__new__(cls, sorted(iterable, key=_sortkey))
+            rules = tuple.__new__(cls, sorted(filter(_satisfiable, iterable),
+                                              key=_sortkey))
+            _compile(rules)
+            return rules
         return tuple.__new__(cls)
 
     def matches(self, *objects, **extra):
@@ -70,13 +142,36 @@ class sourcesdict(defaultdict):
 
 
 class RuleCache(defaultdict):
-    __slots__ = ('source', 'sources')
+    __slots__ = ('source', 'sources', 'planners', 'loaded')
+    # The collection type used for the rules under each key; anything with a
+    # compatible constructor and ``_matches`` method will do.
+    List = RuleList
+    # Keys with at least this many rules have their tree strings parsed by
+    # parse_workers processes at once (see rules.parser.parse_many) when
+    # they're loaded; None never does.
+    parse_threshold = None
+    parse_workers = None
 
     def __init__(self, source):
         self.source = source
         self.sources = sourcesdict(self)
+        self.planners = {}
+        # The keys each saved rule was loaded under, by (type, pk).
+        self.loaded = {}
         defaultdict.__init__(self)
 
+    def planner(self, key):
+        """
+        Returns a :class:`~rules.prefetch.PrefetchPlanner` for the rules under
+        ``key``, kept until they are.
+        """
+        rules = self[key]
+        planner = self.planners.get(key)
+        if planner is None or planner.rules is not rules:
+            from .prefetch import PrefetchPlanner
+            planner = self.planners[key] = PrefetchPlanner(rules)
+        return planner
+
     def add_source(self, key, source):
         self.sources[key].append(source)
 
@@ -96,16 +191,113 @@ class RuleCache(defaultdict):
                 rules.append(v)
             else:
                 rules.extend(v)
+        if self.parse_threshold is not None and \
+                len(rules) >= self.parse_threshold:
+            _preparse(rules, self.parse_workers)
         self[key] = rules
         return self[key]
 
     def __setitem__(self, key, rules):
         if hasattr(rules, '_match'):
-            rules = RuleList([rules])
+            rules = self.List([rules])
         elif not hasattr(rules, '_matches'):
-            rules = RuleList(rules)
+            rules = self.List(rules)
+        self.planners.pop(key, None)
+        for r in (rules if isinstance(rules, tuple) else ()):
+            for member in (r if isinstance(r, tuple) else (r,)):
+                pk = getattr(member, 'pk', None)
+                if pk is not None:
+                    self.loaded.setdefault((type(member), pk), set()).add(key)
         return defaultdict.__setitem__(self, key, rules)
 
+    def __delitem__(self, key):
+        self.planners.pop(key, None)
+        defaultdict.__delitem__(self, key)
+
+    def invalidate(self, keys):
+        """
+        Forgets the rules loaded for any of ``keys`` (the triggers of changed
+        rules), to be loaded again when next needed.
+        """
+        for key in set(keys):
+            if key in self:
+                del self[key]
+
+    def _holds(self, rule):
+        # Whether the default source for the rule's trigger loads it, or None
+        # if there's no telling without a query.
+        from django.db.models import Manager
+        if isinstance(self.source, Manager):
+            return self.source.model is type(rule)
+        return None
+
+    def _topics(self, trigger):
+        # The keys whose rules come from those for a trigger.
+        return (trigger,)
+
+    def _patch(self, key, rules, rule, add):
+        if not isinstance(rules, RuleList) or \
+                any(isinstance(r, tuple) for r in rules):
+            # Mutexes, which may hold old versions of it too.
+            return False
+        if add:
+            try:
+                add = _satisfiable(rule)
+            except Exception:
+                # Left to fail when loaded, as it always has.
+                return False
+        kept = [r for r in rules if not _same(r, rule)]
+        if add:
+            weights = [_sortkey(r) for r in kept]
+            kept.insert(bisect.bisect_right(weights, _sortkey(rule)), rule)
+        if type(rules) is RuleList:
+            # Still in order, and compiled but for the new rule.
+            self[key] = tuple.__new__(RuleList, kept)
+        else:
+            # Indexes, networks and slot tables are built with the list.
+            self[key] = type(rules)(kept)
+        return True
+
+    def update_rule(self, rule, deleted=False):
+        """
+        Brings the rules already loaded up to date with a rule model instance
+        which was just saved or deleted: any old version of it is taken out,
+        and a saved one put in by weight under the keys for its trigger,
+        rather than loading all of them again.  Keys which can't be updated
+        that way, including those with sources of their own (see
+        :meth:`add_source`) which held an old version, are forgotten instead.
+        A rule newly returned by such a source shows up when its key is next
+        loaded.
+        """
+        holds = False if deleted else self._holds(rule)
+        topics = set(k for k in self._topics(rule.trigger) if k in self)
+        # Old versions are wherever they were loaded.
+        keys = topics | self.loaded.pop((type(rule), rule.pk), set())
+        new = None
+        if holds:
+            # A copy, so changes to the instance wait until it's saved again.
+            new = copy.copy(rule)
+            _compile([new])
+        for key in keys:
+            if key not in self:
+                # Forgotten along with another key.
+                continue
+            rules = self[key]
+            add = key in topics and holds
+            if (key in topics and holds is None) or \
+                    not isinstance(rules, tuple) or \
+                    len(self.sources.get(key, ())) > 1:
+                del self[key]
+            elif add or any(isinstance(r, tuple) or _same(r, rule)
+                            for r in rules):
+                if not self._patch(key, rules, new or rule, add):
+                    del self[key]
+
+    def clear(self):
+        self.planners.clear()
+        self.loaded.clear()
+        defaultdict.clear(self)
+
 
 class SourcelessCache(RuleCache):
     def __init__(self):
@@ -116,12 +308,14 @@ class SourcelessCache(RuleCache):
 
 
 class TopicalRuleCache(RuleCache):
-    __slots__ = ('expanders',)
+    __slots__ = ('expanders', 'topics')
 
     def __init__(self, source=None, expanders=None):
         if source is None:
             source = defaultdict(RuleList)
         self.expanders = expanders or []
+        # The keys loaded from each source key.
+        self.topics = defaultdict(set)
         RuleCache.__init__(self, source)
 
     def _expandkey(self, key):
@@ -141,12 +335,42 @@ class TopicalRuleCache(RuleCache):
 
         return source
 
-    def __delitem__(self, key):
+    def __missing__(self, key):
         for k in self._expandkey(key):
+            self.topics[k].add(key)
+        return RuleCache.__missing__(self, key)
+
+    def _forget(self, source_keys):
+        for k in source_keys:
+            for key in self.topics.pop(k, ()):
+                if key in self:
+                    RuleCache.__delitem__(self, key)
+
+    def __delitem__(self, key):
+        keys = self._expandkey(key)
+        for k in keys:
             if k in self.source:
                 del self.source[k]
         RuleCache.__delitem__(self, key)
+        # Other keys loaded from the same source keys are out of date too.
+        self._forget(keys)
+
+    def invalidate(self, keys):
+        keys = set(keys)
+        self._forget(keys)
+        # Only a cache of the source keys needs telling; anything else is
+        # where rules are kept.
+        if hasattr(self.source, 'invalidate'):
+            self.source.invalidate(keys)
+
+    def _holds(self, rule):
+        holds = getattr(self.source, '_holds', None)
+        return holds(rule) if holds is not None else None
+
+    def _topics(self, trigger):
+        return self.topics.get(trigger, ())
 
     def clear(self):
         self.source.clear()
+        self.topics.clear()
         RuleCache.clear(self)
@@ -8,3 +8,15 @@ if not hasattr(settings, 'RULES_CONCRETE_MODELS'):  # pragma: no cover
 
 if not hasattr(settings, 'RULES_MODULES'):  # pragma: no cover
     settings.RULES_MODULES = ()
+
+if not hasattr(settings, 'RULES_PERCOLATOR'):  # pragma: no cover
+    settings.RULES_PERCOLATOR = False
+
+if not hasattr(settings, 'RULES_SERIALIZED_TREES'):  # pragma: no cover
+    settings.RULES_SERIALIZED_TREES = False
+
+if not hasattr(settings, 'RULES_TREE_CACHE_SIZE'):  # pragma: no cover
+    settings.RULES_TREE_CACHE_SIZE = 1024
+
+if not hasattr(settings, 'RULES_PARSER'):  # pragma: no cover
+    settings.RULES_PARSER = 'descent'
@@ -1,3 +1,5 @@
+import functools
+import itertools
 import logging
 from copy import deepcopy
 
@@ -12,7 +14,7 @@ logger = logging.getLogger(__name__)
 
 
 class RuleChecker(object):
-    __slots__ = ('cache', 'context', '_cont', 'continuations')
+    __slots__ = ('cache', 'context', '_cont', 'continuations', 'prefetch')
 
     def __init__(self, **kwargs):
         cls = kwargs.get('cls') or TopicalRuleCache
@@ -31,16 +33,52 @@ class RuleChecker(object):
         else:
             raise ValueError('No rules, rule cache, or rule source provided.')
         used = {'cls', 'rules', 'cache', 'queryset', 'source',
-                'context', 'continuations'}
+                'context', 'continuations', 'prefetch'}
         context = {k: kwargs[k] for k in kwargs if k not in used}
         context.update(kwargs.get('context', ()))
         self.context = context
         self.cache = cache
         self._cont = kwargs.get('continuations') or ContinuationStore.default
+        # Whether to load the related objects the rules use before checking.
+        self.prefetch = kwargs.get('prefetch', False)
 
     def check(self, trigger, *objects, **extra):
+        rules = self.cache[trigger]
+        if self.prefetch:
+            self._planner(trigger, rules).prefetch([objects])
+        return self._check(rules, objects, extra)
+
+    def _planner(self, trigger, rules):
+        planner = getattr(self.cache, 'planner', None)
+        if planner is not None:
+            return planner(trigger)
+        # A cache of some other kind.
+        from .prefetch import PrefetchPlanner
+        return PrefetchPlanner(rules)
+
+    def check_batch(self, trigger, items, batch_size=1000, **extra):
+        """
+        Checks the rules for ``trigger`` against each tuple of objects in
+        ``items``, as :meth:`check` would, and returns a list with the matches
+        for each.  Related objects the rules need are prefetched for up to
+        ``batch_size`` items at a time.
+        """
+        rules = self.cache[trigger]
+        planner = self._planner(trigger, rules)
+        results = []
+        items = iter(items)
+        while True:
+            batch = [tuple(objects) for objects in
+                     itertools.islice(items, batch_size)]
+            if not batch:
+                return results
+            planner.prefetch(batch)
+            for objects in batch:
+                results.append(self._check(rules, objects, extra))
+
+    def _check(self, rules, objects, extra):
         info = {'objects': objects, 'extra': extra}
-        matches = self.cache[trigger]._matches(info)
+        matches = rules._matches(info)
         for rule in matches:
             try:
                 rule.continue_(info, self.continuations)
@@ -2,6 +2,7 @@ import copy
 import logging
 import operator
 
+import six
 from django.utils import tree
 
 from madlibs.decorators import mixedmethod
@@ -14,9 +15,43 @@ __all__ = ['AND', 'OR', 'ConditionNode', 'Condition']
 AND = 'AND'
 OR = 'OR'
 
+# Beyond this depth, nested nodes are compiled separately rather than inlined,
+# to stay well clear of the interpreter's limits on nested expressions.
+MAX_INLINE_DEPTH = 32
+
+
+def compile_tree(node, table=None):
+    """
+    Returns a function of ``info`` equivalent to ``node._evaluate``; nodes
+    which don't know how to compile themselves are simply evaluated.  Deferred
+    values are memoized in slots from ``table`` if given (see
+    :mod:`rules.frame`).
+    """
+    try:
+        compile_ = node._compile
+    except AttributeError:
+        return node._evaluate
+    if table is None:
+        return compile_()
+    return compile_(table)
+
 
 class ConditionNode(tree.Node):
     default = AND
+    # Set on trees shared between rules (see rules.trees), which mustn't be
+    # changed in place; copies aren't frozen.
+    frozen = False
+
+    def _thaw(self):
+        if self.frozen:
+            raise TypeError('Shared condition trees can\'t be changed in '
+                            'place; change a copy.')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Loaded trees aren't shared with anything, so they can be changed.
+        state.pop('frozen', None)
+        return state
 
     def evaluate(self, *objects, **extra):
         return self._evaluate({'objects': objects, 'extra': extra})
@@ -25,14 +60,65 @@ class ConditionNode(tree.Node):
         test = all if self.connector == AND else any
         return test(child._evaluate(info) for child in self.children)
 
+    def _compile(self, table=None):
+        """
+        Generates a single function for the whole tree, in which nested nodes
+        become plain ``and``/``or`` expressions over compiled leaves.
+        """
+        namespace = {}
+        expr = self._compile_expr(namespace, 0, table)
+        source = 'def evaluate(info):\n    return bool({})\n'.format(expr)
+        exec(compile(source, '<rule {}>'.format(id(self)), 'exec'), namespace)
+        return namespace['evaluate']
+
+    def _compile_expr(self, namespace, depth, table=None):
+        if not self.children:
+            return 'True' if self.connector == AND else 'False'
+        terms = []
+        for child in self.children:
+            if type(child) is type(self) and depth < MAX_INLINE_DEPTH:
+                terms.append(child._compile_expr(namespace, depth + 1, table))
+            else:
+                name = '_{}'.format(len(namespace))
+                namespace[name] = compile_tree(child, table)
+                terms.append(name + '(info)')
+        conn = ' and ' if self.connector == AND else ' or '
+        return '(' + conn.join(terms) + ')'
+
+    def __eq__(self, other):
+        return self is other or (type(self) is type(other) and
+                                 self.connector == other.connector and
+                                 self.children == other.children)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((type(self), self.connector, tuple(self.children)))
+
     def add(self, node, conn_type, *args, **kwargs):
+        self._thaw()
         # Future Django versions did away with this bit, not sure why.
         if len(self.children) < 2:
             self.connector = conn_type
+        if node in self.children and all(c is not node for c in self.children):
+            # Django drops a child equal to an existing one, which only used to
+            # happen for the very same object; trees should stay as written.
+            if conn_type != self.connector:
+                obj = self._new_instance(self.children, self.connector)
+                self.connector = conn_type
+                self.children = [obj, node]
+            elif isinstance(node, tree.Node) and (node.connector == conn_type
+                                                  or len(node) == 1):
+                self.children.extend(node.children)
+            else:
+                self.children.append(node)
+            return node
         return tree.Node.add(self, node, conn_type, *args, **kwargs)
 
     def negate(self):
         # !(x & y & z) = (!x | !y | !z)
+        self._thaw()
         connector = AND if self.connector == OR else OR
         for c in self.children:
             c.negate()
@@ -43,6 +129,7 @@ class ConditionNode(tree.Node):
         """
         Removes unnecessary nodes, returning the minimum version of this tree.
         """
+        self._thaw()
         children = self.children
         if len(children) > 0:
             i = 0
@@ -154,9 +241,36 @@ class Condition(object):
             fmt += ' {}'
         return fmt.format(self.left, self.operator, self.right)
 
+    def __eq__(self, other):
+        return self is other or (type(self) is type(other) and
+                                 self.operator == other.operator and
+                                 self.negated == other.negated and
+                                 self.left == other.left and
+                                 self.right == other.right)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        # Not cached, as conditions can be negated in place.
+        return hash((type(self), self.left, self.operator, self.right,
+                     self.negated))
+
     def negate(self):
         self.negated = not self.negated
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if state.get('_eval') is self.OPERATOR_MAP.get(self.operator):
+            # Some operators are lambdas; looked up again when loaded.
+            del state['_eval']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if '_eval' not in state:
+            self._eval = self.OPERATOR_MAP[self.operator]
+
     def evaluate(self, *objects, **extra):
         return self._evaluate({'objects': objects, 'extra': extra})
 
@@ -180,6 +294,51 @@ class Condition(object):
                          .format(self), exc_info=True)
             return False
 
+    def _compile(self, table=None):
+        """
+        Returns a function equivalent to :meth:`_evaluate`, specialized for
+        this condition's operator, negation and (compiled) operands.
+        """
+        left, right = self.left, self.right
+        if not isinstance(left, Deferred) or not (right is None or
+                                                  isinstance(right, Deferred)):
+            return self._evaluate
+        left = left._compile(table)
+        if right:
+            right = right._compile(table)
+        else:
+            right = lambda info, r=right: r
+        op, negated = self._eval, self.negated
+        describe = self.__str__
+
+        if self.is_unary:
+            def evaluate(info):
+                try:
+                    try:
+                        result = op(left(info), right(info))
+                    except ChainError:
+                        # As in _evaluate, treat the value as if it were None.
+                        return negated
+                    if result is NotImplemented:  # pragma: no cover
+                        return False
+                    return not result if negated else bool(result)
+                except:
+                    logger.debug('Exception while evaluating condition "{}"'
+                                 .format(describe()), exc_info=True)
+                    return False
+        else:
+            def evaluate(info):
+                try:
+                    result = op(left(info), right(info))
+                    if result is NotImplemented:  # pragma: no cover
+                        return False
+                    return not result if negated else bool(result)
+                except:
+                    logger.debug('Exception while evaluating condition "{}"'
+                                 .format(describe()), exc_info=True)
+                    return False
+        return evaluate
+
 
 class Rule(object):
     def __init__(self, trigger, **kwargs):
@@ -196,15 +355,65 @@ class Rule(object):
         elif conditions is None:
             # Make it so the rule is never matched.
             return ConditionNode(connector=OR)
+        elif isinstance(conditions, six.string_types):
+            # Parsed trees are shared between rules with the same string.
+            from .trees import TreeCache
+            return TreeCache.default.get(conditions)
         else:
+            from .optimizer import optimize
             from .parser import parse_rule
-            return parse_rule(conditions)
+            return optimize(parse_rule(conditions))
 
     def match(self, *objects, **extra):
         """Matches the given arguments against this rule."""
         return self._match({'objects': objects, 'extra': extra})
     __call__ = match
 
+    def filter_queryset(self, queryset, **extra):
+        """
+        Returns the objects in ``queryset`` which match this rule as
+        ``object:0``, doing as much of the work in the database as possible
+        (see :mod:`rules.sql`).
+        """
+        from .sql import filter_queryset
+        return filter_queryset(queryset, self.conditions, **extra)
+
+    def compile(self):
+        """
+        Compiles the current conditions into a single function, which
+        :meth:`_match` uses for as long as the conditions aren't replaced.
+        Conditions modified in place need to be compiled again.
+        """
+        conditions = self.conditions
+        self._compiled = conditions, compile_tree(conditions)
+        return self._compiled[1]
+
+    def __getstate__(self):
+        getstate = getattr(super(Rule, self), '__getstate__', None)
+        state = dict(getstate() if getstate else self.__dict__)
+        if '_compiled' in state:
+            # Functions don't pickle; compiled again when loaded.
+            state['_compiled'] = True
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        compiled = state.pop('_compiled', None)
+        setstate = getattr(super(Rule, self), '__setstate__', None)
+        if setstate is not None:
+            setstate(state)
+        else:
+            self.__dict__.update(state)
+        if compiled:
+            self.compile()
+
+    def _evaluator(self):
+        conditions = self.conditions
+        compiled = getattr(self, '_compiled', None)
+        if compiled is not None and compiled[0] is conditions:
+            return compiled[1]
+        return conditions._evaluate
+
     def continue_(self, info, continuations):
         # Doesn't catch exceptions on purpose, so continuations can be
         # used to affect control flow (though that shouldn't be too common).
@@ -216,7 +425,7 @@ class Rule(object):
 
     def _match(self, info):
         try:
-            if self.conditions._evaluate(info):
+            if self._evaluator()(info):
                 return self
         except Exception:
             logger.debug('Exception while evaluating rule conditions for {}'
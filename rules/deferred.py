@@ -1,7 +1,10 @@
 import abc
+import operator
 import re
 import six
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import Max, Min, Sum
+from django.db.models.query import QuerySet
 
 __all__ = ['Selector', 'Function', 'DeferredValue', 'Deferred',
            'DeferredDict', 'DeferredTuple', 'ChainError', 'StillDeferred']
@@ -28,6 +31,14 @@ class Deferred(object):
             result = info[self] = self._get_value(info)
             return result
 
+    def __getstate__(self):
+        # The shortcut get_value makes for itself and cached hashes are made
+        # again as needed.
+        state = self.__dict__.copy()
+        state.pop('get_value', None)
+        state.pop('_hash', None)
+        return state
+
     def get_value(self, info):
         try:
             value = self.maybe_const()
@@ -36,6 +47,43 @@ class Deferred(object):
             self.get_value = self._get_deferred_value
         return self.get_value(info)
 
+    def _compile(self, table=None):
+        """
+        Returns a function of ``info`` equivalent to :meth:`get_value`,
+        memoizing in ``info`` the same way, or in a slot from ``table`` (see
+        :mod:`rules.frame`) if given.
+        """
+        try:
+            value = self.maybe_const()
+        except StillDeferred:
+            pass
+        except Exception:
+            # Let the error surface at evaluation time, as it would normally.
+            return self.get_value
+        else:
+            return lambda info: value
+        get = self._compile_value(table)
+        if table is not None:
+            return table.memoize(self, get)
+
+        def getter(info):
+            try:
+                return info[self]
+            except KeyError:
+                result = info[self] = get(info)
+                return result
+        return getter
+
+    def _compile_value(self, table=None):
+        """Returns a function of ``info`` equivalent to :meth:`_get_value`."""
+        return self._get_value
+
+
+def _compile_deferred(obj, table=None):
+    if isinstance(obj, Deferred):
+        return obj._compile(table)
+    return lambda info: obj
+
 
 def _make_hashable(obj):
     if isinstance(obj, dict):
@@ -64,6 +112,15 @@ class DeferredDict(dict, Deferred):
         return {k: v.get_value(info) if isinstance(v, Deferred) else v
                 for k, v in six.iteritems(self)}
 
+    def _compile_value(self, table=None):
+        getters = tuple((k, _compile_deferred(v, table))
+                        for k, v in six.iteritems(self))
+        return lambda info: {k: get(info) for k, get in getters}
+
+    def __reduce__(self):
+        # Filling in a copy item by item would need __setitem__.
+        return type(self), (dict(self),), self.__getstate__()
+
     __hash__ = _make_hashwrapper(_make_hashable)
     __setitem__ = __delitem__ = NotImplemented
     pop = popitem = clear = update = setdefault = NotImplemented
@@ -78,6 +135,10 @@ class DeferredTuple(tuple, Deferred):
         return tuple(x.get_value(info) if isinstance(x, Deferred) else x
                      for x in self)
 
+    def _compile_value(self, table=None):
+        getters = tuple(_compile_deferred(x, table) for x in self)
+        return lambda info: tuple(get(info) for get in getters)
+
     __hash__ = _make_hashwrapper(_make_hashable)
 
 
@@ -90,10 +151,112 @@ class ChainError(Exception):
     pass
 
 
+class _Hop(object):
+    """
+    An inline cache for one link of a selector chain, remembering how to get
+    the link from objects of the last type seen.  Only types which can't be
+    subscripted (most model instances, for one) skip straight to attribute
+    access; for anything else, item access is tried first, as usual.
+    """
+    __slots__ = ('name', 'cache', 'misses')
+    # After this many changes of type, the link just uses the general path.
+    MAX_MISSES = 8
+
+    def __init__(self, name):
+        self.name = name
+        # (type, getter) as a single tuple, so threads always see a pair.
+        self.cache = (None, self._generic)
+        self.misses = 0
+
+    def __reduce__(self):
+        # The cache is rebuilt as needed.
+        return _Hop, (self.name,)
+
+    def __call__(self, obj):
+        t, get = self.cache
+        if type(obj) is t:
+            return get(obj)
+        return self._miss(obj)
+
+    def _miss(self, obj):
+        if self.misses >= self.MAX_MISSES:
+            return self._generic(obj)
+        self.misses += 1
+        t = type(obj)
+        self.cache = t, self._specialize(t)
+        return self.cache[1](obj)
+
+    def _specialize(self, t):
+        name = self.name
+        if isinstance(name, six.string_types) and '.' not in name and \
+                not hasattr(t, '__getitem__') and not issubclass(t, type):
+            return operator.attrgetter(name)
+        item = operator.itemgetter(name)
+
+        def get(obj):
+            try:
+                return item(obj)
+            except (KeyError, TypeError):
+                return getattr(obj, name)
+        return get
+
+    def _generic(self, obj):
+        try:
+            return obj[self.name]
+        except (KeyError, TypeError):
+            return getattr(obj, self.name)
+
+
+def _hops(chain):
+    """Returns inline caches for the constant links of a chain."""
+    if not isinstance(chain, DeferredTuple):
+        return None
+    hops = []
+    for link in chain:
+        if isinstance(link, Deferred):
+            hops.append(None)
+        elif isinstance(link, tuple):
+            hops.append(_Hop(link[0]))
+        else:
+            hops.append(_Hop(link))
+    return tuple(hops)
+
+
+def _follow(obj, get_chain, info, hops=None):
+    try:
+        links = get_chain(info)
+        for i, getter in enumerate(links):
+            if isinstance(getter, tuple):
+                getter, args = getter
+            else:
+                args = ()
+            hop = hops[i] if hops else None
+            if hop is not None:
+                obj = hop(obj)
+            else:
+                try:
+                    obj = obj[getter]
+                except (KeyError, TypeError):
+                    obj = getattr(obj, getter)
+            if callable(obj):
+                if isinstance(args, dict):
+                    obj = obj(**args)
+                elif isinstance(args, (list, tuple)):
+                    obj = obj(*args)
+                else:
+                    obj = obj(args)
+    except ChainError:  # pragma: no cover
+        raise
+    except Exception as ex:
+        raise ChainError(ex)
+    return obj
+
+
 class Selector(DeferredValue):
     def __init__(self, selector_type, chain):
         self.chain = (chain if isinstance(chain, Deferred)
                       else DeferredTuple(chain or ()))
+        self._hops = _hops(self.chain)
         if isinstance(selector_type, (list, tuple)):
             self.set_first(*selector_type)
         else:
@@ -118,6 +281,16 @@ class Selector(DeferredValue):
             raise NotImplementedError('Unknown selector type: "{}"'
                                       .format(stype))
 
+    def __getstate__(self):
+        state = DeferredValue.__getstate__(self)
+        # A closure, made again by set_first.
+        del state['first']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.set_first(self.stype, self.arg)
+
     def __str__(self):
         stype = self.stype
         if stype in ('const', 'model'):
@@ -135,29 +308,17 @@ class Selector(DeferredValue):
         raise StillDeferred(self)
 
     def _get_value(self, info):
-        obj = self.first(info)
-        try:
-            for getter in self.chain.get_value(info):
-                if isinstance(getter, tuple):
-                    getter, args = getter
-                else:
-                    args = ()
-                try:
-                    obj = obj[getter]
-                except (KeyError, TypeError):
-                    obj = getattr(obj, getter)
-                if callable(obj):
-                    if isinstance(args, dict):
-                        obj = obj(**args)
-                    elif isinstance(args, (list, tuple)):
-                        obj = obj(*args)
-                    else:
-                        obj = obj(args)
-        except ChainError:  # pragma: no cover
-            raise
-        except Exception as ex:
-            raise ChainError(ex)
-        return obj
+        return _follow(self.first(info), self.chain.get_value, info,
+                       self._hops)
+
+    def _compile_value(self, table=None):
+        stype = self.stype
+        if isinstance(stype, Deferred):
+            first = stype._compile(table)
+        else:
+            first = self.first
+        get_chain, hops = self.chain._compile(table), self._hops
+        return lambda info: _follow(first(info), get_chain, info, hops)
 
     def __eq__(self, obj):
         return self is obj or (self.stype == getattr(obj, 'stype', None) and
@@ -168,6 +329,84 @@ class Selector(DeferredValue):
     __hash__ = _make_hashwrapper(__hash__)
 
 
+def _values_field(queryset, kinds):
+    """
+    Returns ``(field, flat)`` for a ``values_list`` of one non-null field of
+    the queryset's model with an internal type in ``kinds``, else
+    ``(None, None)``.
+    """
+    fields = getattr(queryset, '_fields', None)
+    if not fields or len(fields) != 1:
+        return None, None
+    flat = getattr(queryset, 'flat', None)
+    if flat is None:
+        iterable = getattr(queryset, '_iterable_class', None)
+        flat = {'FlatValuesListIterable': True,
+                'ValuesListIterable': False}.get(getattr(iterable, '__name__',
+                                                         None))
+        if flat is None:
+            return None, None
+    opts = queryset.model._meta
+    try:
+        field = opts.pk if fields[0] == 'pk' else opts.get_field(fields[0])
+    except Exception:
+        return None, None
+    if field.null or field.is_relation:
+        # Python would choke on nulls, which the database skips.
+        return None, None
+    if field.get_internal_type() not in kinds:
+        return None, None
+    return fields[0], flat
+
+
+# Fields whose sums the database gets exactly right; floats may be added up
+# in another order.
+_SUMMABLE = frozenset([
+    'AutoField', 'BigAutoField', 'IntegerField', 'BigIntegerField',
+    'SmallIntegerField', 'PositiveIntegerField', 'PositiveSmallIntegerField',
+    'DecimalField',
+])
+# Fields the database orders as Python does; text goes by the collation.
+_ORDERABLE = _SUMMABLE | frozenset([
+    'FloatField', 'DateField', 'DateTimeField', 'TimeField', 'DurationField',
+])
+
+
+def _aggregate(aggregate, kinds, flat_only):
+    def pushdown(queryset):
+        if queryset._result_cache is not None:
+            # Already loaded, so Python can do it for free.
+            return NotImplemented
+        field, flat = _values_field(queryset, kinds)
+        if field is None or (flat_only and not flat):
+            return NotImplemented
+        value = queryset.aggregate(_value=aggregate(field))['_value']
+        if value is None:
+            # No rows; let Python give the usual result (or error).
+            return NotImplemented
+        return value if flat else (value,)
+    return pushdown
+
+
+def _count(queryset):
+    return queryset.count()
+
+
+def _pushdown(func, pushdown):
+    """Calls ``pushdown`` for a single queryset argument, if it can."""
+    def call(*args):
+        if len(args) == 1 and isinstance(args[0], QuerySet):
+            try:
+                result = pushdown(args[0])
+            except Exception:
+                # Slices, combined queries and the like; Python will do.
+                result = NotImplemented
+            if result is not NotImplemented:
+                return result
+        return func(*args)
+    return call
+
+
 class Function(DeferredValue):
     FUNCS = {
         'len': len,
@@ -187,21 +426,50 @@ class Function(DeferredValue):
         'round': round,
         'regex': re.compile
     }
+    # Functions of a single queryset which can be done by the database
+    # instead, giving exactly what Python would, or returning
+    # ``NotImplemented`` when they can't.  Python can't sum the 1-tuples of a
+    # non-flat ``values_list``, so neither does the database.
+    PUSHDOWNS = {
+        'len': _count,
+        'sum': _aggregate(Sum, _SUMMABLE, True),
+        'max': _aggregate(Max, _ORDERABLE, False),
+        'min': _aggregate(Min, _ORDERABLE, False),
+    }
 
     def __init__(self, func, args):
-        self.func = self.FUNCS[func]
-        self.name = func
+        self._set_func(func)
         self.args = (args if isinstance(args, Deferred)
                      else DeferredTuple(args or ()))
 
+    def _set_func(self, name):
+        self.func = self._call = self.FUNCS[name]
+        if name in self.PUSHDOWNS:
+            self._call = _pushdown(self.func, self.PUSHDOWNS[name])
+        self.name = name
+
+    def __getstate__(self):
+        state = DeferredValue.__getstate__(self)
+        # Looked up again by name.
+        del state['func'], state['_call']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._set_func(self.name)
+
     def __str__(self):
         return self.name + '(' + ', '.join(str(a) for a in self.args) + ')'
 
     def maybe_const(self):
-        return self.func(*self.args.maybe_const())
+        return self._call(*self.args.maybe_const())
 
     def _get_value(self, info):
-        return self.func(*self.args.get_value(info))
+        return self._call(*self.args.get_value(info))
+
+    def _compile_value(self, table=None):
+        func, get_args = self._call, self.args._compile(table)
+        return lambda info: func(*get_args(info))
 
     def __eq__(self, obj):
         return self is obj or (self.name == getattr(obj, 'name', None) and
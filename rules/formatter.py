@@ -1,3 +1,15 @@
+"""
+Formats condition trees as strings which :func:`~rules.parser.parse_rule`
+parses back.
+
+Deferred values are numbered in a ``with(...)`` list as they're first
+formatted, and equal ones share a number.  The numbers are found in a hash
+map, so formatting takes time linear in the size of the tree.  Canonical
+strings (``format_rule(tree, canonical=True)``) also put the children of each
+node and the keys of each dict in order, so trees which differ only in those
+give the same string, and the same :func:`fingerprint`.
+"""
+import hashlib
 from datetime import datetime, date, time
 from decimal import Decimal
 from json.encoder import encode_basestring_ascii
@@ -7,9 +19,52 @@ from .core import Condition, ConditionNode
 from .deferred import DeferredValue, Selector, Function
 
 
+class _Table(list):
+    """
+    The deferred values numbered so far: a list of their strings, followed by
+    the values themselves, with a map from each value to its number.  Plain
+    lists like that work too, but are searched.
+    """
+    canonical = False
+
+    def __init__(self):
+        list.__init__(self, [[]])
+        self.indexes = {}
+
+
+class _CanonicalTable(_Table):
+    """A table which also puts children and dict keys in order."""
+    canonical = True
+
+    def __init__(self, keys=None, inline=False):
+        _Table.__init__(self)
+        self.keys = {} if keys is None else keys
+        # Spells deferred values out, for keys which don't depend on numbers.
+        self.inline = self if inline else None
+
+    def key(self, obj):
+        """Returns the string to sort ``obj`` by among its siblings."""
+        try:
+            return self.keys[id(obj)][0]
+        except KeyError:
+            pass
+        if self.inline is None:
+            self.inline = _CanonicalTable(self.keys, True)
+        if isinstance(obj, DeferredValue):
+            key = '\\(' + _format_new(obj, self.inline) + ')'
+        else:
+            key = _format(obj, self.inline)
+        # Kept with the key so the id isn't reused.
+        self.keys[id(obj)] = key, obj
+        return key
+
+
 def _format_dict(obj, deferred):
+    items = iteritems(obj)
+    if getattr(deferred, 'canonical', False):
+        items = sorted(items, key=lambda item: item[0])
     pairs = (encode_basestring_ascii(k) + ':' + _format(v, deferred)
-             for k, v in iteritems(obj))
+             for k, v in items)
     return '{' + ','.join(pairs) + '}'
 
 
@@ -44,19 +99,43 @@ def _format_func(obj, deferred):
     return obj.name + '(' + ','.join(args) + ')'
 
 
+def _format_new(obj, deferred):
+    if isinstance(obj, Selector):
+        return _format_sel(obj, deferred)
+    elif isinstance(obj, Function):
+        return _format_func(obj, deferred)
+    raise ValueError('Unknown deferred type')
+
+
+def _find(obj, deferred):
+    # The number of an equal value numbered already; raises ValueError if
+    # there isn't one.
+    indexes = getattr(deferred, 'indexes', None)
+    if indexes is not None:
+        try:
+            return indexes[obj]
+        except KeyError:
+            raise ValueError(obj)
+        except TypeError:
+            # Unhashable constants; searched for instead.
+            pass
+    return deferred.index(obj) - 1
+
+
 def _format_deferred(obj, deferred):
+    if getattr(deferred, 'inline', None) is deferred:
+        return deferred.key(obj)
     try:
-        index = deferred.index(obj) - 1
+        index = _find(obj, deferred)
     except ValueError:
-        if isinstance(obj, Selector):
-            v = _format_sel(obj, deferred)
-        elif isinstance(obj, Function):
-            v = _format_func(obj, deferred)
-        else:
-            raise ValueError('Unknown deferred type')
+        v = _format_new(obj, deferred)
         index = len(deferred[0])
         deferred[0].append(v)
         deferred.append(obj)
+        try:
+            deferred.indexes[obj] = index
+        except (AttributeError, TypeError):
+            pass
     return '\\' + str(index)
 
 
@@ -77,7 +156,13 @@ def _format_cond(obj, deferred):
 
 def _format_tree(obj, deferred):
     c = ' ' + obj.connector + ' '
-    return '(' + c.join(_format(v, deferred) for v in obj.children) + ')'
+    children = obj.children
+    if getattr(deferred, 'canonical', False):
+        # The order of children doesn't change what a node means.
+        children = sorted(children, key=deferred.key)
+        if deferred.inline is deferred:
+            return '(' + c.join(deferred.key(v) for v in children) + ')'
+    return '(' + c.join(_format(v, deferred) for v in children) + ')'
 
 
 def _format(obj, deferred):
@@ -104,9 +189,22 @@ def _format(obj, deferred):
     raise ValueError('Unknown object type')
 
 
-def format_rule(obj):
-    deferred = [[]]
+def format_rule(obj, canonical=False):
+    """
+    Returns the string for a condition tree; with ``canonical``, the same for
+    trees which differ only in the order of children or dict keys.
+    """
+    deferred = _CanonicalTable() if canonical else _Table()
     string = _format_tree(obj, deferred)
     if deferred:
         string = 'with(' + ','.join(deferred[0]) + ') ' + string
     return string
+
+
+def fingerprint(obj):
+    """
+    Returns a hex digest of the canonical string of a condition tree, to tell
+    whether trees are equivalent without comparing them.
+    """
+    string = format_rule(obj, canonical=True)
+    return hashlib.sha1(string.encode('utf-8')).hexdigest()
@@ -0,0 +1,119 @@
+"""
+Evaluation frames with numbered slots for deferred values.
+
+Normally each deferred value is memoized in ``info`` under itself, which means
+hashing (and sometimes comparing) selectors on every lookup.  A
+:class:`FrameRuleList` instead gives each distinct deferred value in its rules
+a slot number from a :class:`SlotTable` when it's built, and each check gets a
+:class:`Frame`: the usual ``info`` dict, plus a flat list of slots.  Compiled
+rules then memoize by index.  Since a frame is still a dict, anything which
+isn't compiled (custom nodes, rules without conditions, continuations) works
+exactly as before.
+"""
+import logging
+
+from .cache import RuleList, _rule_conditions
+from .core import ConditionNode, Condition, compile_tree
+from .network import _beta
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['Frame', 'SlotTable', 'FrameRuleList']
+
+# Marks slots which haven't been filled yet.
+_EMPTY = object()
+
+
+class Frame(dict):
+    """An ``info`` dict for a check, with slots from ``table``."""
+    __slots__ = ('table', 'slots')
+
+    def __init__(self, info, table):
+        dict.__init__(self, info)
+        self.table = table
+        self.slots = [_EMPTY] * len(table)
+
+
+class SlotTable(object):
+    """Numbers deferred values, giving equal ones the same slot."""
+
+    def __init__(self):
+        self.slots = {}
+        self._unhashable = 0
+
+    def __len__(self):
+        return len(self.slots) + self._unhashable
+
+    def slot(self, deferred):
+        try:
+            return self.slots[deferred]
+        except KeyError:
+            slot = self.slots[deferred] = len(self)
+            return slot
+        except TypeError:
+            # Can't be shared, but can still have a slot of its own.
+            self._unhashable += 1
+            return len(self) - 1
+
+    def frame(self, info):
+        return Frame(info, self)
+
+    def memoize(self, deferred, get):
+        """
+        Returns a function like ``get``, memoizing in the deferred value's
+        slot for frames from this table, and in ``info`` otherwise.
+        """
+        slot = self.slot(deferred)
+
+        def getter(info):
+            if type(info) is Frame and info.table is self:
+                slots = info.slots
+                try:
+                    value = slots[slot]
+                except IndexError:
+                    # Slotted after the frame was made, by something compiled
+                    # lazily (like the children of an adaptive node).
+                    slots.extend([_EMPTY] * (len(self) - len(slots)))
+                    value = _EMPTY
+                if value is _EMPTY:
+                    value = slots[slot] = get(info)
+                return value
+            try:
+                return info[deferred]
+            except KeyError:
+                result = info[deferred] = get(info)
+                return result
+        return getter
+
+
+class FrameRuleList(RuleList):
+    """
+    A :class:`~rules.cache.RuleList` which checks its rules in frames.  Like a
+    compiled rule, it reflects the conditions as they were when it was built.
+    """
+
+    def __new__(cls, iterable=None):
+        self = RuleList.__new__(cls, iterable)
+        self.table = SlotTable()
+        self._matchers = [self._add(r) for r in self]
+        return self
+
+    def _add(self, rule):
+        conditions = _rule_conditions(rule)
+        if not isinstance(conditions, (Condition, ConditionNode)):
+            return rule._match
+        try:
+            return _beta(rule, compile_tree(conditions, self.table))
+        except Exception:
+            logger.debug('Exception while compiling rule {}'.format(rule),
+                         exc_info=True)
+            return rule._match
+
+    def _matches(self, info):
+        frame = Frame(info, self.table)
+        results = []
+        for match in self._matchers:
+            x = match(frame)
+            if x:
+                results.append(x)
+        return results
@@ -0,0 +1,524 @@
+"""
+Rule lists which use indexes to skip rules that can't possibly match.
+
+Most rules are guarded by simple tests of a single value, e.g. a top-level
+``object:0.status == "closed" AND ...``, ``object:0.amount > 10000 AND ...``,
+``object:0.email like regex(".*@example\\.com$") AND ...`` or
+``"fraud" in object:0.notes AND ...``.  When an indexed list is built, one such
+guard is chosen for each rule and added to an index for its deferred value.
+When checking, each indexed value is computed once and looked up, and only the
+rules which come back as candidates (plus any rules without a usable guard) are
+fully evaluated, still in weight order.
+"""
+import datetime
+import decimal
+import re
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+import six
+
+from .cache import RuleList, RuleMutex, _rule_conditions
+from .core import AND, Condition, ConditionNode
+from .deferred import DeferredValue, StillDeferred
+
+__all__ = ['EqualityIndex', 'RangeIndex', 'PatternIndex', 'SubstringIndex',
+           'IndexedRuleList', 'IndexedRuleMutex']
+
+# Types for which equality and hashing are known to agree, so a dict lookup
+# gives the same answer as ``==``.  Subclasses could change that, so the types
+# have to match exactly.
+_HASH_SAFE = frozenset(six.string_types + six.integer_types + (
+    six.text_type, six.binary_type, float, bool, type(None), decimal.Decimal,
+    datetime.date, datetime.datetime, datetime.time, datetime.timedelta,
+))
+
+
+def _const(deferred):
+    """Returns ``(True, value)`` for constant deferred values."""
+    if not isinstance(deferred, DeferredValue):
+        return False, None
+    try:
+        return True, deferred.maybe_const()
+    except StillDeferred:
+        return False, None
+    except Exception:
+        # Will fail when evaluated; leave that to the condition.
+        return False, None
+
+
+def _operands(cond):
+    """
+    Returns ``(deferred, constant, flipped)`` for conditions comparing a
+    non-constant deferred value with a constant, else ``None``.
+    """
+    if cond.negated or cond.is_unary:
+        return None
+    lconst, left = _const(cond.left)
+    rconst, right = _const(cond.right)
+    if rconst and not lconst and isinstance(cond.left, DeferredValue):
+        return cond.left, right, False
+    elif lconst and not rconst and isinstance(cond.right, DeferredValue):
+        return cond.right, left, True
+    return None
+
+
+# Groups of types which can be ordered among themselves.
+_NUMERIC = 'numeric'
+_ORDERED = {datetime.date: datetime.date,
+            datetime.datetime: datetime.datetime,
+            datetime.time: datetime.time,
+            datetime.timedelta: datetime.timedelta,
+            six.text_type: six.text_type, six.binary_type: six.binary_type,
+            float: _NUMERIC, bool: _NUMERIC, decimal.Decimal: _NUMERIC}
+for _t in six.integer_types:
+    _ORDERED[_t] = _NUMERIC
+del _t
+
+
+def _hashable(value):
+    # NaN isn't equal to itself, but would be found by identity.
+    return type(value) in _HASH_SAFE and value == value
+
+
+def guards(rule):
+    """Yields the conditions which must hold for ``rule`` to match."""
+    conditions = _rule_conditions(rule)
+    if isinstance(conditions, Condition):
+        yield conditions
+    elif isinstance(conditions, ConditionNode) and conditions.connector == AND:
+        for child in conditions.children:
+            if isinstance(child, Condition):
+                yield child
+
+
+class EqualityIndex(object):
+    """Indexes ``<value> == <const>`` and ``<value> in [<consts>]`` guards."""
+
+    def __init__(self, deferred):
+        self.deferred = deferred
+        self.table = defaultdict(list)
+        self.positions = []
+
+    @classmethod
+    def guard(cls, cond):
+        """
+        Returns ``(deferred, keys)`` if the condition can be indexed by this
+        type of index, else ``None``.
+        """
+        operands = _operands(cond)
+        if operands is None:
+            return None
+        deferred, const, flipped = operands
+        if cond.operator == '==':
+            keys = (const,)
+        elif cond.operator == 'in' and not flipped and \
+                isinstance(const, (list, tuple, set, frozenset)):
+            keys = tuple(const)
+        else:
+            return None
+        if all(_hashable(k) for k in keys):
+            return deferred, keys
+        return None
+
+    def add(self, keys, position):
+        self.positions.append(position)
+        for k in set(keys):
+            self.table[k].append(position)
+
+    def lookup(self, value):
+        """Returns the positions of the rules whose guards ``value`` meets."""
+        if _hashable(value):
+            return self.table.get(value, ())
+        # Can't trust a hash lookup, so every rule is a candidate.
+        return self.positions
+
+
+class RangeIndex(object):
+    """
+    Indexes ``<value> < <const>`` guards (and ``<=``, ``>``, ``>=``), keeping
+    the constants sorted so a bisection finds every guard that holds.
+    """
+    # Flipping the operands flips the operator.
+    FLIPPED = {'<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+    def __init__(self, deferred):
+        self.deferred = deferred
+        # {kind: {operator: ([sorted constants], [positions])}}
+        self.tables = {}
+        self.positions = []
+
+    @classmethod
+    def guard(cls, cond):
+        operands = _operands(cond)
+        if operands is None or cond.operator not in cls.FLIPPED:
+            return None
+        deferred, const, flipped = operands
+        if type(const) not in _ORDERED or const != const:
+            return None
+        op = cls.FLIPPED[cond.operator] if flipped else cond.operator
+        return deferred, (op, const)
+
+    def add(self, key, position):
+        op, const = key
+        self.positions.append(position)
+        tables = self.tables.setdefault(_ORDERED[type(const)], {})
+        consts, positions = tables.setdefault(op, ([], []))
+        i = bisect_right(consts, const)
+        consts.insert(i, const)
+        positions.insert(i, position)
+
+    def lookup(self, value):
+        kind = _ORDERED.get(type(value))
+        if kind not in self.tables:
+            return self.positions
+        # Constants of other kinds can't be compared with this value (at least
+        # not sensibly), so their rules are left to full evaluation.
+        result = [p for k, tables in six.iteritems(self.tables) if k != kind
+                  for consts, positions in six.itervalues(tables)
+                  for p in positions]
+        if value != value:
+            # NaN; every comparison is false.
+            return result
+        try:
+            for op, (consts, positions) in six.iteritems(self.tables[kind]):
+                if op == '>':
+                    result.extend(positions[:bisect_left(consts, value)])
+                elif op == '>=':
+                    result.extend(positions[:bisect_right(consts, value)])
+                elif op == '<':
+                    result.extend(positions[bisect_right(consts, value):])
+                else:
+                    result.extend(positions[bisect_left(consts, value):])
+        except TypeError:
+            # Of the same type, but still not comparable (like naive and aware
+            # datetimes), so it's all left to full evaluation.
+            return self.positions
+        return result
+
+
+_PATTERN_TYPE = type(re.compile(''))
+_SPECIAL = set('.^$*+?{}[]|()\\')
+_QUANTIFIERS = set('*+?{')
+_BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+def _literal_prefix(pattern):
+    """
+    Returns the literal text any match of ``pattern`` must start with, which
+    may well be empty.
+    """
+    if pattern.flags & (re.IGNORECASE | re.VERBOSE):
+        return ''
+    source, prefix = pattern.pattern, []
+    # Patterns are only ever matched at the start.
+    i, length = 1 if source.startswith('^') else 0, len(source)
+    # Any top-level alternation makes the prefix meaningless.
+    depth, in_class, escaped = 0, False, False
+    for c in source:
+        if escaped:
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif in_class:
+            in_class = c != ']'
+        elif c == '[':
+            in_class = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            return ''
+    while i < length:
+        c = source[i]
+        if c == '\\' and i + 1 < length and not source[i + 1].isalnum():
+            c, step = source[i + 1], 2
+        elif c in _SPECIAL:
+            break
+        else:
+            step = 1
+        if i + step < length and source[i + step] in _QUANTIFIERS:
+            # The last character is optional or repeated.
+            break
+        prefix.append(c)
+        i += step
+    return ''.join(prefix)
+
+
+def _combinable(pattern):
+    if _BACKREFERENCE.search(pattern.pattern):
+        # Group numbers change when combined.
+        return False
+    try:
+        re.compile('(?P<_0>{})'.format(pattern.pattern), pattern.flags)
+    except re.error:
+        # e.g. inline global flags, which have to be at the very start.
+        return False
+    return True
+
+
+class _PatternGroup(object):
+    """Patterns with the same flags, for :class:`PatternIndex`."""
+
+    def __init__(self, flags):
+        self.flags = flags
+        self.trie = {}
+        self.patterns = []
+        self.uncombinable = []
+        self._combined = None
+
+    def add(self, pattern, position):
+        node = self.trie
+        for c in _literal_prefix(pattern):
+            node = node.setdefault(c, {})
+        if node is not self.trie:
+            node.setdefault(None, []).append(position)
+        elif _combinable(pattern):
+            self.patterns.append((pattern, position))
+            self._combined = None
+        else:
+            self.uncombinable.append(position)
+
+    @property
+    def combined(self):
+        """
+        A single regex of every unprefixed pattern, one named group each, or
+        ``False`` if they can't be combined.
+        """
+        if self._combined is None:
+            alternatives = ('(?P<_{}>{})'.format(i, p.pattern)
+                            for i, (p, position) in enumerate(self.patterns))
+            try:
+                self._combined = re.compile('|'.join(alternatives),
+                                            self.flags)
+            except re.error:
+                # Most likely the same group name in different patterns.
+                self._combined = False
+        return self._combined
+
+    def lookup(self, value):
+        result = list(self.uncombinable)
+        node = self.trie
+        for c in value:
+            try:
+                node = node[c]
+            except KeyError:
+                break
+            result.extend(node.get(None, ()))
+        if not self.patterns:
+            return result
+        combined = self.combined
+        if combined is False:
+            result.extend(i for p, i in self.patterns)
+            return result
+        m = combined.match(value)
+        if m is not None:
+            # The alternatives before the one which matched all failed, the
+            # others still might match.
+            first = int(m.lastgroup[1:])
+            result.extend(i for p, i in self.patterns[first:])
+        return result
+
+
+class PatternIndex(object):
+    """
+    Indexes ``<value> like <regex>`` guards.  Patterns starting with literal
+    text go into a trie, so one walk over the value finds every prefix that
+    fits, and the rest are combined into a single alternation to rule out
+    the ones which can't match.
+    """
+
+    def __init__(self, deferred):
+        self.deferred = deferred
+        self.groups = {}
+        self.positions = []
+
+    @classmethod
+    def guard(cls, cond):
+        operands = _operands(cond)
+        if operands is None or cond.operator not in ('like', 're'):
+            return None
+        deferred, const, flipped = operands
+        if flipped or not isinstance(const, _PATTERN_TYPE) or \
+                not isinstance(const.pattern, six.text_type):
+            return None
+        return deferred, const
+
+    def add(self, pattern, position):
+        self.positions.append(position)
+        try:
+            group = self.groups[pattern.flags]
+        except KeyError:
+            group = self.groups[pattern.flags] = _PatternGroup(pattern.flags)
+        group.add(pattern, position)
+
+    def lookup(self, value):
+        if not isinstance(value, six.text_type):
+            # Let the conditions decide what to make of it.
+            return self.positions
+        result = []
+        for group in six.itervalues(self.groups):
+            result.extend(group.lookup(value))
+        return result
+
+
+class _Automaton(object):
+    """An Aho-Corasick automaton over some strings."""
+
+    def __init__(self, keywords):
+        # Each state is [transitions, failure state, positions].
+        root = [{}, None, []]
+        for keyword, position in keywords:
+            state = root
+            for c in keyword:
+                try:
+                    state = state[0][c]
+                except KeyError:
+                    state[0][c] = [{}, root, []]
+                    state = state[0][c]
+            state[2].append(position)
+        queue = list(six.itervalues(root[0]))
+        for state in queue:
+            for c, child in six.iteritems(state[0]):
+                fail = state[1]
+                while fail is not root and c not in fail[0]:
+                    fail = fail[1]
+                child[1] = fail[0].get(c, root)
+                # Everything found by the failure state ends here too.
+                child[2].extend(child[1][2])
+                queue.append(child)
+        self.root = root
+
+    def search(self, text):
+        """Returns the positions of every keyword in ``text``."""
+        root = state = self.root
+        found = []
+        for c in text:
+            while c not in state[0] and state is not root:
+                state = state[1]
+            state = state[0].get(c, root)
+            found.extend(state[2])
+        return found
+
+
+class SubstringIndex(object):
+    """
+    Indexes ``<const> in <value>`` guards on text, so a single pass over the
+    value finds every constant it contains.  The automaton is only built the
+    first time it's needed.
+    """
+
+    def __init__(self, deferred):
+        self.deferred = deferred
+        self.keywords = []
+        self.always = []
+        self.positions = []
+        self._automaton = None
+
+    @classmethod
+    def guard(cls, cond):
+        operands = _operands(cond)
+        if operands is None or cond.operator != 'in':
+            return None
+        deferred, const, flipped = operands
+        if not flipped or type(const) is not six.text_type:
+            return None
+        return deferred, const
+
+    def add(self, keyword, position):
+        self.positions.append(position)
+        if keyword:
+            self.keywords.append((keyword, position))
+            self._automaton = None
+        else:
+            self.always.append(position)
+
+    @property
+    def automaton(self):
+        if self._automaton is None:
+            self._automaton = _Automaton(self.keywords)
+        return self._automaton
+
+    def lookup(self, value):
+        if type(value) is not six.text_type:
+            # Other containers (or subclasses) may define ``in`` differently.
+            return self.positions
+        # A keyword can be found several times.
+        return self.always + list(set(self.automaton.search(value)))
+
+
+class _Indexed(object):
+    # In order of preference, when a rule has guards usable by several.
+    INDEXES = (EqualityIndex, RangeIndex, PatternIndex, SubstringIndex)
+
+    def _guard(self, rule):
+        conds = list(guards(rule))
+        for index_cls in self.INDEXES:
+            for cond in conds:
+                guard = index_cls.guard(cond)
+                if guard is not None:
+                    return index_cls, guard
+        return None, None
+
+    def _build(self):
+        self.indexes = {}
+        unindexed = []
+        for position, rule in enumerate(self):
+            index_cls, guard = self._guard(rule)
+            if guard is None:
+                unindexed.append(position)
+            else:
+                deferred, keys = guard
+                try:
+                    index = self.indexes[(index_cls, deferred)]
+                except KeyError:
+                    index = index_cls(deferred)
+                    self.indexes[(index_cls, deferred)] = index
+                index.add(keys, position)
+        self.unindexed = unindexed
+
+    def _candidates(self, info):
+        positions = list(self.unindexed)
+        for index in six.itervalues(self.indexes):
+            try:
+                value = index.deferred.get_value(info)
+            except Exception:
+                # The guard can't be true, so neither can any of its rules.
+                continue
+            positions.extend(index.lookup(value))
+        positions.sort()
+        return [self[i] for i in positions]
+
+
+class IndexedRuleList(_Indexed, RuleList):
+    """A :class:`~rules.cache.RuleList` which only checks candidate rules."""
+
+    def __new__(cls, iterable=None):
+        self = RuleList.__new__(cls, iterable)
+        self._build()
+        return self
+
+    def _matches(self, info):
+        results = []
+        for r in self._candidates(info):
+            x = r._match(info)
+            if x:
+                results.append(x)
+        return results
+
+
+class IndexedRuleMutex(_Indexed, RuleMutex):
+    """A :class:`~rules.cache.RuleMutex` which only checks candidate rules."""
+
+    def __new__(cls, iterable=None):
+        self = RuleMutex.__new__(cls, iterable)
+        self._build()
+        return self
+
+    def _match(self, info):
+        for r in self._candidates(info):
+            x = r._match(info)
+            if x:
+                return x
+        return False
@@ -0,0 +1,40 @@
+import io
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rules.conf import settings
+
+
+class Command(BaseCommand):
+    help = ('Loads rules from bundles of JSON lines, one rule per line (see'
+            ' rules.bundle).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('bundles', nargs='+', metavar='bundle',
+                            help='A bundle file, or - for standard input.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            dest='batch_size',
+                            help='Rules parsed and saved at a time.')
+        parser.add_argument('--workers', type=int, default=1, dest='workers',
+                            help='Processes to parse trees with; 0 for one'
+                            ' per CPU.')
+
+    def handle(self, *args, **options):
+        if not settings.RULES_CONCRETE_MODELS:
+            raise CommandError('There is no rules model to load into.')
+        from rules.bundle import load_bundle
+        workers = options['workers'] or None
+        total = 0
+        for path in options['bundles']:
+            try:
+                if path == '-':
+                    total += load_bundle(sys.stdin, None,
+                                         options['batch_size'], workers)
+                    continue
+                with io.open(path, encoding='utf-8') as f:
+                    total += load_bundle(f, None, options['batch_size'],
+                                         workers)
+            except (IOError, ValueError) as e:
+                raise CommandError('{}: {}'.format(path, e))
+        self.stdout.write('Loaded {} rules.'.format(total))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from rules.conf import settings
+from rules.serial import dumps, is_current
+
+
+class Command(BaseCommand):
+    help = ('Stores the serialized condition tree of each rule which lacks an'
+            ' up-to-date one, so it loads without parsing.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', dest='all',
+                            help='Serialize every rule, even those which are'
+                            ' up to date.')
+
+    def handle(self, *args, **options):
+        if not settings.RULES_CONCRETE_MODELS:
+            raise CommandError('There is no rules model to update.')
+        if not settings.RULES_SERIALIZED_TREES:
+            raise CommandError('RULES_SERIALIZED_TREES is off, so rules have'
+                               ' nowhere to store serialized trees.')
+        from rules.models import Rule
+        written = skipped = 0
+        for rule in Rule.objects.iterator():
+            if not options['all'] and \
+                    is_current(rule.serialized_tree, rule.tree):
+                continue
+            try:
+                data = dumps(rule.conditions, rule.tree)
+            except (TypeError, ValueError):
+                # Custom parts, or a tree which doesn't parse.
+                skipped += 1
+                data = None
+            # Not saved, which would reformat the tree and update guards.
+            Rule.objects.filter(pk=rule.pk).update(serialized_tree=data)
+            written += 1
+        self.stdout.write('Serialized {} rules ({} can only be parsed).'
+                          .format(written - skipped, skipped))
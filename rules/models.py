@@ -1,12 +1,22 @@
-from django.db import models
+import copy
+
+import six
+from django.db import models, transaction
 from django.db.models.query import QuerySet
+from django.db.models.signals import post_delete, post_save
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
 
 from madlibs.models.fields import JSONTextField
 from .cache import RuleCache, TopicalRuleCache
 from .conf import settings
-from .core import Rule as CoreRule
+from .core import OR, ConditionNode, Rule as CoreRule
+from .percolator import Percolator
+from .serial import dumps, is_current, loads
+from .sql import filter_queryset
+
+# The tree string stored for conditions which can never be true.
+CONTRADICTION = '1 == 2'
 
 
 class RuleQueryMixin(object):
@@ -26,7 +36,7 @@ class RuleQueryMixin(object):
 class RuleSet(RuleQueryMixin, QuerySet):
     """
     Queryset for rules with a few special filters (from :class:`RuleQueryMixin`
-    and a bulk :meth:`matches` method.
+    and bulk :meth:`matches` and :meth:`filter_queryset` methods.
     """
 
     def matches(self, *objects, **extra):
@@ -34,6 +44,14 @@ class RuleSet(RuleQueryMixin, QuerySet):
         info = {'objects': objects, 'extra': extra}
         return [r for r in self if r._match(info)]
 
+    def filter_queryset(self, queryset, **extra):
+        """
+        Returns the objects in ``queryset`` which match any of the rules in
+        the QuerySet as ``object:0``; see :meth:`Rule.filter_queryset`.
+        """
+        tree = ConditionNode([r.conditions for r in self], OR)
+        return filter_queryset(queryset, tree, **extra)
+
 
 class RuleManager(RuleQueryMixin, models.Manager):
     """Manager with helpful methods for working with :class:`Rule`s."""
@@ -64,6 +82,12 @@ class BaseRule(CoreRule, models.Model):
     value = JSONTextField(blank=True, help_text='A helper value to be passed'
                           ' to the continuation when the rule is matched.')
     tree = models.TextField(help_text='The string form the condition tree.')
+    if settings.RULES_SERIALIZED_TREES:
+        # A column to add to existing tables before turning this on; rules
+        # without it are always parsed.
+        serialized_tree = models.BinaryField(
+            null=True, blank=True, editable=False, help_text='The condition'
+            ' tree in a form which loads without parsing.')
     weight = models.IntegerField(default=0, blank=True)
 
     objects = RuleManager()
@@ -71,6 +95,12 @@ class BaseRule(CoreRule, models.Model):
     def __init__(self, *args, **kwargs):
         models.Model.__init__(self, *args, **kwargs)
 
+    def save(self, *args, **kwargs):
+        models.Model.save(self, *args, **kwargs)
+        if settings.RULES_PERCOLATOR:
+            from .percolator import update_guards
+            update_guards(self)
+
     def __str__(self):
         return '{0.trigger}->{0.continuation}: {0.description}'.format(self)
 
@@ -78,23 +108,96 @@ class BaseRule(CoreRule, models.Model):
     def is_system(self):
         return not getattr(self, 'owner_id', None)
 
+    def __getstate__(self):
+        state = CoreRule.__getstate__(self)
+        tree = state.get('_tree')
+        if getattr(tree, 'frozen', False) and \
+                is_current(getattr(self, 'serialized_tree', None), self.tree):
+            # From the tree cache, which it loads from again without parsing.
+            del state['_tree']
+        return state
+
+    def _load_tree(self):
+        source, data = self.tree, getattr(self, 'serialized_tree', None)
+        if not data or not isinstance(source, six.string_types):
+            return self._build_tree(source)
+        from .trees import TreeCache
+
+        def build(string):
+            try:
+                return loads(data, string)
+            except ValueError:
+                # Stale, so parsed as usual.
+                return TreeCache.default.build(string)
+        return TreeCache.default.get(source, build)
+
     @property
     def conditions(self):
         if '_tree' not in self.__dict__:
-            self._tree = self._build_tree(self.tree)
+            self._tree = self._load_tree()
         return self._tree
 
     @conditions.setter
     def conditions(self, value):
         from .formatter import format_rule
         tree = self._build_tree(value)
-        self.tree = format_rule(tree)
+        if getattr(tree, 'unsatisfiable', False):
+            # There's nothing left to format, so it's kept as written, or
+            # stored as a contradiction which optimizes to the same.
+            if isinstance(value, six.string_types):
+                self.tree = value
+            else:
+                self.tree = CONTRADICTION
+        else:
+            self.tree = format_rule(tree)
         self._tree = tree
+        if not settings.RULES_SERIALIZED_TREES:
+            return
+        try:
+            self.serialized_tree = dumps(tree, self.tree)
+        except TypeError:
+            # Trees with custom parts are parsed from the string.
+            self.serialized_tree = None
 
     class Meta:
         abstract = True
 
 
+def _update_caches(rule, deleted):
+    for cls in (RuleCache, TopicalRuleCache):
+        # Looked up directly, as TopicalRuleCache would find RuleCache's.
+        cache = cls.__dict__.get('default')
+        if cache is not None:
+            cache.update_rule(rule, deleted)
+
+
+def _on_commit(rule, deleted, using):
+    # A copy, as it is now: deleting clears the pk, and the instance may
+    # change again before the transaction ends (or be rolled back with it).
+    rule = copy.copy(rule)
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is None:  # pragma: no cover
+        _update_caches(rule, deleted)
+    else:
+        on_commit(lambda: _update_caches(rule, deleted), using=using)
+
+
+def _rule_saved(sender, instance, using=None, **kwargs):
+    if isinstance(instance, BaseRule):
+        _on_commit(instance, False, using)
+
+
+def _rule_deleted(sender, instance, using=None, **kwargs):
+    if isinstance(instance, BaseRule):
+        _on_commit(instance, True, using)
+
+
+# Rules saved in bulk or with update() don't send these; see
+# RuleCache.invalidate.
+post_save.connect(_rule_saved, dispatch_uid='rules.models._rule_saved')
+post_delete.connect(_rule_deleted, dispatch_uid='rules.models._rule_deleted')
+
+
 def expand_model_key(key):
     '''key types
     * create.<app_label>.<model>:<signal>
@@ -130,6 +233,20 @@ if settings.RULES_CONCRETE_MODELS:
         def get_absolute_url(self):
             return reverse('admin:rule_reactor_rule_change', args=[self.pk])
 
+    class RuleGuard(models.Model):
+        """
+        A condition which must hold for a rule to match, for
+        :mod:`rules.percolator`: the deferred value at ``path`` must equal
+        ``value`` (encoded), or compare with ``number`` using ``operator``.
+        """
+        rule = models.ForeignKey(Rule, related_name='guards',
+                                 on_delete=models.CASCADE)
+        path = models.CharField(max_length=255, db_index=True)
+        operator = models.CharField(max_length=2)
+        value = models.CharField(max_length=255, blank=True, db_index=True)
+        number = models.FloatField(null=True, db_index=True)
+
     RuleCache.default = RuleCache(Rule.objects)
     TopicalRuleCache.default = TopicalRuleCache(RuleCache.default,
                                                 [expand_model_key])
+    Percolator.default = Percolator(Rule.objects.all(), [expand_model_key])
@@ -0,0 +1,167 @@
+"""
+A Rete-style alternative to :class:`~rules.cache.RuleList`.
+
+Rules under the same trigger are frequently built from the same fragments, so
+a :class:`RuleNetwork` merges equal conditions into shared alpha nodes, and
+equal subtrees (such as the common part of many near-duplicate rules) into
+shared nodes.  Each shared node is evaluated at most once per check, with its
+result kept in the check's ``info``, and reused by every rule containing it.
+To use it for a cache, set it as the cache's
+``List``::
+
+    class NetworkRuleCache(TopicalRuleCache):
+        List = RuleNetwork
+"""
+import copy
+import logging
+
+from .cache import RuleList, _rule_conditions
+from .core import ConditionNode, Condition, compile_tree
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['AlphaNode', 'RuleNetwork']
+
+
+class AlphaNode(object):
+    """A condition shared by any number of rules."""
+    __slots__ = ('condition', 'rules', '_compiled')
+
+    def __init__(self, condition):
+        self.condition = condition
+        self.rules = []
+        self._compiled = None
+
+    def __str__(self):
+        return str(self.condition)
+
+    def _evaluate(self, info):
+        try:
+            return info[self]
+        except KeyError:
+            result = info[self] = self.condition._evaluate(info)
+            return result
+
+    def _compile(self, table=None):
+        if self._compiled is not None and self._compiled[0] is table:
+            return self._compiled[1]
+        evaluate = compile_tree(self.condition, table)
+
+        def alpha(info):
+            try:
+                return info[self]
+            except KeyError:
+                result = info[self] = evaluate(info)
+                return result
+        self._compiled = table, alpha
+        return alpha
+
+
+class SharedNode(AlphaNode):
+    """
+    A whole subtree shared by several rules; ``condition`` is the subtree,
+    made of shared nodes itself.
+    """
+    __slots__ = ()
+
+
+def _hashable(obj):
+    try:
+        hash(obj)
+    except TypeError:
+        # Unhashable constants; such a condition just won't be shared.
+        return False
+    return True
+
+
+def _count(node, counts):
+    if isinstance(node, ConditionNode):
+        if _hashable(node):
+            counts[node] = counts.get(node, 0) + 1
+        for c in node.children:
+            _count(c, counts)
+
+
+def _beta(rule, evaluate):
+    def match(info):
+        try:
+            if evaluate(info):
+                return rule
+        except Exception:
+            logger.debug('Exception while evaluating rule conditions for {}'
+                         .format(rule), exc_info=True)
+        return False
+    return match
+
+
+class RuleNetwork(RuleList):
+    """
+    A :class:`~rules.cache.RuleList` which evaluates its rules through a
+    network of shared conditions.  Like a compiled rule, the network reflects
+    the conditions as they were when it was built.
+    """
+
+    def __new__(cls, iterable=None):
+        self = RuleList.__new__(cls, iterable)
+        self.alphas = {}
+        self.subtrees = {}
+        # Structurally equal subtrees found in more than one place.
+        counts = {}
+        for r in self:
+            _count(_rule_conditions(r), counts)
+        self._repeated = {n for n, count in counts.items() if count > 1}
+        self._matchers = [self._add(r) for r in self]
+        del self._repeated
+        return self
+
+    def _add(self, rule):
+        conditions = _rule_conditions(rule)
+        if not isinstance(conditions, (Condition, ConditionNode)):
+            return rule._match
+        try:
+            tree = self._share(conditions, rule)
+            return _beta(rule, compile_tree(tree))
+        except Exception:
+            logger.debug('Exception while adding rule {} to network'
+                         .format(rule), exc_info=True)
+            return rule._match
+
+    def _share(self, node, rule):
+        if isinstance(node, Condition):
+            if not _hashable(node):
+                return AlphaNode(node)
+            try:
+                alpha = self.alphas[node]
+            except KeyError:
+                alpha = self.alphas[node] = AlphaNode(node)
+            alpha.rules.append(rule)
+            return alpha
+        elif isinstance(node, ConditionNode):
+            if node in self._repeated:
+                try:
+                    shared = self.subtrees[node]
+                except KeyError:
+                    pass
+                else:
+                    shared.rules.append(rule)
+                    return shared
+            shared = copy.copy(node)
+            shared.children = [self._share(c, rule) for c in node.children]
+            if node in self._repeated:
+                shared = self.subtrees[node] = SharedNode(shared)
+                shared.rules.append(rule)
+            return shared
+        return node
+
+    @property
+    def shared(self):
+        """The alpha nodes used by more than one rule."""
+        return [a for a in self.alphas.values() if len(a.rules) > 1]
+
+    def _matches(self, info):
+        results = []
+        for match in self._matchers:
+            x = match(info)
+            if x:
+                results.append(x)
+        return results
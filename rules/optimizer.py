@@ -0,0 +1,186 @@
+"""
+Simplifies condition trees before they're used.
+
+:func:`optimize` rebuilds a tree bottom up, and along the way:
+
+* evaluates conditions with only constant operands, e.g. ``1 == 1`` or
+  ``len([1, 2]) > 1``, dropping them or deciding their node outright;
+* merges nested nodes with the same connector and removes single-child nodes;
+* removes duplicate children, so ``a AND a`` becomes ``a``;
+* applies absorption, so ``a AND (a OR b)`` becomes ``a`` and
+  ``a OR (a AND b)`` becomes ``a``;
+* detects contradictions such as ``x == 1 AND x == 2``, ``x == 1 AND
+  x in [2, 3]`` or ``a AND NOT a``.
+
+A tree which can never be true comes back as :class:`Unsatisfiable`, and
+rules with such trees are left out of any :class:`~rules.cache.RuleList`.
+Rules built from strings are optimized automatically.
+"""
+import logging
+
+from .core import AND, OR, ConditionNode, Condition
+from .deferred import Deferred, StillDeferred
+from .index import _hashable, _operands
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['Unsatisfiable', 'optimize']
+
+
+class Unsatisfiable(ConditionNode):
+    """An empty OR node, marking a tree which can never be true."""
+    unsatisfiable = True
+
+    def __init__(self, children=None, connector=None, negated=False):
+        ConditionNode.__init__(self, connector=OR)
+
+
+# Stand-ins for conditions which have been evaluated.
+_TRUE, _FALSE = object(), object()
+
+
+def _is_const(deferred):
+    if deferred is None:
+        return True
+    if not isinstance(deferred, Deferred):
+        return False
+    try:
+        deferred.maybe_const()
+    except StillDeferred:
+        return False
+    except Exception:
+        # Leave it to fail when evaluated, as it always has.
+        return False
+    return True
+
+
+def _fold(cond):
+    if _is_const(cond.left) and _is_const(cond.right):
+        result = cond._evaluate({'objects': (), 'extra': {}})
+        return _TRUE if result else _FALSE
+    return cond
+
+
+def _key(obj):
+    """Returns a hashable key for structurally equal children, or ``None``."""
+    if isinstance(obj, Condition):
+        key = (type(obj), obj.left, obj.operator, obj.right, obj.negated)
+    elif isinstance(obj, ConditionNode):
+        keys = [_key(c) for c in obj.children]
+        if None in keys:
+            return None
+        key = (type(obj), obj.connector, frozenset(keys))
+    else:
+        return None
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _contradicts(children):
+    """Whether a list of children can't all be true at once."""
+    keys = set(_key(c) for c in children)
+    allowed = {}
+    for c in children:
+        if not isinstance(c, Condition):
+            continue
+        key = _key(c)
+        if key is not None and key[:4] + (not key[4],) in keys:
+            return True
+        operands = _operands(c)
+        if operands is None:
+            continue
+        deferred, const, flipped = operands
+        if c.operator == '==':
+            values = (const,)
+        elif c.operator == 'in' and not flipped and \
+                isinstance(const, (list, tuple, set, frozenset)):
+            values = const
+        else:
+            continue
+        # This assumes values equal to a constant behave like it, which
+        # objects with strange __eq__ methods might not.
+        if not all(_hashable(v) for v in values):
+            continue
+        values = set(values)
+        try:
+            hash(deferred)
+        except TypeError:
+            continue
+        if deferred in allowed:
+            values &= allowed[deferred]
+            if not values:
+                return True
+        allowed[deferred] = values
+    return False
+
+
+def _optimize(node):
+    """Returns an optimized copy of ``node``, or ``_TRUE`` or ``_FALSE``."""
+    if isinstance(node, Condition):
+        return _fold(node)
+    elif type(node) is not ConditionNode:
+        # Nodes which might evaluate differently are left alone.
+        return node
+    conn = node.connector
+    # The value which decides the node, and the one which can be dropped.
+    decisive, neutral = (_FALSE, _TRUE) if conn == AND else (_TRUE, _FALSE)
+    children, keys = [], set()
+
+    def add(child):
+        key = _key(child)
+        if key is None or key not in keys:
+            keys.add(key)
+            children.append(child)
+
+    pending = list(node.children)
+    while pending:
+        child = _optimize(pending.pop(0))
+        if child is decisive:
+            return decisive
+        elif child is neutral:
+            continue
+        elif type(child) is ConditionNode and (child.connector == conn or
+                                               len(child.children) < 2):
+            pending[:0] = child.children
+        else:
+            add(child)
+    if conn == AND and _contradicts(children):
+        return _FALSE
+    # Absorption: an OR under an AND (or vice versa) sharing a child with its
+    # parent adds nothing.
+    keys.discard(None)
+    children = [c for c in children if not (
+        type(c) is ConditionNode and c.connector != conn and
+        any(_key(x) in keys for x in c.children))]
+    if not children:
+        return neutral
+    elif len(children) == 1 and type(children[0]) is ConditionNode:
+        return children[0]
+    return ConditionNode(children, conn)
+
+
+def optimize(tree):
+    """
+    Returns a simplified equivalent of ``tree``, which is left untouched.
+    Only plain :class:`~rules.core.ConditionNode` and
+    :class:`~rules.core.Condition` objects are simplified; anything else is
+    kept as it is.
+    """
+    if type(tree) is not ConditionNode:
+        return tree
+    try:
+        result = _optimize(tree)
+    except Exception:
+        logger.debug('Exception while optimizing rule {}'.format(tree),
+                     exc_info=True)
+        return tree
+    if result is _TRUE:
+        return ConditionNode()
+    elif result is _FALSE:
+        return Unsatisfiable()
+    elif not isinstance(result, ConditionNode):
+        return ConditionNode([result])
+    return result
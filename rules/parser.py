@@ -71,15 +71,21 @@ Other:
   * <simplelist> and <simpledict> are identical to <list> and <dict>, except
     that any occurrence of <value> should be swapped for <simplevalue>
 """
+import itertools
+import logging
 import re
 from collections import defaultdict
 from json.decoder import scanstring
 from madlibs.parser import Parser, subparser, parseloop, with_parsers
 from madlibs.json import parse_date, parse_time, parse_datetime
+from .conf import settings
 from .core import *
 from .deferred import *
 
-__all__ = ['RuleParser', 'parse_rule']
+logger = logging.getLogger(__name__)
+
+__all__ = ['RuleParser', 'DescentParser', 'parse_rule', 'parse_many',
+           'parse_executor']
 
 
 class _floatdict(defaultdict):
@@ -431,4 +437,371 @@ class RuleParser(Parser):
         while index < length and string[index].isspace():
             index += 1
         return tree, index
-parse_rule = RuleParser().parse
+
+
+# The single-pass parser.  Rather than trying each parser in turn at every
+# position, it matches one regex for whatever may start a value, and goes by
+# which alternative matched; the alternatives are in the order RuleParser
+# tries its parsers, so the two make the same trees.
+_SIMPLE, _TERM, _VALUE, _DEFERRED = range(4)
+
+_termmatch = re.compile(
+    r'(?P<object>object:\d+)|(?P<extra>extra)|(?P<const>const:)|'
+    r'(?P<model>model:)|\\(?P<ref>\d+)|'
+    r'(?P<function>(?:' + '|'.join(Function.FUNCS) + r')\()|'
+    r'(?P<dict>\{)|(?P<list>\[)|(?P<string>")|'
+    r'(?P<number>(?:-?[1-9][0-9]*|0)(?:\.[0-9]*)?(?:[eE][+-]?[0-9]+)?)|'
+    r'(?P<float>[-+]?[iI][nN][fF](?:[iI][nN][iI][tT][yY])?|[nN][aA][nN])|'
+    r'(?P<true>true)|(?P<false>false)|(?P<null>null)').match
+
+_SELECTORS = frozenset(('object', 'extra', 'const', 'model', 'ref'))
+_CONSTS = {'true': True, 'false': False, 'null': None}
+_DATES = (parse_datetime, parse_date, parse_time)
+
+
+class _Descent(object):
+    """The state of parsing one string with :class:`DescentParser`."""
+    __slots__ = ('string', 'length', 'deferred')
+
+    def __init__(self, string):
+        self.string = string
+        self.length = len(string)
+        self.deferred = []
+
+    def skip(self, index):
+        string, length = self.string, self.length
+        while index < length and string[index].isspace():
+            index += 1
+        return index
+
+    def value(self, index, mode):
+        """
+        Returns ``(value, index)``, with ``NotImplemented`` for text which
+        doesn't start a value of this kind:  simple values, terms of
+        conditions, values in a ``with`` list, or its deferred values.
+        """
+        string = self.string
+        m = _termmatch(string, index)
+        if m is None:
+            return NotImplemented, index
+        kind = m.lastgroup
+        if kind in _SELECTORS:
+            if mode == _SIMPLE:
+                return NotImplemented, index
+            return self.selector(m, mode)
+        elif kind == 'function':
+            if mode == _SIMPLE:
+                return NotImplemented, index
+            inner = _TERM if mode == _TERM else _VALUE
+            args, index = self.list(m.end(), inner)
+            return Function(m.group()[:-1], args), index
+        elif mode == _DEFERRED:
+            return NotImplemented, index
+        elif kind == 'dict':
+            inner = _VALUE if mode == _VALUE else _SIMPLE
+            return self.list(index + 1, inner, '}', pairs=True,
+                             cls=DeferredDict if mode == _VALUE else dict)
+        elif kind == 'list':
+            inner = _VALUE if mode == _VALUE else _SIMPLE
+            return self.list(index + 1, inner, ']',
+                             cls=DeferredTuple if mode == _VALUE else tuple)
+        elif kind == 'string':
+            return scanstring(string, index + 1)
+        elif kind == 'number':
+            if string[index].isdigit():
+                for parse in _DATES:
+                    try:
+                        result, end = parse(None, string, index)
+                    except IndexError:
+                        continue
+                    if result is not NotImplemented:
+                        return result, end
+            text = m.group()
+            if '.' in text or 'e' in text or 'E' in text:
+                return float(text), m.end()
+            return int(text), m.end()
+        elif kind == 'float':
+            return _FLOATS[m.group()], m.end()
+        return _CONSTS[kind], m.end()
+
+    def selector(self, m, mode):
+        kind, index = m.lastgroup, m.end()
+        if kind == 'object':
+            stype = int(m.group()[7:])
+        elif kind == 'extra':
+            stype = 'extra'
+        elif kind == 'ref':
+            try:
+                stype = self.deferred[int(m.group('ref'))]
+            except IndexError:
+                msg = '"{}" is a deferred value that has not yet been defined.'
+                raise ValueError(msg.format(m.group()))
+        elif kind == 'model':
+            model = _modelmatch(self.string, index)
+            if model is None:
+                msg = '"model" selector type must be followed by a model name.'
+                raise ValueError(msg)
+            index = model.end()
+            stype = ('model', model.group())
+        else:
+            value, index = self.value(index, _SIMPLE)
+            if value is NotImplemented:
+                raise _error(index, 'Invalid const selector at index {}')
+            return Selector(('const', value), None), index
+        chain, index = self.chain(index, _TERM if mode == _TERM else _VALUE)
+        if isinstance(stype, DeferredValue) and not chain:
+            return stype, index
+        return Selector(stype, chain), index
+
+    def chain(self, index, mode):
+        string, length = self.string, self.length
+        chain = []
+        m = _chainmatch(string, index)
+        while m:
+            attr, div = m.groups()
+            try:
+                attr = int(attr)
+            except ValueError:
+                pass
+            index = m.end()
+            if div:
+                val, index = self.value(index, mode)
+                if val is NotImplemented:
+                    raise _error(index)
+                chain.append(DeferredTuple((attr, val)))
+            else:
+                chain.append(attr)
+            if index < length and string[index] == ';':
+                index += 1
+            m = _chainmatch(string, index)
+        return chain, index
+
+    def pair(self, index, mode):
+        string = self.string
+        if index >= self.length or string[index] != '"':
+            return NotImplemented, index
+        key, index = scanstring(string, index + 1)
+        index = self.skip(index)
+        if index >= self.length or string[index] != ':':
+            return NotImplemented, index
+        val, index = self.value(self.skip(index + 1), mode)
+        if val is NotImplemented:
+            return NotImplemented, index
+        return (key, val), index
+
+    def list(self, index, mode, term=')', pairs=False, cls=None, obj=None,
+             expect=False):
+        """Parses a sequence the same way as ``_parse_list``."""
+        string, length = self.string, self.length
+        parse = self.pair if pairs else self.value
+        if obj is None:
+            obj = []
+        while index < length:
+            c = string[index]
+            if c.isspace():
+                index += 1
+                continue
+            if expect:
+                result, index = parse(index, mode)
+                if result is NotImplemented:
+                    raise _error(index)
+                expect = False
+                obj.append(result)
+            elif c == term:
+                if cls is not None:
+                    obj = cls(obj)
+                return obj, index + 1
+            elif not obj:
+                expect = True
+            elif c == ',':
+                expect = True
+                index += 1
+            else:
+                raise _error(index)
+        raise _error(index, 'Unfinished sequence, started at index {}')
+
+    def condition(self, index):
+        string = self.string
+        left, index = self.value(index, _TERM)
+        if left is NotImplemented:
+            return NotImplemented, index
+        elif not isinstance(left, DeferredValue):
+            left = Selector(('const', left), ())
+        m = _opmatch(string, index)
+        if m is None:
+            raise _error(index, 'Expected operator at index {}')
+        op, index = m.group(1), m.end()
+        if Condition.is_unary(op):
+            return Condition(left=left, operator=op), index
+        end = self.skip(index)
+        if end == index:
+            raise _error(index,
+                         'Binary operator must have whitespace at index {}')
+        right, index = self.value(end, _TERM)
+        if right is NotImplemented:
+            raise _error(index, 'Expected deferred value at index {}')
+        elif not isinstance(right, DeferredValue):
+            right = Selector(('const', right), ())
+        return Condition(left=left, operator=op, right=right), index
+
+    def tree(self, index):
+        """Parses a tree the same way as :func:`parse_tree`."""
+        string, length = self.string, self.length
+        node = ConditionNode()
+        conn = node.default
+        negate_next = False
+        expect = -1
+        while index < length:
+            if expect:
+                m = _expectmatch(string, index)
+                index = m.end()
+                sym = m.group(1)
+                if sym and sym[0] == 'N':
+                    negate_next = not negate_next
+                    continue
+                elif sym and sym[0] == '(':
+                    result, index = self.tree(index)
+                    index = self.skip(index)
+                    if index >= length or string[index] != ')':
+                        raise _error(index, 'Expected ")" at index {}')
+                    index += 1
+                else:
+                    result, index = self.condition(index)
+                if result is NotImplemented:
+                    if expect < 0:
+                        break
+                    raise _error(index, 'Expected condition or subtree at {}')
+                if negate_next:
+                    result.negate()
+                    negate_next = False
+                expect = 0
+                node.add(result, conn)
+            else:
+                m = _connmatch(string, index)
+                if m:
+                    index = m.end()
+                    conn = m.group(1)
+                    expect = 1
+                else:
+                    break
+        if expect > 0:
+            raise _error(index, 'Expected condition at index {}')
+        return node, index
+
+    def parse(self):
+        index = self.skip(0)
+        if self.string[index:index + 5] == 'with(':
+            index = self.list(index + 5, _DEFERRED, obj=self.deferred,
+                              expect=True)[1]
+        tree, index = self.tree(index)
+        tree.collapse()
+        index = self.skip(index)
+        if index != self.length:
+            raise ValueError('Could not parse string at index {}'
+                             .format(index))
+        return tree
+
+
+class DescentParser(object):
+    """
+    Parses rules in a single pass, making the same trees as
+    :class:`RuleParser`, only faster.
+    """
+
+    def parse(self, string):
+        return _Descent(string).parse()
+
+
+PARSERS = {
+    'madlibs': RuleParser().parse,
+    'descent': DescentParser().parse,
+}
+
+
+def parse_rule(string, parser=None):
+    """
+    Parses a rule string into a condition tree, with the parser named by
+    ``parser`` or the ``RULES_PARSER`` setting (see :data:`PARSERS`).
+    """
+    return PARSERS[parser or settings.RULES_PARSER](string)
+
+
+def _parse_chunk(args):
+    parse, overrides, strings = args
+    for name, value in overrides:
+        # As they are in the parent process, which may have changed them.
+        setattr(settings, name, value)
+    results = []
+    for string in strings:
+        try:
+            results.append(parse(string))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def parse_executor(workers=None):
+    """
+    Returns a pool of ``workers`` processes (by default, one per CPU) for
+    :func:`parse_many`, which set Django up for themselves rather than being
+    forked with this process's database connections, or ``None`` if this
+    Python can't make one.  It should be shut down once done with.
+    """
+    try:
+        import django
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(
+            workers, multiprocessing.get_context('spawn'), django.setup)
+    except (ImportError, AttributeError, TypeError):  # pragma: no cover
+        return None
+
+
+def parse_many(strings, workers=None, chunksize=200, parse=None,
+               return_exceptions=False, executor=None):
+    """
+    Parses many rule strings in a pool of ``workers`` processes (by default,
+    one per CPU), ``chunksize`` strings at a time, returning their trees in
+    order.  ``parse`` is the function to parse each string with (by default
+    :func:`parse_rule`), which must be picklable, like any module-level
+    function.  If a string doesn't parse, its exception is raised, or returned
+    in place of its tree with ``return_exceptions``.  To parse several
+    batches with the same workers, pass an ``executor`` from
+    :func:`parse_executor`, which is left running.
+
+    The workers get this process's ``RULES_*`` settings.  With one worker or
+    fewer, for small batches, or if the workers can't start (say, because
+    Django was set up with ``settings.configure()``), the strings are simply
+    parsed here.
+    """
+    strings = list(strings)
+    parse = parse or parse_rule
+    chunks = [strings[i:i + chunksize]
+              for i in range(0, len(strings), chunksize)]
+    parsed = None
+    own = executor is None
+    if len(chunks) > 1 and (not own or workers is None or workers > 1):
+        if own:
+            executor = parse_executor(workers)
+        if executor is not None:
+            overrides = tuple((name, getattr(settings, name))
+                              for name in dir(settings)
+                              if name.startswith('RULES_'))
+            try:
+                parsed = list(executor.map(
+                    _parse_chunk, [(parse, overrides, c) for c in chunks]))
+            except Exception:
+                logger.warning('Parsing in this process, as the workers'
+                               ' failed to start or run.')
+                logger.debug('Worker failure', exc_info=True)
+            finally:
+                if own:
+                    executor.shutdown()
+    if parsed is None:
+        parsed = [_parse_chunk((parse, (), c)) for c in chunks]
+    results = list(itertools.chain.from_iterable(parsed))
+    if not return_exceptions:
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+    return results
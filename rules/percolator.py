@@ -0,0 +1,229 @@
+"""
+Finds the rules an object might match with a single query.
+
+With very many rules in the database, even loading all the rules for a
+trigger is expensive.  With ``RULES_PERCOLATOR`` on, saving a rule also
+stores its guard (see :mod:`rules.index`) as :class:`~rules.models.RuleGuard`
+rows: the deferred value it tests, and either the constants it must equal or
+the bound of a numeric range.  :meth:`Percolator.candidates` then computes each
+guarded value for the objects being checked, and fetches only the rules whose
+guards hold (or which have none) in one query, to be checked as usual.
+
+Rules saved in other ways, like :meth:`~django.db.models.query.QuerySet.update`
+or ``bulk_create``, need :func:`rebuild_guards`.
+"""
+import datetime
+import logging
+
+import six
+from django.db.models import Q
+
+from .cache import RuleList, expand_key
+from .core import Condition, ConditionNode
+from .index import EqualityIndex, RangeIndex, guards, _NUMERIC, _ORDERED
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['Percolator', 'update_guards', 'rebuild_guards']
+
+# The longest path or value which fits in a RuleGuard.
+MAX_LENGTH = 255
+
+_RANGE_OPERATORS = ('<', '<=', '>', '>=')
+
+
+def _encode(value):
+    """
+    Returns text which is the same for equal constants, or ``None`` if there's
+    no such text for this value.
+    """
+    t = type(value)
+    if value is None:
+        key = 'none'
+    elif _ORDERED.get(t) == _NUMERIC:
+        if value != value or value in (float('inf'), float('-inf')):
+            return None
+        if value == int(value):
+            # 1, 1.0, True and Decimal(1) are all equal.
+            key = 'n:{:d}'.format(int(value))
+        else:
+            key = 'n:' + repr(float(value))
+    elif t in six.string_types or t is six.text_type:
+        key = 's:' + six.text_type(value)
+    elif t is datetime.datetime:
+        offset = value.utcoffset()
+        if offset is None:
+            key = 'dt:' + value.isoformat()
+        else:
+            # Aware datetimes are equal across time zones.
+            key = 'dtz:' + (value - offset).replace(tzinfo=None).isoformat()
+    elif t is datetime.date:
+        key = 'd:' + value.isoformat()
+    elif t is datetime.time and value.tzinfo is None:
+        key = 't:' + value.isoformat()
+    elif t is datetime.timedelta:
+        key = 'td:{0.days}:{0.seconds}:{0.microseconds}'.format(value)
+    else:
+        return None
+    return key if len(key) <= MAX_LENGTH else None
+
+
+def _number(value):
+    """
+    Returns a float for numeric values, ``None`` for values which can't be
+    compared with numbers, or ``NotImplemented`` if it's hard to say.
+    """
+    kind = _ORDERED.get(type(value))
+    if kind == _NUMERIC:
+        if value != value:
+            # NaN; every comparison is false.
+            return None
+        return float(value)
+    elif kind is not None or value is None:
+        return None
+    return NotImplemented
+
+
+def _path(deferred):
+    from .formatter import format_rule
+    return format_rule(ConditionNode([Condition(deferred, 'bool')]))
+
+
+def _deferred(path):
+    from .parser import parse_rule
+    return parse_rule(path).children[0].left
+
+
+def _guard_rows(rule):
+    """Returns ``[(path, operator, value, number)]`` for a rule's guard."""
+    for cond in guards(rule):
+        guard = EqualityIndex.guard(cond)
+        if guard is not None:
+            deferred, keys = guard
+            keys = [_encode(k) for k in keys]
+            if None in keys:
+                continue
+            path = _path(deferred)
+            if len(path) <= MAX_LENGTH:
+                return [(path, '==', k, None) for k in set(keys)]
+        guard = RangeIndex.guard(cond)
+        if guard is not None:
+            deferred, (op, const) = guard
+            if _ORDERED[type(const)] != _NUMERIC:
+                continue
+            path = _path(deferred)
+            if len(path) <= MAX_LENGTH:
+                return [(path, op, '', float(const))]
+    return []
+
+
+def update_guards(rule):
+    """Replaces the stored guard of a saved rule."""
+    from .models import RuleGuard
+    if not isinstance(rule, RuleGuard.rule.field.related_model):
+        return
+    try:
+        rows = _guard_rows(rule)
+    except Exception:
+        # Left unguarded, the rule is simply always a candidate.
+        logger.debug('Exception while finding guards for {}'.format(rule),
+                     exc_info=True)
+        rows = []
+    RuleGuard.objects.filter(rule=rule).delete()
+    RuleGuard.objects.bulk_create([
+        RuleGuard(rule=rule, path=path, operator=op, value=value,
+                  number=number)
+        for path, op, value, number in rows])
+    Percolator.clear_paths()
+
+
+def rebuild_guards(queryset=None):
+    """Updates the guards of every rule in ``queryset`` (or all of them)."""
+    from .models import Rule
+    if queryset is None:
+        queryset = Rule.objects.all()
+    for rule in queryset.iterator():
+        update_guards(rule)
+
+
+class Percolator(object):
+    """Fetches candidate rules for a trigger from the database."""
+    # Paths of the guards for each set of trigger keys, which are all that's
+    # needed to query for candidates; guards on paths which aren't known yet
+    # (saved by other processes, say) always make their rules candidates.
+    _paths = {}
+
+    def __init__(self, queryset=None, expanders=None):
+        if queryset is None:
+            from .models import Rule
+            queryset = Rule.objects.all()
+        self.queryset = queryset
+        self.expanders = expanders or []
+
+    @classmethod
+    def clear_paths(cls):
+        cls._paths.clear()
+
+    def _expandkey(self, key):
+        for func in self.expanders:
+            keys = func(key)
+            if keys is not NotImplemented:
+                return keys
+        return expand_key(key)
+
+    def paths(self, keys):
+        """Returns ``[(path, deferred)]`` for the guards of these keys."""
+        keys = tuple(sorted(keys))
+        try:
+            return self._paths[keys]
+        except KeyError:
+            pass
+        from .models import RuleGuard
+        paths = RuleGuard.objects.filter(rule__trigger__in=keys) \
+            .values_list('path', flat=True).distinct()
+        result = self._paths[keys] = [(p, _deferred(p)) for p in set(paths)]
+        return result
+
+    def _guards(self, paths, info):
+        """Returns a Q for the guards which hold."""
+        q = ~Q(path__in=[path for path, deferred in paths])
+        for path, deferred in paths:
+            try:
+                value = deferred.get_value(info)
+            except Exception:
+                # Guards are never true for values which fail.
+                continue
+            key = _encode(value)
+            if key is not None:
+                q |= Q(path=path, operator='==', value=key)
+            else:
+                # Whether it equals any constant is anyone's guess.
+                q |= Q(path=path, operator='==')
+            number = _number(value)
+            if number is NotImplemented:
+                q |= Q(path=path, operator__in=_RANGE_OPERATORS)
+            elif number is not None:
+                # Inclusive either way, in case of rounding.
+                q |= Q(path=path, operator__in=('<', '<='),
+                       number__gte=number)
+                q |= Q(path=path, operator__in=('>', '>='),
+                       number__lte=number)
+        return q
+
+    def candidates(self, trigger, *objects, **extra):
+        """
+        Returns a queryset of the rules for ``trigger`` which might match the
+        given objects.
+        """
+        from .models import RuleGuard
+        keys = self._expandkey(trigger)
+        info = {'objects': objects, 'extra': extra}
+        guards = RuleGuard.objects.filter(self._guards(self.paths(keys), info))
+        return self.queryset.filter(trigger__in=keys).filter(
+            ~Q(pk__in=RuleGuard.objects.values('rule')) |
+            Q(pk__in=guards.values('rule')))
+
+    def matches(self, trigger, *objects, **extra):
+        """Returns the rules for ``trigger`` which match the objects."""
+        rules = RuleList(self.candidates(trigger, *objects, **extra))
+        return rules._matches({'objects': objects, 'extra': extra})
@@ -0,0 +1,156 @@
+"""
+Plans which related objects to load before checking rules.
+
+Each hop of a selector like ``object:0.customer.account.tier`` can be a
+query of its own when followed lazily.  A :class:`PrefetchPlanner` looks at
+the selectors of all the rules in a list (see :func:`rules.batch.lookups`)
+and, for each type of model instance they're checked against, resolves them
+against the model's ``_meta`` into a :class:`Plan`: chains of to-one relations
+for ``select_related``, and anything through to-many relations for
+``prefetch_related``.  Plans can be applied to querysets before the objects
+are loaded, or to objects already loaded, one at a time or in bulk.
+
+Planners are cached per trigger by :meth:`rules.cache.RuleCache.planner`, and
+replaced along with the rules they were made for.
+"""
+import logging
+from collections import defaultdict
+
+import six
+from django.db import models
+
+try:
+    from django.db.models import prefetch_related_objects
+except ImportError:  # pragma: no cover
+    from django.db.models.query import prefetch_related_objects as _prefetch
+
+    def prefetch_related_objects(instances, *related_lookups):
+        _prefetch(instances, list(related_lookups))
+
+from .batch import lookups
+from .sql import _field
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['Plan', 'PrefetchPlanner']
+
+
+def _outermost(paths):
+    """Drops paths which other paths extend."""
+    paths = set(paths)
+    return tuple(sorted(p for p in paths if not any(
+        other.startswith(p + '__') for other in paths)))
+
+
+class Plan(object):
+    """The related objects to load for instances of a model."""
+
+    def __init__(self, model, select_related=(), prefetch_related=(),
+                 attributes=None):
+        self.model = model
+        self.select_related = _outermost(select_related)
+        self.prefetch_related = _outermost(prefetch_related)
+        # The same relations by attribute name, which can differ from the
+        # query names select_related wants for reverse relations.
+        self.attributes = _outermost(attributes if attributes is not None
+                                     else select_related + prefetch_related)
+
+    def __bool__(self):
+        return bool(self.select_related or self.prefetch_related)
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return '<Plan for {}: select_related={!r}, prefetch_related={!r}>' \
+            .format(self.model.__name__, self.select_related,
+                    self.prefetch_related)
+
+    def queryset(self, queryset):
+        """Returns ``queryset`` loading the related objects with it."""
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if self.prefetch_related:
+            queryset = queryset.prefetch_related(*self.prefetch_related)
+        return queryset
+
+    def prefetch(self, instances):
+        """Loads the related objects for instances already loaded."""
+        if instances and self.attributes:
+            prefetch_related_objects(list(instances), *self.attributes)
+
+
+def _resolve(model, path):
+    """
+    Returns ``(query lookup, attribute lookup, to-many)`` for the relations
+    at the start of a path of attribute names, or ``None`` if it doesn't start
+    with one.
+    """
+    query_names, names, many = [], [], False
+    for name in path.split('__'):
+        if model is None:
+            break
+        found = _field(model, name)
+        if found is None:
+            break
+        field, query_name, model = found
+        if not field.is_relation or model is None:
+            break
+        query_names.append(query_name)
+        names.append(name)
+        many = many or field.many_to_many or field.one_to_many
+    if not names:
+        return None
+    return '__'.join(query_names), '__'.join(names), many
+
+
+class PrefetchPlanner(object):
+    """Makes and caches :class:`Plan` objects for the rules in a list."""
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.lookups = lookups(rules)
+        self.plans = {}
+
+    def plan(self, model, index=0):
+        """Returns the plan for instances of ``model`` as ``object:index``."""
+        key = index, model
+        try:
+            return self.plans[key]
+        except KeyError:
+            pass
+        selected, prefetched, attributes = [], [], []
+        for path in self.lookups.get(index, ()):
+            resolved = _resolve(model, path)
+            if resolved is not None:
+                query_lookup, lookup, many = resolved
+                if many:
+                    prefetched.append(lookup)
+                else:
+                    selected.append(query_lookup)
+                attributes.append(lookup)
+        plan = self.plans[key] = Plan(model, selected, prefetched, attributes)
+        return plan
+
+    def queryset(self, queryset, index=0):
+        """Applies the plan for the queryset's model to it."""
+        return self.plan(queryset.model, index).queryset(queryset)
+
+    def prefetch(self, items):
+        """
+        Loads related objects for a batch of object tuples, with one query
+        per relation for each type of model instance.
+        """
+        for index in self.lookups:
+            by_model = defaultdict(list)
+            for objects in items:
+                try:
+                    obj = objects[index]
+                except IndexError:
+                    continue
+                if isinstance(obj, models.Model):
+                    by_model[type(obj)].append(obj)
+            for model, instances in six.iteritems(by_model):
+                try:
+                    self.plan(model, index).prefetch(instances)
+                except Exception:
+                    logger.debug('Exception while prefetching for {}'
+                                 .format(model), exc_info=True)
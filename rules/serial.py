@@ -0,0 +1,306 @@
+"""
+A compact binary form of condition trees, which loads without parsing.
+
+Parsing is most of the cost of loading rules.  :func:`dumps` encodes a tree
+of :class:`~rules.core.ConditionNode`, :class:`~rules.core.Condition`,
+:class:`~rules.deferred.Selector`, :class:`~rules.deferred.Function` and the
+deferred containers with :mod:`marshal`, and :func:`loads` rebuilds it.  Like
+:mod:`rules.formatter`, deferred values are numbered, so those shared within a
+tree are still shared when it's loaded.
+
+The data starts with the format's :data:`VERSION` and a checksum of the tree
+string it was made from; :func:`loads` raises ``ValueError`` for data of
+another version or another string, so callers can parse the string instead.
+
+:func:`dump_rules` encodes whole rules the same way, with one table of
+deferred values for all of them, for snapshots a process can start from
+without touching the database or parser; :func:`load_rules` reads them back.
+"""
+import datetime
+import decimal
+import marshal
+import struct
+import zlib
+
+import six
+
+from .core import Condition, ConditionNode
+from .deferred import (Deferred, DeferredDict, DeferredTuple, Function,
+                       Selector)
+from .optimizer import Unsatisfiable
+
+__all__ = ['VERSION', 'dumps', 'loads', 'is_current', 'dump_rules',
+           'load_rules']
+
+# Bump whenever the encoding changes; data of other versions is ignored.
+VERSION = 1
+
+_MAGIC = b'RT'
+_HEADER = struct.Struct('>BI')
+_RULES_MAGIC = b'RS'
+_RULES_HEADER = struct.Struct('>B')
+# Readable by every Python version since 2.5.
+_MARSHAL_VERSION = 2
+
+_SCALARS = six.string_types + six.integer_types + (
+    six.text_type, six.binary_type, float, bool, type(None))
+
+
+def _checksum(source):
+    if isinstance(source, six.text_type):
+        source = source.encode('utf-8')
+    return zlib.crc32(source) & 0xffffffff
+
+
+def _bytes(data):
+    return memoryview(data).tobytes()
+
+
+class _Encoder(object):
+    def __init__(self):
+        self.deferred = []
+        self.indexes = {}
+
+    def value(self, obj):
+        """Encodes values as themselves, or as tuples starting with a tag."""
+        t = type(obj)
+        if t in _SCALARS:
+            return obj
+        elif isinstance(obj, Deferred) and t not in (DeferredTuple,
+                                                     DeferredDict):
+            return 'r', self.ref(obj)
+        elif t is DeferredTuple:
+            return 'T', tuple(self.value(v) for v in obj)
+        elif t is DeferredDict:
+            return 'D', tuple((k, self.value(v))
+                               for k, v in six.iteritems(obj))
+        elif t is tuple:
+            return 't', tuple(self.value(v) for v in obj)
+        elif t is list:
+            # Never in trees, but common in rule values.
+            return 'l', tuple(self.value(v) for v in obj)
+        elif t is dict:
+            return 'd', tuple((k, self.value(v))
+                               for k, v in six.iteritems(obj))
+        elif t is datetime.datetime and obj.tzinfo is None:
+            return 'dt', obj.timetuple()[:6] + (obj.microsecond,)
+        elif t is datetime.date:
+            return 'da', obj.timetuple()[:3]
+        elif t is datetime.time and obj.tzinfo is None:
+            return 'ti', (obj.hour, obj.minute, obj.second, obj.microsecond)
+        elif t is decimal.Decimal:
+            return 'de', str(obj)
+        raise TypeError('Can\'t serialize {!r}'.format(obj))
+
+    def ref(self, obj):
+        """Returns the index of a deferred value in the table."""
+        try:
+            return self.indexes[id(obj)][0]
+        except KeyError:
+            pass
+        t = type(obj)
+        if t is Selector:
+            encoded = ('s', self.value(obj.stype), self.value(obj.arg),
+                       self.value(obj.chain))
+        elif t is Function:
+            encoded = ('f', obj.name, self.value(obj.args))
+        else:
+            raise TypeError('Can\'t serialize {!r}'.format(obj))
+        # Anything it depends on is numbered first.
+        index = len(self.deferred)
+        self.deferred.append(encoded)
+        # Kept with the index so the id isn't reused.
+        self.indexes[id(obj)] = index, obj
+        return index
+
+    def node(self, node):
+        t = type(node)
+        if t is Unsatisfiable:
+            return 'u',
+        elif t is ConditionNode:
+            return ('n', node.connector, bool(node.negated),
+                    tuple(self.node(c) for c in node.children))
+        elif t is Condition:
+            return ('c', self.value(node.left), node.operator,
+                    self.value(node.right), node.negated)
+        raise TypeError('Can\'t serialize {!r}'.format(node))
+
+
+def dumps(tree, source):
+    """
+    Returns bytes for ``tree``, parsed from the string ``source``; raises
+    ``TypeError`` for trees with parts it can't encode.
+    """
+    encoder = _Encoder()
+    body = encoder.node(tree)
+    try:
+        body = marshal.dumps((tuple(encoder.deferred), body),
+                             _MARSHAL_VERSION)
+    except ValueError as e:
+        # Unmarshallable dictionary keys and the like.
+        raise TypeError('Can\'t serialize {!r}: {}'.format(tree, e))
+    return _MAGIC + _HEADER.pack(VERSION, _checksum(source)) + body
+
+
+def is_current(data, source):
+    """Whether ``data`` is of this version and made from ``source``."""
+    if not data:
+        return False
+    header = _bytes(data)[:len(_MAGIC) + _HEADER.size]
+    if len(header) < len(_MAGIC) + _HEADER.size or \
+            header[:len(_MAGIC)] != _MAGIC:
+        return False
+    version, checksum = _HEADER.unpack(header[len(_MAGIC):])
+    return version == VERSION and checksum == _checksum(source)
+
+
+_TYPES = {
+    'dt': lambda v: datetime.datetime(*v),
+    'da': lambda v: datetime.date(*v),
+    'ti': lambda v: datetime.time(*v),
+    'de': decimal.Decimal,
+}
+
+
+class _Decoder(object):
+    def __init__(self, deferred):
+        self.deferred = []
+        for encoded in deferred:
+            self.deferred.append(self.make(encoded))
+
+    def make(self, encoded):
+        if encoded[0] == 's':
+            tag, stype, arg, chain = encoded
+            return Selector((self.value(stype), self.value(arg)),
+                            self.value(chain))
+        tag, name, args = encoded
+        return Function(name, self.value(args))
+
+    def value(self, obj):
+        if type(obj) is not tuple:
+            return obj
+        tag, v = obj
+        if tag == 'r':
+            return self.deferred[v]
+        elif tag == 'T':
+            return DeferredTuple(self.value(x) for x in v)
+        elif tag == 'D':
+            return DeferredDict((k, self.value(x)) for k, x in v)
+        elif tag == 't':
+            return tuple(self.value(x) for x in v)
+        elif tag == 'l':
+            return [self.value(x) for x in v]
+        elif tag == 'd':
+            return dict((k, self.value(x)) for k, x in v)
+        return _TYPES[tag](v)
+
+    def node(self, encoded):
+        tag = encoded[0]
+        if tag == 'u':
+            return Unsatisfiable()
+        elif tag == 'n':
+            tag, connector, negated, children = encoded
+            return ConditionNode([self.node(c) for c in children], connector,
+                                 negated)
+        tag, left, operator, right, negated = encoded
+        return Condition(self.value(left), operator, self.value(right),
+                         negated)
+
+
+def loads(data, source):
+    """
+    Returns the tree from data made by :func:`dumps`, raising ``ValueError``
+    if it's not :func:`current <is_current>` or can't be read.
+    """
+    if not is_current(data, source):
+        raise ValueError('Serialized tree is stale.')
+    data = _bytes(data)
+    try:
+        deferred, body = marshal.loads(data[len(_MAGIC) + _HEADER.size:])
+        return _Decoder(deferred).node(body)
+    except (EOFError, IndexError, KeyError, TypeError, ValueError) as e:
+        raise ValueError('Can\'t load serialized tree: {}'.format(e))
+
+
+def _encode_rule(encoder, rule):
+    from django.db import models
+    from .core import Rule
+    if isinstance(rule, models.Model):
+        opts = rule._meta
+        fields = []
+        for field in opts.concrete_fields:
+            value = getattr(rule, field.attname)
+            if isinstance(value, memoryview):
+                value = _bytes(value)
+            fields.append((field.attname, encoder.value(value)))
+        try:
+            node = encoder.node(rule.conditions)
+        except TypeError:
+            # Parsed from its string when loaded.
+            node = None
+        return ('m', opts.app_label, opts.object_name, tuple(fields), node)
+    elif type(rule) is Rule:
+        return ('r', encoder.value(rule.trigger),
+                encoder.value(rule.continuation), encoder.value(rule.value),
+                encoder.value(getattr(rule, 'weight', None)),
+                encoder.node(rule.conditions))
+    raise TypeError('Can\'t serialize {!r}'.format(rule))
+
+
+def dump_rules(rules):
+    """
+    Returns bytes for a sequence of core rules and rule model instances;
+    raises ``TypeError`` for rules or values it can't encode.  Model rules
+    with trees it can't encode keep only the string.
+    """
+    encoder = _Encoder()
+    body = tuple(_encode_rule(encoder, r) for r in rules)
+    try:
+        body = marshal.dumps((tuple(encoder.deferred), body),
+                             _MARSHAL_VERSION)
+    except ValueError as e:
+        raise TypeError('Can\'t serialize rules: {}'.format(e))
+    return _RULES_MAGIC + _RULES_HEADER.pack(VERSION) + body
+
+
+def _decode_rule(decoder, encoded):
+    from .core import Rule
+    from .trees import TreeCache
+    if encoded[0] == 'r':
+        tag, trigger, continuation, value, weight, node = encoded
+        kwargs = {'value': decoder.value(value),
+                  'continuation': decoder.value(continuation),
+                  'conditions': decoder.node(node)}
+        weight = decoder.value(weight)
+        if weight is not None:
+            kwargs['weight'] = weight
+        return Rule(decoder.value(trigger), **kwargs)
+    from django.apps import apps
+    tag, app_label, name, fields, node = encoded
+    rule = apps.get_model(app_label, name)(
+        **dict((k, decoder.value(v)) for k, v in fields))
+    rule._state.adding = False
+    if node is not None:
+        # Shared with any other rule with the same string, as when fetched.
+        tree = decoder.node(node)
+        rule._tree = TreeCache.default.get(rule.tree, lambda s: tree)
+    return rule
+
+
+def load_rules(data):
+    """
+    Returns the rules from data made by :func:`dump_rules`, raising
+    ``ValueError`` if it's of another version or can't be read.
+    """
+    data = _bytes(data)
+    size = len(_RULES_MAGIC) + _RULES_HEADER.size
+    if data[:len(_RULES_MAGIC)] != _RULES_MAGIC or len(data) < size or \
+            _RULES_HEADER.unpack(data[len(_RULES_MAGIC):size])[0] != VERSION:
+        raise ValueError('Rule snapshot is stale.')
+    try:
+        deferred, body = marshal.loads(data[size:])
+        decoder = _Decoder(deferred)
+        return [_decode_rule(decoder, r) for r in body]
+    except (EOFError, IndexError, KeyError, LookupError, TypeError,
+            ValueError) as e:
+        raise ValueError('Can\'t load rule snapshot: {}'.format(e))
@@ -0,0 +1,328 @@
+"""
+Pushes rule conditions down into SQL.
+
+Finding the rows of a table which match a rule would otherwise mean loading
+every instance and calling :meth:`~rules.core.Rule.match` on each.
+:func:`translate` turns as much of a condition tree as it can into a
+:class:`~django.db.models.Q` object, for conditions comparing an
+``object:0.<field>`` path (which may follow relations) with a constant or an
+``extra`` value, using the ``exact``, ``lt``/``lte``/``gt``/``gte``, ``in``
+and ``isnull`` lookups.  ``bool`` and ``exists`` work on fields and to-one
+relations, and on to-many relations as ``object:0.<relation>.all``.
+Databases have regex dialects of their own, so ``like`` and ``re`` only narrow
+the rows down to those starting with the pattern's literal prefix.
+
+Whatever can't be translated is returned as a residual tree, which
+:func:`filter_queryset` checks in Python, but only for the rows which the
+translated part has already narrowed down to.  Constants need to have the
+Python type of their field, so the database compares them the way Python
+would; string comparisons assume the database collation is case-sensitive.
+"""
+import datetime
+import decimal
+import logging
+import operator
+from functools import reduce
+
+import six
+from django.db.models import Q
+
+from .core import AND, Condition, ConditionNode
+from .deferred import Deferred, Selector
+from .index import _const, _literal_prefix
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['translate', 'filter_queryset']
+
+_STRINGS = six.string_types + (six.text_type,)
+_INTEGERS = six.integer_types
+
+# The Python types of constants which compare the same way in the database as
+# with the field's values in Python, by internal type.
+FIELD_TYPES = {
+    'CharField': _STRINGS,
+    'TextField': _STRINGS,
+    'SlugField': _STRINGS,
+    'EmailField': _STRINGS,
+    'URLField': _STRINGS,
+    'AutoField': _INTEGERS,
+    'BigAutoField': _INTEGERS,
+    'IntegerField': _INTEGERS,
+    'BigIntegerField': _INTEGERS,
+    'SmallIntegerField': _INTEGERS,
+    'PositiveIntegerField': _INTEGERS,
+    'PositiveSmallIntegerField': _INTEGERS,
+    'FloatField': _INTEGERS + (float,),
+    'DecimalField': _INTEGERS + (decimal.Decimal,),
+    'BooleanField': (bool,),
+    'NullBooleanField': (bool,),
+    'DateField': (datetime.date,),
+    'DateTimeField': (datetime.datetime,),
+    'TimeField': (datetime.time,),
+    'DurationField': (datetime.timedelta,),
+}
+
+# How values of each kind of field are false, besides being null.
+_FALSE_VALUES = dict(
+    [(t, '') for t in ('CharField', 'TextField', 'SlugField', 'EmailField',
+                       'URLField')] +
+    [(t, 0) for t in ('AutoField', 'BigAutoField', 'IntegerField',
+                      'BigIntegerField', 'SmallIntegerField',
+                      'PositiveIntegerField', 'PositiveSmallIntegerField',
+                      'FloatField', 'DecimalField')] +
+    [(t, False) for t in ('BooleanField', 'NullBooleanField')] +
+    [('DurationField', datetime.timedelta(0))] +
+    [(t, None) for t in ('DateField', 'DateTimeField', 'TimeField')]
+)
+
+_LOOKUPS = {'==': 'exact', '<': 'lt', '<=': 'lte', '>': 'gt', '>=': 'gte'}
+_FLIPPED = {'==': '==', '!=': '!=', '<': '>', '<=': '>=', '>': '<',
+            '>=': '<='}
+# Operators which fail (so are false, even negated) on nulls in Python.
+_NULL_FAILS = {'<', '<=', '>', '>=', 'like', 're'}
+
+
+def _unbound(cls, name):
+    return six.get_unbound_function(getattr(cls, name))
+
+
+def _field(model, name):
+    """
+    Returns ``(field, query name, next model)`` for an attribute of a model
+    instance, or ``None``.
+    """
+    for f in model._meta.get_fields():
+        if f.auto_created and not f.concrete:
+            # Reverse relations are accessed by a different name.
+            try:
+                if f.get_accessor_name() == name:
+                    return f, f.name, f.related_model
+            except AttributeError:  # pragma: no cover
+                pass
+        elif f.name == name:
+            return f, f.name, f.related_model if f.is_relation else None
+        elif f.is_relation and f.concrete and \
+                getattr(f, 'attname', None) == name:
+            return f.target_field, name, None
+    return None
+
+
+class _Translator(object):
+    def __init__(self, model, extra):
+        self.model = model
+        self.extra = extra
+        # Whether any lookups span to-many relations, and so need a subquery
+        # to avoid duplicate rows.
+        self.many = False
+
+    def path(self, selector):
+        """
+        Returns ``(lookup, field, relation prefix, to-many)`` for an
+        ``object:0`` selector with a chain of field names, else ``None``.
+        """
+        if not isinstance(selector, Selector) or \
+                isinstance(selector.stype, bool) or selector.stype != 0:
+            return None
+        chain = selector.chain
+        if not isinstance(chain, tuple) or not chain or any(
+                isinstance(link, (Deferred, tuple)) or
+                not isinstance(link, six.string_types) for link in chain):
+            return None
+        model, names, field = self.model, [], None
+        for i, name in enumerate(chain):
+            if model is None:
+                return None
+            found = _field(model, name)
+            if found is None:
+                return None
+            field, query_name, model = found
+            names.append(query_name)
+            if field.is_relation and model is None:
+                # Generic relations and the like.
+                return None
+            if field.is_relation and (field.many_to_many or
+                                      field.one_to_many):
+                # The manager itself is useless; only .all makes sense.
+                if chain[i + 1:] != ('all',):
+                    return None
+                return '__'.join(names), field, '__'.join(names[:-1]), True
+        return '__'.join(names), field, '__'.join(names[:-1]), False
+
+    def value(self, deferred):
+        """Returns ``(True, value)`` for constants and ``extra`` values."""
+        const, value = _const(deferred)
+        if const or not isinstance(deferred, Selector) or \
+                deferred.stype != 'extra':
+            return const, value
+        try:
+            return True, deferred.get_value({'objects': (),
+                                             'extra': self.extra})
+        except Exception:
+            return False, None
+
+    def truthy(self, lookup, field):
+        if field.is_relation:
+            return Q(**{lookup + '__isnull': False})
+        kind = field.get_internal_type()
+        if kind not in _FALSE_VALUES:
+            return None
+        q = Q(**{lookup + '__isnull': False})
+        false = _FALSE_VALUES[kind]
+        if false is not None:
+            q &= ~Q(**{lookup: false})
+        return q
+
+    def condition(self, cond):
+        """Returns ``(q, exact)``, with ``q`` as ``None`` if untranslatable."""
+        if _unbound(type(cond), '_evaluate') is not \
+                _unbound(Condition, '_evaluate') or \
+                cond._eval is not Condition.OPERATOR_MAP.get(cond.operator):
+            return None, False
+        op, left, right = cond.operator, cond.left, cond.right
+        if cond.is_unary:
+            path = self.path(left)
+            if path is None:
+                return None, False
+            lookup, field, prefix, many = path
+            q = self.truthy(lookup, field)
+            if q is None:
+                return None, False
+            self.many |= many
+            return (~q if cond.negated else q), True
+        path, flipped = self.path(left), False
+        const, value = self.value(right)
+        if path is None or not const:
+            path, flipped = self.path(right), True
+            const, value = self.value(left)
+            if path is None or not const:
+                return None, False
+        lookup, field, prefix, many = path
+        if many or field.is_relation:
+            return None, False
+        types = FIELD_TYPES.get(field.get_internal_type())
+        if types is None:
+            return None, False
+        exact = True
+        if op == 'in' and flipped:
+            # Substring tests; LIKE may ignore case, so this only narrows.
+            if not isinstance(value, _STRINGS) or types is not _STRINGS or \
+                    cond.negated:
+                return None, False
+            q, exact = Q(**{lookup + '__contains': value}), False
+        elif op == 'in':
+            if not isinstance(value, (list, tuple, set, frozenset)) or \
+                    not all(type(v) in types for v in value):
+                return None, False
+            q = Q(**{lookup + '__in': list(value)})
+        elif op in ('like', 're'):
+            if flipped or types is not _STRINGS or cond.negated or \
+                    type(getattr(value, 'pattern', None)) not in _STRINGS:
+                return None, False
+            # Any match starts with the prefix, but the rest of the pattern
+            # can only be checked in Python.
+            literal = _literal_prefix(value)
+            if not literal:
+                return None, False
+            q, exact = Q(**{lookup + '__startswith': literal}), False
+        elif op in _FLIPPED:
+            if flipped:
+                op = _FLIPPED[op]
+            if value is None and op in ('==', '!='):
+                q = Q(**{lookup + '__isnull': op == '=='})
+            elif type(value) not in types:
+                return None, False
+            elif op == '!=':
+                q = ~Q(**{lookup: value})
+            else:
+                q = Q(**{lookup + '__' + _LOOKUPS[op]: value})
+        else:
+            return None, False
+        if cond.negated:
+            q = ~q
+        if cond.negated or op == '!=':
+            # Negating in SQL lets nulls through, where Python would fail.
+            if op in _NULL_FAILS:
+                q &= Q(**{lookup + '__isnull': False})
+            elif prefix:
+                q &= Q(**{prefix + '__isnull': False})
+        return q, exact
+
+    def translate(self, node):
+        """
+        Returns ``(q, residual)``; ``q`` is ``None`` if nothing narrows the
+        rows down, and ``residual`` is ``None`` if ``q`` is exact.
+        """
+        if isinstance(node, Condition):
+            if self.value(node.left)[0] and (node.right is None or
+                                             self.value(node.right)[0]):
+                info = {'objects': (), 'extra': self.extra}
+                if node._evaluate(info):
+                    return None, None
+                return Q(pk__in=[]), None
+            q, exact = self.condition(node)
+            return q, (None if exact else node)
+        elif not isinstance(node, ConditionNode) or \
+                getattr(node, 'negated', False) or \
+                _unbound(type(node), '_evaluate') is not \
+                _unbound(ConditionNode, '_evaluate'):
+            return None, node
+        results = [self.translate(c) for c in node.children]
+        if node.connector == AND:
+            qs = [q for q, residual in results if q is not None]
+            residuals = [r for q, r in results if r is not None]
+            q = reduce(operator.and_, qs) if qs else None
+            if not residuals:
+                return q, None
+            elif len(residuals) == 1:
+                return q, residuals[0]
+            return q, ConditionNode(residuals, AND)
+        if not results:
+            # Never true.
+            return Q(pk__in=[]), None
+        for q, residual in results:
+            if q is None:
+                # Either always true, or can't be narrowed down.
+                return None, (None if residual is None else node)
+        q = reduce(operator.or_, [q for q, residual in results])
+        if any(residual is not None for q, residual in results):
+            return q, node
+        return q, None
+
+
+def translate(tree, model, **extra):
+    """
+    Translates a condition tree into a :class:`~django.db.models.Q` object for
+    rows of ``model`` as ``object:0``, returning ``(q, residual)``.  Rows not
+    matching ``q`` can't match the tree, and those which do only need
+    ``residual`` checking; either may be ``None``.
+    """
+    translator = _Translator(model, extra)
+    try:
+        q, residual = translator.translate(tree)
+    except Exception:
+        logger.debug('Exception while translating rule {}'.format(tree),
+                     exc_info=True)
+        return None, tree
+    if q is not None and translator.many:
+        q = Q(pk__in=model._default_manager.filter(q).values('pk'))
+    return q, residual
+
+
+def filter_queryset(queryset, tree, **extra):
+    """
+    Returns the rows of ``queryset`` which match ``tree`` as ``object:0``.
+    """
+    q, residual = translate(tree, queryset.model, **extra)
+    narrowed = queryset if q is None else queryset.filter(q)
+    if residual is None:
+        return narrowed
+    pks = []
+    for obj in narrowed.iterator():
+        try:
+            if residual._evaluate({'objects': (obj,), 'extra': extra}):
+                pks.append(obj.pk)
+        except Exception:
+            logger.debug('Exception while evaluating {}'.format(residual),
+                         exc_info=True)
+    return queryset.filter(pk__in=pks)
@@ -0,0 +1,179 @@
+import pickle
+import threading
+
+from django.test import TestCase
+
+from rules.adaptive import AdaptiveConditionNode, adaptive, static_cost
+from rules.core import AND, OR, ConditionNode, Condition, Rule, compile_tree
+from rules.deferred import Selector
+from rules.frame import SlotTable
+from rules.parser import parse_rule
+from . import Dummy
+from .test_compile import RULES, _objects
+
+
+def C(value):
+    return Condition(Selector(('const', value), ()), 'bool')
+
+
+class Slow(Condition):
+    # Looks expensive to the static cost model.
+    def __init__(self, value):
+        Condition.__init__(self, Selector(0, ('items', 'all')), 'exists')
+        self.value = value
+
+    def _evaluate(self, info):
+        return self.value
+
+
+class TestStaticCost(TestCase):
+    def test_database(self):
+        cheap = parse_rule('object:0.a == 1')
+        costly = parse_rule('object:0.items.all exists')
+        self.assertTrue(static_cost(costly) > 10 * static_cost(cheap))
+        query = parse_rule('object:0.items.filter:{"a": 1}.count > 1')
+        self.assertTrue(static_cost(query) > static_cost(costly))
+        self.assertTrue(static_cost(parse_rule('model:auth.user bool')) >
+                        static_cost(cheap))
+
+    def test_initial_order(self):
+        tree = adaptive(parse_rule('object:0.items.all exists AND '
+                                   '(object:0.b.all bool OR object:0.c bool) '
+                                   'AND object:0.a == 1'))
+        self.assertTrue(isinstance(tree, AdaptiveConditionNode))
+        self.assertEqual(str(tree.children[0]), '0.a == const:1')
+        self.assertEqual(str(tree.children[2]), '0.items.all exists')
+        self.assertEqual(str(tree.children[1].children[0]), '0.c bool')
+
+
+class TestAdaptive(TestCase):
+    def assertSame(self, tree):
+        node = adaptive(tree)
+        node.REORDER_EVERY = 2
+        compiled = compile_tree(node)
+        for i in range(3):
+            for objects, extra in _objects():
+                info = {'objects': objects, 'extra': extra}
+                expected = tree._evaluate(dict(info))
+                self.assertIs(node._evaluate(dict(info)), expected)
+                self.assertIs(compiled(dict(info)), expected)
+
+    def test_results(self):
+        for string in RULES:
+            self.assertSame(parse_rule(string))
+            tree = parse_rule(string)
+            tree.negate()
+            self.assertSame(tree)
+
+    def test_reorders(self):
+        for connector, decisive in ((AND, False), (OR, True)):
+            tree = ConditionNode([C(not decisive), C(decisive)], connector)
+            node = adaptive(tree)
+            node.MIN_SAMPLES = 5
+            first = node.children[0]
+            for i in range(node.REORDER_EVERY):
+                self.assertIs(node._evaluate({}), decisive)
+            # The decisive child now goes first.
+            self.assertIsNot(node.children[0], first)
+            self.assertEqual(node.children[0].left.arg, decisive)
+
+    def test_cost(self):
+        tree = adaptive(ConditionNode([Slow(True), C(True)]))
+        self.assertEqual(tree.children[1].__class__, Slow)
+        # Measured times replace the estimate.
+        tree.children[1].left = tree.children[1].right = None
+        entries = tree._entries()
+        for e in entries:
+            e.count, e.true = 50, 50
+        entries[0].time, entries[1].time = 1, 0.001
+        tree.reorder()
+        self.assertEqual(tree.children[0].__class__, Slow)
+
+    def test_unsafe_children_stay(self):
+        d = Dummy(True)
+        tree = ConditionNode([C(True), d, C(True), C(False)])
+        node = adaptive(tree)
+        node.REORDER_EVERY = 1
+        for i in range(20):
+            self.assertFalse(node._evaluate({}))
+        self.assertIs(node.children[1], d)
+        self.assertEqual(node.children[2].left.arg, False)
+        self.assertEqual(node.children[3].left.arg, True)
+        # Nodes containing unsafe children are unsafe too.
+        tree = ConditionNode([ConditionNode([d, C(True)]), C(False)])
+        node = adaptive(tree)
+        node.REORDER_EVERY = 1
+        for i in range(20):
+            node._evaluate({})
+        self.assertIs(node.children[0].children[0], d)
+        self.assertTrue(isinstance(node.children[1], Condition))
+
+    def test_compiled_records(self):
+        node = adaptive(ConditionNode([C(True), C(False)], OR))
+        r = Rule('t', conditions=node)
+        r.compile()
+        for i in range(5):
+            self.assertIs(r.match(), r)
+        self.assertEqual([e.count for e in node._entries()], [5, 0])
+
+    def test_compiled_tables(self):
+        node = adaptive(ConditionNode([C(True), C(False)], OR))
+        entry = node._entries()[0]
+        compile_tree(node)({})
+        plain = entry.compiled
+        for i in range(3):
+            table = SlotTable()
+            compile_tree(node, table)(table.frame({}))
+            # Only the latest table is kept.
+            self.assertIs(entry.framed[0], table)
+        compile_tree(node)({})
+        self.assertIs(entry.compiled, plain)
+
+    def test_pickle(self):
+        node = adaptive(ConditionNode([C(True), C(False)], OR))
+        r = Rule('t', conditions=node)
+        r.compile()
+        r.match()
+        loaded = pickle.loads(pickle.dumps(r))
+        self.assertEqual(loaded.conditions, node)
+        self.assertIs(loaded.match(), loaded)
+        self.assertEqual([e.count for e in loaded.conditions._entries()],
+                         [1, 0])
+
+    def test_bounded(self):
+        node = adaptive(ConditionNode([C(True), C(True)]))
+        node.WINDOW = 10
+        for i in range(100):
+            node._evaluate({})
+        for e in node._entries():
+            self.assertTrue(e.count < 10)
+            self.assertTrue(e.true <= e.count)
+
+    def test_replaced_children(self):
+        node = adaptive(ConditionNode([C(True), C(False)]))
+        node._evaluate({})
+        kept = node._entries()[1]
+        node.children = [C(True), node.children[1]]
+        self.assertIs(node._entries()[1], kept)
+        self.assertEqual(node._entries()[0].count, 0)
+        self.assertFalse(node._evaluate({}))
+
+    def test_threads(self):
+        children = [C(i % 3 == 0) for i in range(6)] + [Dummy(True)]
+        tree = ConditionNode([ConditionNode(children[:4], OR)] + children[4:])
+        node = adaptive(tree)
+        node.REORDER_EVERY = node.children[0].REORDER_EVERY = 1
+        expected = tree._evaluate({})
+        errors = []
+
+        def run():
+            for i in range(300):
+                if node._evaluate({}) is not expected:
+                    errors.append(i)
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(node.children), len(tree.children))
@@ -0,0 +1,110 @@
+from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
+from django.test import TestCase
+
+from rules.batch import lookups
+from rules.cache import RuleCache, RuleMutex
+from rules.context import RuleChecker
+from rules.core import Condition, ConditionNode, Rule
+from rules.deferred import Selector
+from rules.prefetch import PrefetchPlanner
+from . import Dummy
+
+
+def R(tree, weight=0):
+    return Rule('t', conditions=tree, weight=weight)
+
+
+class TestLookups(TestCase):
+    def test_lookups(self):
+        rules = [
+            R('object:0.permission_set.all exists AND object:1 bool'),
+            R('object:0.app_label == "auth" OR object:1.a.b.count:1 > 0'),
+            R(r'with(object:0.content_type) \0.app_label == "auth"'),
+            R('len(object:2.x) > 1 AND extra.user.name bool'),
+            RuleMutex([R('object:3.__class__.y bool'),
+                       R('object:3.z.0 bool')]),
+            R('model:contenttypes.contenttype.objects.all exists'),
+            Dummy(True),
+        ]
+        self.assertEqual(lookups(rules), {
+            0: {'permission_set__all', 'app_label', 'content_type',
+                'content_type__app_label'},
+            1: {'a__b'},
+            2: {'x'},
+            3: {'z'},
+        })
+
+    def test_nested(self):
+        s = Selector(Selector(0, ('a', 'b')), ('c',))
+        r = Rule('t', conditions=ConditionNode([Condition(s, 'bool')]))
+        self.assertEqual(lookups([r]), {0: {'a__b', 'a__b__c'}})
+        s = Selector(Selector(0, (('a', 1),)), ('c',))
+        r = Rule('t', conditions=ConditionNode([Condition(s, 'bool')]))
+        self.assertEqual(lookups([r]), {})
+
+
+def _permission():
+    ct = ContentType.objects.get_for_model(Group)
+    Permission.objects.get_or_create(codename='batch', name='Batch',
+                                     content_type=ct)
+
+
+class TestPrefetch(TestCase):
+    def setUp(self):
+        _permission()
+
+    def test_prefetch(self):
+        types = list(ContentType.objects.all())
+        self.assertTrue(len(types) > 2)
+        items = [(t,) for t in types] + [(None,), ()]
+        with self.assertNumQueries(1):
+            PrefetchPlanner([R('object:0.permission_set.all exists AND '
+                               'object:0.app_label bool AND '
+                               'object:0.missing.thing bool')]).prefetch(items)
+        with self.assertNumQueries(0):
+            for t in types:
+                list(t.permission_set.all())
+
+    def test_forward(self):
+        perms = list(Permission.objects.all())
+        with self.assertNumQueries(1):
+            PrefetchPlanner([R('object:0.content_type.app_label bool')]) \
+                .prefetch([(p,) for p in perms])
+        with self.assertNumQueries(0):
+            for p in perms:
+                p.content_type.app_label
+
+
+class TestCheckBatch(TestCase):
+    def setUp(self):
+        _permission()
+        self.rules = [
+            R('object:0.content_type.app_label == "auth" AND '
+              'object:0.codename == "batch"', 1),
+            R('object:0.content_type.model == "group"'),
+            R('object:0.content_type.app_label != "auth"', 2),
+        ]
+        cache = RuleCache(None)
+        cache['t'] = self.rules
+        cache['u'] = []
+        self.checker = RuleChecker(cache=cache)
+
+    def test_check_batch(self):
+        with self.checker as c:
+            perms = list(Permission.objects.all())
+            expected = [c.check('t', p) for p in perms]
+            perms = list(Permission.objects.all())
+            with self.assertNumQueries(2):
+                # One query for the prefetch in each batch.
+                results = c.check_batch('t', ((p,) for p in perms),
+                                        batch_size=len(perms) // 2 + 1)
+        self.assertEqual(results, expected)
+        self.assertIn({self.rules[0], self.rules[1]}, map(set, results))
+        self.assertIn([self.rules[1]], results)
+        self.assertIn([self.rules[2]], results)
+
+    def test_empty(self):
+        with self.checker as c:
+            self.assertEqual(c.check_batch('t', []), [])
+            self.assertEqual(c.check_batch('u', [(1,), (2,)]), [[], []])
@@ -0,0 +1,107 @@
+import json
+import os
+import tempfile
+
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+from six import StringIO
+
+from rules.bundle import load_bundle, read_bundle
+from rules.cache import RuleCache
+from rules.conf import settings
+from rules.models import Rule
+from rules.parser import parse_rule
+from rules.serial import is_current
+
+LINES = [
+    json.dumps({'trigger': 't', 'tree': 'object:0.a == 1', 'weight': 2,
+                'continuation': 'c', 'value': {'x': [1]}}),
+    '',
+    json.dumps({'trigger': 't', 'tree': 'object:0.a == 1 OR object:0 == 2',
+                'description': 'd'}),
+    json.dumps({'trigger': 'u', 'tree': 'object:0.a == 1'}),
+]
+
+
+class TestBundle(TestCase):
+    def test_read(self):
+        rules = list(read_bundle(LINES))
+        self.assertEqual([n for n, fields in rules], [1, 3, 4])
+        self.assertEqual(rules[0][1]['weight'], 2)
+        for line in ('{"trigger": "t"}', '[]', '{"trigger": 1, "tree": ""}',
+                     '{'):
+            self.assertRaises(ValueError, list, read_bundle([line]))
+
+    def test_load(self):
+        self.assertEqual(load_bundle(LINES, batch_size=2), 3)
+        rules = Rule.objects.order_by('pk')
+        self.assertEqual([(r.trigger, r.weight) for r in rules],
+                         [('t', 2), ('t', 0), ('u', 0)])
+        self.assertEqual(rules[0].value, {'x': [1]})
+        self.assertEqual(rules[0].continuation, 'c')
+        self.assertEqual(rules[1].description, 'd')
+        if settings.RULES_SERIALIZED_TREES:
+            for r in rules:
+                self.assertTrue(is_current(r.serialized_tree, r.tree))
+        self.assertEqual(rules[1].conditions,
+                         parse_rule('object:0.a == 1 OR object:0 == 2'))
+
+    def test_workers(self):
+        from rules import parser
+        executors = []
+
+        def parse_executor(workers=None):
+            executors.append(make(workers))
+            return executors[-1]
+        make, parser.parse_executor = parser.parse_executor, parse_executor
+        try:
+            lines = [json.dumps({'trigger': 't', 'tree': 'object:0 == {}'
+                                 .format(i)}) for i in range(900)]
+            self.assertEqual(load_bundle(lines, batch_size=450, workers=2),
+                             900)
+        finally:
+            parser.parse_executor = make
+        # One pool for every batch, shut down afterwards.
+        self.assertEqual(len(executors), 1)
+        self.assertRaises(RuntimeError, executors[0].submit, len, ())
+        self.assertEqual(Rule.objects.filter(trigger='t').count(), 900)
+
+    def test_unsatisfiable(self):
+        string = 'object:0.a == 1 AND object:0.a == 2'
+        line = json.dumps({'trigger': 't', 'tree': string})
+        self.assertEqual(load_bundle(LINES + [line]), 4)
+        rule = Rule.objects.get(tree=string)
+        if settings.RULES_SERIALIZED_TREES:
+            self.assertTrue(is_current(rule.serialized_tree, string))
+        cache = RuleCache(Rule.objects)
+        self.assertEqual(len(cache['t']), 2)
+
+    def test_invalid(self):
+        for line in ('{"trigger": "t", "tree": "object:0 =="}',
+                     '{"trigger": "t", "tree": "object:0 bool", "x": 1}'):
+            self.assertRaises(ValueError, load_bundle, LINES + [line],
+                              batch_size=2)
+            self.assertFalse(Rule.objects.exists())
+
+    def test_caches(self):
+        cache = RuleCache(Rule.objects)
+        other = cache['other']
+        self.assertEqual(len(cache['t']), 0)
+        load_bundle(LINES, caches=[cache])
+        self.assertEqual(set(cache), {'other'})
+        self.assertIs(cache['other'], other)
+        self.assertEqual(len(cache['t']), 2)
+
+    def test_command(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('\n'.join(LINES))
+            out = StringIO()
+            call_command('load_rule_bundle', path, stdout=out)
+            self.assertIn('Loaded 3 rules.', out.getvalue())
+            self.assertRaises(CommandError, call_command, 'load_rule_bundle',
+                              path + '.missing', stdout=out)
+        finally:
+            os.remove(path)
+        self.assertEqual(Rule.objects.count(), 3)
@@ -1,4 +1,5 @@
 from unittest import SkipTest
+from django.db import transaction
 from django.test import TestCase
 
 from rules.cache import *
@@ -194,6 +195,17 @@ class TestRuleCache(TestCase):
         self.assertEqual(len(y), 1)
         self.assertEqual(y[0].trigger, 'goodbye')
 
+    def test_broken_tree(self):
+        from rules.frame import FrameRuleList
+        from rules.index import IndexedRuleList
+        from rules.network import RuleNetwork
+        Rule.objects.create(trigger='broken', tree='object:0 ==')
+        ok = Rule.objects.create(trigger='broken', tree='object:0 == 1')
+        for cls in (RuleList, IndexedRuleList, RuleNetwork, FrameRuleList):
+            rules = cls(Rule.objects.filter(trigger='broken'))
+            self.assertEqual(len(rules), 2)
+            self.assertEqual([r.pk for r in rules.matches(1)], [ok.pk])
+
     def test_default_source3(self):
         r = RuleCache(Rule.objects)
         x = r.get_default_source('random')
@@ -297,6 +309,28 @@ class TestRuleCache(TestCase):
         with self.assertRaises(TypeError):
             y = r['you']
 
+    def test_missing_parallel_parse(self):
+        from rules.trees import TreeCache
+
+        class Cache(RuleCache):
+            parse_threshold = 3
+            parse_workers = 2
+
+        strings = ['object:0 == {}'.format(i) for i in range(4)]
+        for s in strings:
+            Rule.objects.create(trigger='many', tree=s)
+        TreeCache.default.clear()
+        r = Cache(Rule.objects)
+        self.assertEqual(len(r['goodbye']), 1)
+        self.assertNotIn(strings[0], TreeCache.default.trees)
+        x = r['many']
+        self.assertEqual(len(x), 4)
+        for s in strings:
+            self.assertIn(s, TreeCache.default.trees)
+        # The trees were all there when the rules were compiled.
+        self.assertEqual(TreeCache.default.misses, 1)
+        TreeCache.default.clear()
+
 
 def _trc(source=None, queryset=Rule.objects, expanders=[expand_model_key]):
     if not source:
@@ -402,9 +436,170 @@ class TestTopicalRuleCache(TestCase):
         self.assertEqual(len(r), 2)
         self.assertEqual(set(r.source), {'#', 'hello', 'hello.#', 'goodbye', 'goodbye.#'})
         del r['hello']
-        self.assertEqual(len(r), 1)
+        # 'goodbye' was loaded from '#' too.
+        self.assertEqual(len(r), 0)
         self.assertEqual(set(r.source), {'goodbye', 'goodbye.#'})
         z = r['goodbye']
-        self.assertEqual(set(r.source), {'goodbye', 'goodbye.#'})
+        self.assertEqual(set(r.source), {'#', 'goodbye', 'goodbye.#'})
         w = r['you']
         self.assertEqual(set(r.source), {'#', 'you', 'you.#', 'goodbye', 'goodbye.#'})
+
+    def test_invalidate(self):
+        r = _trc()
+        x = r['hello']
+        y = r['goodbye']
+        z = r['create.rules.rule']
+        r.invalidate(['hello', 'create.#'])
+        self.assertEqual(set(r), {'goodbye'})
+        self.assertIs(r['goodbye'], y)
+        self.assertEqual(set(r.source), {'#', 'goodbye', 'goodbye.#',
+                                         'hello.#', 'create.rules.rule', 'create.rules.#',
+                                         '#.rules.#', '#.rules.rule'})
+        Rule.objects.create(trigger='hello')
+        self.assertEqual(len(r['hello']), 5)
+
+
+class TestUpdateRule(TestCase):
+    def setUp(self):
+        for i in (0, 2, 4):
+            Rule.objects.create(weight=i, trigger='hello')
+        Rule.objects.create(weight=3, trigger='#')
+
+    def test_insert(self):
+        r = RuleCache(Rule.objects)
+        x = r['hello']
+        rule = Rule.objects.create(weight=3, trigger='hello')
+        with self.assertNumQueries(0):
+            r.update_rule(rule)
+        self.assertEqual([p.weight for p in r['hello']], [0, 2, 3, 4])
+        self.assertIsInstance(r['hello'], RuleList)
+        self.assertIsNot(r['hello'][2], rule)
+        self.assertEqual(r['hello'][2].pk, rule.pk)
+
+    def test_move(self):
+        r = RuleCache(Rule.objects)
+        x, y = r['hello'], r['bye']
+        rule = Rule.objects.get(trigger='hello', weight=2)
+        rule.weight = 5
+        r.update_rule(rule)
+        self.assertEqual([p.weight for p in r['hello']], [0, 4, 5])
+        rule.trigger = 'bye'
+        r.update_rule(rule)
+        self.assertEqual([p.weight for p in r['hello']], [0, 4])
+        self.assertEqual([p.pk for p in r['bye']], [rule.pk])
+        r.update_rule(rule, deleted=True)
+        self.assertEqual(len(r['bye']), 0)
+
+    def test_list_types(self):
+        from rules.frame import FrameRuleList
+        from rules.index import IndexedRuleList
+        from rules.network import RuleNetwork
+        for cls in (IndexedRuleList, RuleNetwork, FrameRuleList):
+            class Cache(RuleCache):
+                List = cls
+            r = Cache(Rule.objects)
+            x = r['hello']
+            rule = Rule(weight=3, trigger='hello')
+            rule.conditions = 'object:0 == 1'
+            rule.save()
+            r.update_rule(rule)
+            self.assertIsInstance(r['hello'], cls)
+            self.assertEqual([p.weight for p in r['hello']], [0, 2, 3, 4])
+            pks = lambda *objects: [p.pk for p in r['hello'].matches(*objects)]
+            self.assertIn(rule.pk, pks(1))
+            self.assertNotIn(rule.pk, pks(2))
+            r.update_rule(rule, deleted=True)
+            self.assertNotIn(rule.pk, pks(1))
+            self.assertEqual(len(pks(1)), 3)
+            rule.delete()
+
+    def test_mutex(self):
+        r = RuleCache(Rule.objects)
+        rule = Rule.objects.get(trigger='hello', weight=2)
+        r['hello'] = [RuleMutex([rule]), Rule.objects.get(weight=4)]
+        rule.weight = 5
+        r.update_rule(rule)
+        self.assertNotIn('hello', r)
+
+    def test_added_source(self):
+        r = RuleCache(Rule.objects)
+        r.add_source('hello', lambda c: Rule.objects.filter(trigger='#'))
+        r.add_source('other', lambda c: Rule.objects.filter(trigger='#'))
+        x, y, z = r['hello'], r['other'], r['bye']
+        rule = Rule.objects.get(trigger='#')
+        rule.weight = 6
+        rule.save()
+        r.update_rule(rule)
+        # There's no telling what the sources return now.
+        self.assertEqual(set(r), {'bye'})
+        self.assertEqual([p.weight for p in r['other']], [6])
+
+    def test_unknown_source(self):
+        r = RuleCache(Rule.objects.all())
+        x, y = r['hello'], r['bye']
+        r.update_rule(Rule.objects.create(trigger='hello'))
+        self.assertEqual(set(r), {'bye'})
+        self.assertEqual(len(r['hello']), 4)
+
+    def test_topical(self):
+        r = _trc()
+        x, y = r['hello'], r['create.rules.rule']
+        self.assertEqual(set(r.topics['#']), {'hello', 'create.rules.rule'})
+        rule = Rule.objects.create(weight=1, trigger='#')
+        with self.assertNumQueries(0):
+            r.source.update_rule(rule)
+            r.update_rule(rule)
+        self.assertEqual([p.weight for p in r['hello']], [0, 1, 2, 3, 4])
+        self.assertEqual([p.weight for p in r['create.rules.rule']], [1, 3])
+        self.assertEqual(len(r.source['#']), 2)
+        r.update_rule(rule, deleted=True)
+        self.assertEqual([p.weight for p in r['hello']], [0, 2, 3, 4])
+
+    def test_topical_forget(self):
+        # With no telling which rules a queryset holds, the keys for the
+        # trigger are forgotten, and nothing is loaded again meanwhile.
+        r = _trc(queryset=Rule.objects.all())
+        x, y = r['hello'], r['create.rules.rule']
+        rule = Rule.objects.create(weight=1, trigger='#')
+        with self.assertNumQueries(0):
+            r.update_rule(rule)
+        self.assertEqual(set(r), set())
+        self.assertNotIn('#', r.source)
+
+    def test_signals(self):
+        if not settings.RULES_CONCRETE_MODELS:
+            raise SkipTest
+        RuleCache.default.clear()
+        TopicalRuleCache.default.clear()
+        try:
+            x = TopicalRuleCache.default['hello']
+            with self.captureOnCommitCallbacks(execute=True):
+                rule = Rule.objects.create(weight=1, trigger='hello')
+            with self.assertNumQueries(0):
+                self.assertEqual([p.weight for p in
+                                  TopicalRuleCache.default['hello']],
+                                 [0, 1, 2, 3, 4])
+                self.assertEqual(len(RuleCache.default['hello']), 4)
+            with self.captureOnCommitCallbacks(execute=True):
+                rule.delete()
+            self.assertEqual(len(TopicalRuleCache.default['hello']), 4)
+            # Rules rolled back never reach the caches.
+            with self.captureOnCommitCallbacks(execute=True):
+                try:
+                    with transaction.atomic():
+                        Rule.objects.create(weight=1, trigger='hello')
+                        raise ValueError
+                except ValueError:
+                    pass
+            self.assertEqual(len(TopicalRuleCache.default['hello']), 4)
+            # Nor does anything else before the commit.
+            with self.captureOnCommitCallbacks() as callbacks:
+                Rule.objects.get(weight=2).delete()
+            self.assertEqual(len(TopicalRuleCache.default['hello']), 4)
+            for callback in callbacks:
+                callback()
+            self.assertEqual([p.weight for p in
+                              TopicalRuleCache.default['hello']], [0, 3, 4])
+        finally:
+            RuleCache.default.clear()
+            TopicalRuleCache.default.clear()
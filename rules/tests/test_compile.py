@@ -0,0 +1,156 @@
+from django.test import TestCase
+
+from rules.cache import RuleList, RuleMutex
+from rules.core import AND, OR, ConditionNode, Condition, Rule, compile_tree
+from rules.deferred import Selector, Function, DeferredDict, DeferredTuple
+from rules.parser import parse_rule
+from . import Dummy
+
+
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+RULES = (
+    '',
+    'object:0.a == 1',
+    'object:0.a != object:1.a',
+    'object:0.a <= 2 AND object:0.b > 1.5',
+    'object:0.missing == 1',
+    'NOT object:0.missing == 1',
+    'object:0.missing bool',
+    'NOT object:0.missing bool',
+    'object:0.missing exists',
+    'object:0.missing does not exist',
+    'object:0.items does not exist',
+    'object:5 bool',
+    'NOT object:5 bool',
+    'min() bool',
+    'NOT min() bool',
+    'object:0.name like regex("ab.*")',
+    'object:0.name not like regex("x")',
+    'object:0.name re regex("[0-9]+$")',
+    'len(object:0.items) > 2',
+    'sum(object:0.items) >= 6',
+    'max(object:0.items) == object:0.a',
+    'object:0.a in [1, 2, 3]',
+    'object:0.a not in [1, 2]',
+    '"b" in object:0.name',
+    'extra.user.name == "bob"',
+    'extra.user.upper; == "BOB"',
+    'object:0.items.count:2 == 1',
+    'object:0.name.split:"b".0 == "a"',
+    r'with(object:0.a) \0 > 1 AND \0 < 10',
+    r'with(object:0.items) \0.index:3 == 2 OR len(\0) == 0',
+    '(object:0.a == 1 OR object:0.b == 2) AND '
+    'NOT (object:0.c bool OR object:1 bool)',
+    'object:0.a == 1 OR object:0.a == 2 OR object:0.a == 3',
+    '((object:0.a > 0 AND object:0.b > 0) OR object:0.c bool) AND '
+    '(object:0.name like regex("a") OR NOT object:0.items bool)',
+)
+
+
+def _objects():
+    yield (), {}
+    yield ({'a': 1, 'b': 2, 'c': 0, 'name': 'abc', 'items': [1, 2, 3]},
+           {'a': 2}), {'user': {'name': 'bob'}}
+    yield ({'a': 3, 'b': 1.5, 'c': None, 'name': '123', 'items': []},
+           {'a': 3}), {'user': 'bob'}
+    yield (Obj(a=2, b=2, c=True, name='xab', items=[3, 2, 2, 1], missing=1),
+           None), {'user': Obj(name='alice')}
+    yield (Obj(a=None, name=None, items=None),), {}
+    yield ({'a': '1', 'name': 5},), {'user': None}
+
+
+class TestCompiledConditions(TestCase):
+    def assertSame(self, tree):
+        compiled = compile_tree(tree)
+        for objects, extra in _objects():
+            expected = tree._evaluate({'objects': objects, 'extra': extra})
+            actual = compiled({'objects': objects, 'extra': extra})
+            self.assertIs(actual, expected, '{} with {!r}'.format(tree, objects))
+
+    def test_rules(self):
+        for string in RULES:
+            self.assertSame(parse_rule(string))
+
+    def test_negated_rules(self):
+        for string in RULES:
+            tree = parse_rule(string)
+            tree.negate()
+            self.assertSame(tree)
+
+    def test_conditions(self):
+        for string in RULES:
+            tree = parse_rule(string)
+            for child in tree.children:
+                self.assertSame(child)
+
+    def test_deferred_args(self):
+        f = DeferredDict({'a': Selector(0, ('a',))})
+        s = Selector(('const', {'x': {1: 'one', 2: 'two'}}), ())
+        s = Selector(s, ('x', DeferredTuple(('get', Selector(0, ('a',))))))
+        self.assertSame(Condition(s, '==', Selector(('const', 'one'), ())))
+        self.assertSame(Condition(Function('dict', (f,)), 'bool'))
+        nested = Selector(Selector(0, ()), ('a',))
+        self.assertSame(Condition(nested, 'in', Selector(1, ('items',))))
+
+    def test_custom_children(self):
+        c = Condition(Selector(0, ('a',)), '==', Selector(('const', 1), ()))
+        for v in (True, False):
+            self.assertSame(ConditionNode([Dummy(v), c]))
+            self.assertSame(ConditionNode([c, Dummy(v)], OR))
+            self.assertSame(ConditionNode([ConditionNode([Dummy(v)]), c], OR))
+
+    def test_empty(self):
+        self.assertIs(compile_tree(ConditionNode())({}), True)
+        self.assertIs(compile_tree(ConditionNode(connector=OR))({}), False)
+
+    def test_deep(self):
+        c = Condition(Selector(0, ('a',)), '==', Selector(('const', 1), ()))
+        tree = ConditionNode([c])
+        for i in range(100):
+            tree = ConditionNode([tree, Dummy(True)], OR if i % 2 else AND)
+        self.assertSame(tree)
+
+    def test_memoizes(self):
+        s = Selector(0, ('a',))
+        tree = ConditionNode([Condition(s, 'bool')])
+        info = {'objects': ({'a': 1},), 'extra': {}}
+        compile_tree(tree)(info)
+        self.assertEqual(info[s], 1)
+
+
+class TestCompiledRules(TestCase):
+    def test_compile(self):
+        r = Rule('hi', conditions='object:0 == 1')
+        self.assertEqual(r._evaluator(), r.conditions._evaluate)
+        compiled = r.compile()
+        self.assertIs(r._evaluator(), compiled)
+        self.assertIs(r.match(1), r)
+        self.assertFalse(r.match(2))
+        # Replacing the conditions discards the compiled form.
+        r.conditions = ConditionNode([Dummy(True)])
+        self.assertEqual(r._evaluator(), r.conditions._evaluate)
+        self.assertIs(r.match(2), r)
+
+    def test_collections_compile(self):
+        r1 = Rule('hi', conditions='object:0 == 1', weight=1)
+        r2 = Rule('hi', conditions='object:0 bool')
+        rl = RuleList([r1, r2])
+        self.assertIs(r1._compiled[0], r1.conditions)
+        self.assertIs(r2._compiled[0], r2.conditions)
+        self.assertEqual(rl.matches(1), [r2, r1])
+        self.assertEqual(rl.matches(2), [r2])
+        r3 = Rule('hi', conditions='object:0 == 2', weight=-1)
+        rm = RuleMutex([r1, r3])
+        self.assertIs(r3._compiled[0], r3.conditions)
+        self.assertIs(rm.match(1), r1)
+        self.assertIs(rm.match(2), r3)
+
+    def test_bad_rule(self):
+        r = Rule('hi', conditions=ConditionNode([Dummy(True)]))
+        r.conditions = None
+        rl = RuleList([r, Dummy(True)])
+        self.assertEqual(len(rl.matches()), 1)
@@ -1,4 +1,5 @@
 import datetime
+import pickle
 
 from django.test import TestCase
 from madlibs.test_utils import CollectMixin
@@ -79,6 +80,19 @@ class TestCondition(TestCase):
         self.assertEqual(cn.connector, ConditionNode.default)
         self.assertEqual(len(Condition.C()), 0)
 
+    def test_pickle(self):
+        left, right = Selector(0, ('a',)), Selector(('const', [1, 2]), ())
+        for op in ('in', 'not in', '==', 'bool'):
+            c = Condition(left, op, None if op == 'bool' else right)
+            self.assertTrue(c.evaluate({'a': 1}) in (True, False))
+            d = pickle.loads(pickle.dumps(c, pickle.HIGHEST_PROTOCOL))
+            self.assertEqual(d, c)
+            self.assertIs(d._eval, c._eval)
+            for obj in ({'a': 1}, {'a': 3}):
+                self.assertEqual(d.evaluate(obj), c.evaluate(obj))
+        node = ConditionNode([c, Condition(left, '==', right)], OR)
+        self.assertEqual(pickle.loads(pickle.dumps(node)), node)
+
 
 class TestConditionMethods(CollectMixin, TestCase):
     defaults = {'left': Selector(0, None), 'right': Selector(1, None), 'operator': '=='}
@@ -102,6 +116,19 @@ class TestConditionMethods(CollectMixin, TestCase):
         c.negate()
         self.assertIs(c.negated, False)
 
+    def test_eq(self):
+        c = self.c()
+        self.assertEqual(c, self.c())
+        self.assertEqual(hash(c), hash(self.c()))
+        self.assertNotEqual(c, self.c(operator='!='))
+        self.assertNotEqual(c, self.c(negated=True))
+        self.assertNotEqual(c, self.c(right=Selector(2, None)))
+        self.assertNotEqual(self.c(operator='bool'), self.c(operator='exists'))
+        self.assertNotEqual(c, Dummy(True))
+        c.negate()
+        self.assertEqual(c, self.c(negated=True))
+        self.assertEqual(hash(c), hash(self.c(negated=True)))
+
     def _eval(self, true, false, **kwargs):
         ct = self.c(**kwargs)
         cf = self.c(negated=True, **kwargs)
@@ -195,6 +222,33 @@ class TestConditionNode(TestCase):
         self.assertEqual(n.children, [child])
         self.assertEqual(n.connector, AND)
 
+    def test_add_equal(self):
+        c1 = Condition(Selector(0, None), 'bool')
+        c2 = Condition(Selector(0, None), 'bool')
+        n = ConditionNode([c1, Dummy(True)])
+        n.add(c2, AND)
+        self.assertEqual(len(n.children), 3)
+        self.assertIs(n.children[2], c2)
+        c3 = Condition(Selector(0, None), 'bool')
+        n.add(c3, OR)
+        self.assertEqual(len(n.children), 2)
+        self.assertIs(n.children[1], c3)
+        self.assertEqual(n.connector, OR)
+
+    def test_eq(self):
+        c1, c2 = Dummy(True), Dummy(True)
+        self.assertEqual(ConditionNode([c1, c2]), ConditionNode([c1, c2]))
+        self.assertEqual(hash(ConditionNode([c1, c2])),
+                         hash(ConditionNode([c1, c2])))
+        self.assertNotEqual(ConditionNode([c1, c2]), ConditionNode([c2, c1]))
+        self.assertNotEqual(ConditionNode([c1], OR), ConditionNode([c1]))
+        c = Condition(Selector(0, ('a',)), '==', Selector(('const', 1), None))
+        d = Condition(Selector(0, ('a',)), '==', Selector(('const', 1), None))
+        n1, n2 = ConditionNode([c, ConditionNode([c1])]), ConditionNode([d])
+        n2.children.append(ConditionNode([c1]))
+        self.assertEqual(n1, n2)
+        self.assertEqual(hash(n1), hash(n2))
+
     def test_add_third(self):
         c1, c2, c3 = Dummy(True), Dummy(True), Dummy(False)
         n = ConditionNode([c1, c2])
@@ -429,6 +483,22 @@ class TestRule(TestCase):
         r2 = Rule(trigger='hi', conditions=n)
         self.assertIs(r2.match(), r2)
 
+    def test_pickle(self):
+        r = Rule('hi', conditions='object:0.a == 1 OR object:0 == 2',
+                 continuation='cont1', value=[1], weight=3)
+        self.assertTrue(r.conditions.frozen)
+        r.compile()
+        loaded = pickle.loads(pickle.dumps(r, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(loaded.conditions, r.conditions)
+        self.assertFalse(loaded.conditions.frozen)
+        self.assertIs(loaded._compiled[0], loaded.conditions)
+        self.assertEqual((loaded.trigger, loaded.continuation, loaded.value,
+                          loaded.weight), ('hi', 'cont1', [1], 3))
+        self.assertIs(loaded.match(2), loaded)
+        self.assertFalse(loaded.match(3))
+        loaded = pickle.loads(pickle.dumps(Rule('hi', conditions='object:0 bool')))
+        self.assertFalse(hasattr(loaded, '_compiled'))
+
     def test_continue_simple(self):
         r1 = Rule('hi', continuation='cont1', value=14)
         i = {}
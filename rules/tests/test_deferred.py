@@ -1,3 +1,5 @@
+import pickle
+
 from django.contrib.contenttypes.models import ContentType
 from django.test import TestCase
 from rules.deferred import *
@@ -206,6 +208,53 @@ class TestSelector(TestCase):
         x = s.get_value({'objects': ['random']})
         self.assertEqual(len(x), 0)
 
+    def test_inline_cache(self):
+        class Obj(object):
+            a = 1
+            items = [5]
+
+        class Items(dict):
+            a = 2
+        s = Selector(0, ('a',))
+        hop = s._hops[0]
+        self.assertEqual(s._get_value({'objects': [Obj()]}), 1)
+        self.assertIs(hop.cache[0], Obj)
+        self.assertEqual(s._get_value({'objects': [Obj()]}), 1)
+        self.assertEqual(hop.misses, 1)
+        # Subscriptable types still try items first.
+        self.assertEqual(s._get_value({'objects': [{'a': 3}]}), 3)
+        self.assertIs(hop.cache[0], dict)
+        self.assertEqual(s._get_value({'objects': [Items(a=4)]}), 4)
+        self.assertEqual(s._get_value({'objects': [Items()]}), 2)
+        self.assertEqual(s._get_value({'objects': [Obj]}), 1)
+        self.assertRaises(ChainError, s._get_value, {'objects': [None]})
+        self.assertEqual(hop.misses, 5)
+        # Dicts without the key fall back to attributes, like always.
+        s = Selector(0, ('items',))
+        self.assertEqual(s._get_value({'objects': [Obj()]}), [5])
+        self.assertEqual(list(s._get_value({'objects': [{1: 2}]})), [(1, 2)])
+
+    def test_inline_cache_megamorphic(self):
+        s = Selector(0, ('real',))
+        hop = s._hops[0]
+        values = [1, 1.5, True, 1j, 2, 2.5, False, 2j, 3, 3.5, 3j]
+        for i in range(2):
+            for v in values:
+                self.assertEqual(s._get_value({'objects': [v]}), v.real)
+        self.assertEqual(hop.misses, hop.MAX_MISSES)
+
+    def test_inline_cache_copy(self):
+        import copy
+        import pickle
+        s = Selector(0, ('real', ('conjugate', ())))
+        self.assertEqual(s._get_value({'objects': [1]}), 1)
+        for c in (copy.deepcopy(s), pickle.loads(pickle.dumps(s._hops))[0]):
+            hops = getattr(c, '_hops', (c,))
+            self.assertEqual(hops[0].name, 'real')
+            self.assertEqual(hops[0].misses, 0)
+        self.assertEqual(copy.deepcopy(s)._get_value({'objects': [2]}), 2)
+        self.assertIs(Selector(0, s)._hops, None)
+
     def test_str(self):
         s = Selector(('model', 'contenttypes.contenttype'), ('objects', 'all'))
         self.assertEqual(str(s), 'model:contenttypes.contenttype.objects.all')
@@ -214,6 +263,22 @@ class TestSelector(TestCase):
         s = Selector(s, ('hello',))
         self.assertEqual(str(s), 'const:3.hello')
 
+    def test_pickle(self):
+        selectors = (
+            Selector(0, ('a', 'b')),
+            Selector('extra', ('x',)),
+            Selector(('const', {'a': 1}), None),
+            Selector(('model', 'contenttypes.contenttype'), ('objects',)),
+            Selector(Selector(0, ()), (Selector(1, ()),)),
+        )
+        info = {'objects': ({'a': {'b': 1}, 'x': 'y'}, 'x'),
+                'extra': {'x': 2}}
+        for s in selectors:
+            value = s.get_value(dict(info))
+            t = pickle.loads(pickle.dumps(s, pickle.HIGHEST_PROTOCOL))
+            self.assertEqual(t, s)
+            self.assertEqual(t.get_value(dict(info)), value)
+
 
 class TestFunction(TestCase):
     def test_init(self):
@@ -267,6 +332,67 @@ class TestFunction(TestCase):
         s = Selector(0, ())
         self.assertNotEqual(f1, s)
 
+    def test_pushdown(self):
+        qs = ContentType.objects.all()
+        pks = list(qs.values_list('pk', flat=True))
+        i = {'objects': (qs,)}
+        # (function, chain link, result, aggregate or None for Python)
+        cases = (
+            ('len', (), len(pks), 'COUNT'),
+            ('max', ('values_list', ('pk',)), (max(pks),), 'MAX'),
+            ('min', ('values_list', ('pk',)), (min(pks),), 'MIN'),
+            # Text is ordered by the database's collation.
+            ('min', ('values_list', ('app_label',)), min(
+                qs.values_list('app_label')), None),
+            ('max', ('values_list', ('pk', 'model')), max(
+                qs.values_list('pk', 'model')), None),
+        )
+        for name, link, expected, aggregate in cases:
+            chain = (link,) if link else ()
+            f = Function(name, [Selector(0, chain)])
+            # One aggregate query, not one per row.
+            with self.assertNumQueries(1) as queries:
+                self.assertEqual(f._get_value(dict(i)), expected)
+            sql = queries[0]['sql']
+            if aggregate is None:
+                self.assertNotIn(name.upper() + '(', sql)
+            else:
+                self.assertIn(aggregate + '(', sql)
+            self.assertEqual(f.func(*f.args.get_value(dict(i))), expected)
+        flat = ContentType.objects.values_list('pk', flat=True)
+        with self.assertNumQueries(1) as queries:
+            self.assertEqual(Function('sum', [flat])._get_value({}), sum(pks))
+        self.assertIn('SUM(', queries[0]['sql'])
+        # Python can't sum 1-tuples, loaded or not.
+        for loaded in (False, True):
+            qs = ContentType.objects.values_list('pk')
+            if loaded:
+                list(qs)
+            self.assertRaises(TypeError, Function('sum', [qs])._get_value,
+                              {})
+        # Loaded querysets and empty ones are left to Python.
+        qs = ContentType.objects.values_list('pk')
+        list(qs)
+        with self.assertNumQueries(0):
+            self.assertEqual(Function('max', [qs])._get_value({}),
+                             (max(pks),))
+        empty = ContentType.objects.none().values_list('pk', flat=True)
+        self.assertEqual(Function('sum', [empty])._get_value({}), 0)
+        self.assertRaises(ValueError, Function('min', [empty])._get_value, {})
+        self.assertEqual(Function('max', [(1, 3)])._get_value({}), 3)
+
+    def test_pickle(self):
+        f = Function('len', [Selector(0, ())])
+        self.assertEqual(f.get_value({'objects': ([1, 2],)}), 2)
+        g = pickle.loads(pickle.dumps(f, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(g, f)
+        self.assertIs(g.func, len)
+        count = ContentType.objects.count()
+        with self.assertNumQueries(1):
+            # Still pushed down to the database.
+            self.assertEqual(g.get_value({'objects': (
+                ContentType.objects.all(),)}), count)
+
 
 class TestDeferredDict(TestCase):
     def test_maybe_const(self):
@@ -287,6 +413,15 @@ class TestDeferredDict(TestCase):
         self.assertEqual(d.get_value({'objects': [1]}), {'one': 1, 'two': 2})
         self.assertEqual(d.get_value({'objects': ['one']}), {'one': 'one', 'two': 2})
 
+    def test_pickle(self):
+        d = DeferredDict({'one': Selector(0, None), 'two': 2})
+        d.get_value({'objects': [1]})
+        hash(d)
+        e = pickle.loads(pickle.dumps(d, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(e, d)
+        self.assertIsInstance(e, DeferredDict)
+        self.assertEqual(e.get_value({'objects': [3]}), {'one': 3, 'two': 2})
+
 
 class TestDeferredTuple(TestCase):
     def test_maybe_const(self):
@@ -306,3 +441,11 @@ class TestDeferredTuple(TestCase):
         l = DeferredTuple(['one', Selector(0, None), 2])
         self.assertEqual(l.get_value({'objects': [1]}), ('one', 1, 2))
         self.assertEqual(l.get_value({'objects': ['one']}), ('one', 'one', 2))
+
+    def test_pickle(self):
+        l = DeferredTuple(['one', Selector(0, None), 2])
+        l.get_value({'objects': [1]})
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            m = pickle.loads(pickle.dumps(l, protocol))
+            self.assertEqual(m, l)
+            self.assertEqual(m.get_value({'objects': [3]}), ('one', 3, 2))
@@ -7,7 +7,8 @@ from rules.core import *
 from rules.deferred import *
 from rules.formatter import (
     _format, _format_tree, _format_cond, _format_term, _format_deferred,
-    _format_func, _format_sel, _format_dict, _format_list, format_rule
+    _format_func, _format_sel, _format_dict, _format_list, format_rule,
+    fingerprint
 )
 from rules.parser import parse_value, parse_rule
 
@@ -244,3 +245,37 @@ class TestRules(TestCase):
         self.assertEqual(x, y)
         z = parse_rule(y)
         self.assertEq(z, n3)
+
+
+class TestCanonical(TestCase):
+    def test_same(self):
+        from .test_compile import RULES, _objects
+        # Empty trees don't format as anything parseable.
+        for string in filter(None, RULES):
+            tree = parse_rule(string)
+            canonical = format_rule(tree, canonical=True)
+            parsed = parse_rule(canonical)
+            self.assertEqual(format_rule(parsed, canonical=True), canonical)
+            for objects, extra in _objects():
+                self.assertEqual(parsed.evaluate(*objects, **extra),
+                                 tree.evaluate(*objects, **extra), string)
+
+    def test_order(self):
+        a = parse_rule('object:0.a == 1 AND (object:1 bool OR '
+                       'object:0.b in [2, 1]) AND extra.x:{"k":1,"j":2}; > 1')
+        b = parse_rule('extra.x:{"j":2,"k":1}; > 1 AND '
+                       '(object:0.b in [2, 1] OR object:1 bool) AND '
+                       'object:0.a == 1')
+        self.assertNotEqual(format_rule(a), format_rule(b))
+        self.assertEqual(format_rule(a, canonical=True),
+                         format_rule(b, canonical=True))
+        self.assertEqual(fingerprint(a), fingerprint(b))
+        c = parse_rule('object:0.b in [1, 2] OR object:1 bool')
+        self.assertNotEqual(fingerprint(a), fingerprint(c))
+
+    def test_shared(self):
+        tree = parse_rule('object:0.a == 1 AND len(object:0.a) > 2 AND '
+                          'object:0.a != 3')
+        string = format_rule(tree, canonical=True)
+        self.assertEqual(string.count('object:0.a;'), 1)
+        self.assertEqual(format_rule(tree).count('object:0.a;'), 1)
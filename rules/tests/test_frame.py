@@ -0,0 +1,97 @@
+from django.test import TestCase
+
+from rules.adaptive import adaptive
+
+from rules.cache import RuleList
+from rules.core import ConditionNode, Rule, compile_tree
+from rules.deferred import Selector
+from rules.frame import Frame, FrameRuleList, SlotTable
+from rules.parser import parse_rule
+from . import Dummy
+from .test_compile import RULES, _objects
+
+
+class Objects(object):
+    # A custom condition, which only knows about plain ``info`` dicts.
+    def __init__(self, count):
+        self.count = count
+
+    def _evaluate(self, info):
+        info['seen'] = True
+        return len(info['objects']) == self.count
+
+
+class TestSlotTable(TestCase):
+    def test_slot(self):
+        t = SlotTable()
+        self.assertEqual(t.slot(Selector(0, ('a',))), 0)
+        self.assertEqual(t.slot(Selector(1, ())), 1)
+        self.assertEqual(t.slot(Selector(0, ('a',))), 0)
+        self.assertEqual(len(t), 2)
+        self.assertEqual(len(t.frame({}).slots), 2)
+
+    def test_memoize(self):
+        s = Selector(0, ('a',))
+        t = SlotTable()
+        calls = []
+        get = t.memoize(s, lambda info: calls.append(1) or len(calls))
+        frame = t.frame({'objects': ({'a': 1},), 'extra': {}})
+        self.assertEqual(get(frame), 1)
+        self.assertEqual(get(frame), 1)
+        self.assertEqual(frame.slots, [1])
+        self.assertNotIn(s, frame)
+        # Other dicts (or frames from other tables) memoize as usual.
+        info = {}
+        self.assertEqual(get(info), 2)
+        self.assertEqual(get(info), 2)
+        self.assertEqual(info[s], 2)
+        other = SlotTable().frame({})
+        self.assertEqual(get(other), 3)
+        self.assertEqual(other[s], 3)
+
+
+class TestFrameRuleList(TestCase):
+    def test_consistent(self):
+        rules = [Rule('t', conditions=parse_rule(string), weight=i)
+                 for i, string in enumerate(RULES)]
+        rules.append(Rule('t', conditions=ConditionNode([Objects(2)])))
+        rules.append(Dummy(True))
+        frames, plain = FrameRuleList(rules), RuleList(rules)
+        self.assertTrue(len(frames.table) > 10)
+        for objects, extra in _objects():
+            self.assertEqual(frames.matches(*objects, **extra),
+                             plain.matches(*objects, **extra))
+
+    def test_frame(self):
+        r = Rule('t', conditions=ConditionNode([
+            Objects(1), parse_rule('object:0.a == 1 AND object:0.a < 2')]))
+        l = FrameRuleList([r])
+        # Both conditions share the same slot.
+        self.assertEqual(len(l.table), 1)
+        info = {'objects': ({'a': 1},), 'extra': {}}
+        self.assertEqual(l._matches(info), [r])
+        # The caller's info is left alone.
+        self.assertNotIn('seen', info)
+
+    def test_adaptive(self):
+        # Adaptive nodes compile their children as they first run them.
+        tree = parse_rule('object:0.a == 1 AND (object:0.b == 2 OR '
+                          'object:1.c == 3)')
+        r = Rule('t', conditions=adaptive(tree))
+        frames = FrameRuleList([r])
+        for objects, expected in ((({'a': 1, 'b': 2}, {}), [r]),
+                                  (({'a': 1, 'b': 0}, {'c': 3}), [r]),
+                                  (({'a': 1, 'b': 0}, {'c': 0}), [])):
+            info = {'objects': objects, 'extra': {}}
+            self.assertEqual(frames._matches(info), expected)
+
+    def test_compile(self):
+        tree = parse_rule('object:0.a == object:1.a OR object:0.b bool')
+        t = SlotTable()
+        evaluate = compile_tree(tree, t)
+        self.assertEqual(len(t), 3)
+        for objects, extra in _objects():
+            info = {'objects': objects, 'extra': extra}
+            expected = tree._evaluate(dict(info))
+            self.assertIs(evaluate(Frame(info, t)), expected)
+            self.assertIs(evaluate(info), expected)
@@ -0,0 +1,329 @@
+import datetime
+import json
+import re
+from decimal import Decimal
+
+from django.test import TestCase
+from django.utils import timezone
+
+from rules.cache import RuleList, RuleMutex
+from rules.core import Rule
+from rules.deferred import Selector
+from rules.parser import parse_rule
+from rules.index import (
+    EqualityIndex, RangeIndex, PatternIndex, SubstringIndex, IndexedRuleList,
+    IndexedRuleMutex, guards, _literal_prefix, _Automaton
+)
+from . import Dummy
+
+
+def R(tree, weight=0):
+    return Rule('t', conditions=tree, weight=weight)
+
+
+class Tagged(str):
+    # Equal to plain strings, but not hashed like them.
+    def __hash__(self):
+        return 0
+
+
+OBJECTS = (
+    {'status': 'closed', 'kind': 'a', 'amount': 5},
+    {'status': 'open', 'kind': 'b', 'amount': 50},
+    {'status': 'open', 'kind': 'c', 'amount': 50},
+    {'status': Tagged('open'), 'kind': 'q'},
+    {'kind': 'a'},
+    {'status': ['open']},
+    None,
+)
+
+
+class IndexTests(object):
+    def setUp(self):
+        self.rules = [
+            R('object:0.status == "closed"', 5),
+            R('"open" == object:0.status AND object:0.amount > 10'),
+            R('object:0.kind in ["a", "b"] AND object:0.status bool', -1),
+            R('object:0.kind in ["c"]', 1),
+            R('object:0.status == "open" OR object:0.kind == "q"', 2),
+            R('NOT object:0.status == "open"', 3),
+            R('object:0.status != "open" AND object:0.kind == "a"', 4),
+            R('object:0.status == "open" AND object:0.kind == "q"', 6),
+            Dummy(True, weight=-2),
+        ]
+
+    def assertConsistent(self, rules):
+        indexed, plain = self.cls(rules), self.plain(rules)
+        self.assertEqual(tuple(indexed), tuple(plain))
+        for obj in OBJECTS:
+            if self.cls is IndexedRuleList:
+                self.assertEqual(indexed.matches(obj), plain.matches(obj))
+            else:
+                self.assertIs(indexed.match(obj), plain.match(obj))
+
+    def test_consistent(self):
+        self.assertConsistent(self.rules)
+
+    def test_consistent_subsets(self):
+        for i in range(len(self.rules)):
+            self.assertConsistent(self.rules[i:])
+            self.assertConsistent(self.rules[:i])
+
+
+class TestIndexedRuleList(IndexTests, TestCase):
+    cls, plain = IndexedRuleList, RuleList
+
+    def test_build(self):
+        l = self.cls(self.rules)
+        by_selector = {d: i for (c, d), i in l.indexes.items()}
+        self.assertEqual(len(by_selector), 2)
+        status = by_selector[Selector(0, ('status',))]
+        kind = by_selector[Selector(0, ('kind',))]
+        self.assertTrue(isinstance(status, EqualityIndex))
+        self.assertEqual(set(status.table), {'open', 'closed'})
+        self.assertEqual(set(kind.table), {'a', 'b', 'c'})
+        # The OR, the negation and the Dummy can't be indexed.
+        self.assertEqual(len(l.unindexed), 3)
+
+    def test_candidates(self):
+        l = self.cls(self.rules)
+        c = l._candidates({'objects': (OBJECTS[0],), 'extra': {}})
+        self.assertEqual(len(c), 6)
+        self.assertEqual(list(c), sorted(c, key=lambda r: r.weight))
+        c = l._candidates({'objects': (), 'extra': {}})
+        self.assertEqual(len(c), 3)
+
+    def test_unhashable_value(self):
+        l = self.cls(self.rules)
+        c = l._candidates({'objects': (OBJECTS[5],), 'extra': {}})
+        # Lists can't be looked up, so all the status rules are candidates.
+        self.assertEqual(len(c), 6)
+        c = l._candidates({'objects': (OBJECTS[3],), 'extra': {}})
+        self.assertIn(self.rules[-2], c)
+
+
+class TestIndexedRuleMutex(IndexTests, TestCase):
+    cls, plain = IndexedRuleMutex, RuleMutex
+
+    def test_weight(self):
+        self.assertEqual(self.cls(self.rules).weight, -2)
+        self.assertEqual(self.cls(self.rules[:-1]).weight, -1)
+
+
+class TestRangeIndex(TestCase):
+    def setUp(self):
+        self.rules = [R('object:0 > {}'.format(i), i) for i in range(0, 20, 2)]
+        self.rules += [R('object:0 <= {} AND object:1 bool'.format(i), -i)
+                       for i in (5, 10.5, 15)]
+        self.rules += [R('{} >= object:0'.format(i)) for i in (3, 7)]
+        self.rules += [R('{} < object:0'.format(i)) for i in (4, 8)]
+        self.rules += [R('object:0 < "m"'), R('object:0 >= 2014-01-02'),
+                       R('object:0 > 1 OR object:0 < 0')]
+        self.values = [-1, 0, 1, 2, 3, 3.5, 4, 5, 7, 8, 10.5, 11, 15, 16, 30,
+                       Decimal('4.5'), True, float('nan'), float('inf'), None,
+                       'a', 'z', datetime.date(2014, 1, 1),
+                       datetime.date(2014, 1, 2), datetime.datetime.now(), [1]]
+
+    def test_build(self):
+        l = IndexedRuleList(self.rules)
+        self.assertEqual(len(l.indexes), 1)
+        index = list(l.indexes.values())[0]
+        self.assertTrue(isinstance(index, RangeIndex))
+        self.assertEqual(len(l.unindexed), 1)
+        numbers = index.tables['numeric']
+        self.assertEqual(numbers['>'][0], [0, 2, 4, 4, 6, 8, 8, 10, 12, 14,
+                                           16, 18])
+        self.assertEqual(numbers['<='][0], [3, 5, 7, 10.5, 15])
+        self.assertEqual(len(index.tables), 3)
+
+    def test_consistent(self):
+        indexed, plain = IndexedRuleList(self.rules), RuleList(self.rules)
+        for v in self.values:
+            self.assertEqual(indexed.matches(v, 1), plain.matches(v, 1))
+            self.assertEqual(indexed.matches(v, 0), plain.matches(v, 0))
+
+    def test_candidates(self):
+        l = IndexedRuleList(self.rules)
+        c = l._candidates({'objects': (9,), 'extra': {}})
+        # Seven "greater" and two "lesser" guards hold, then there are the two
+        # non-numeric guards and the unindexed OR.
+        self.assertEqual(len(c), 7 + 2 + 2 + 1)
+
+    def test_incomparable(self):
+        naive = [R('object:0 > 2014-01-02T03:04:05'),
+                 R('object:0 <= 2014-01-02T03:04:05'), R('object:0 > 1')]
+        aware = datetime.datetime(2015, 1, 1,
+                                  tzinfo=timezone.get_fixed_timezone(0))
+        indexed, plain = IndexedRuleList(naive), RuleList(naive)
+        self.assertEqual(len(indexed.indexes), 1)
+        for v in (aware, aware.replace(tzinfo=None), 2):
+            self.assertEqual(indexed.matches(v), plain.matches(v))
+        self.assertEqual(len(indexed._candidates({'objects': (aware,),
+                                                  'extra': {}})), 3)
+
+    def test_prefers_equality(self):
+        r = R('object:0.x > 1 AND object:0.y == 2')
+        l = IndexedRuleList([r])
+        self.assertEqual([type(i) for i in l.indexes.values()],
+                         [EqualityIndex])
+
+
+class TestPatternIndex(TestCase):
+    PATTERNS = ('abc', 'abd', r'ab\.c', 'ab', 'a+b', '^xyz', 'x?yz', '[ab]c',
+                '.*@example\\.com$', r'(\w)\1', 'q|r', '(?i)ABC', 'ab(c|d)',
+                r'\d+', '')
+
+    def setUp(self):
+        self.rules = [R('object:0 like regex({})'.format(_json(p)), i)
+                      for i, p in enumerate(self.PATTERNS)]
+        self.rules.append(R('object:0 re regex("b") AND object:1 bool'))
+        self.rules.append(R('object:0 not like regex("ab")'))
+        self.values = ['abc', 'abd', 'ab.c', 'abx', 'aab', 'xyz', 'yz', 'bc',
+                       'me@example.com', 'aa', 'r', 'ABC', 'a', '', '123',
+                       'b', None, 5, b'abc', ['abc']]
+
+    def test_literal_prefix(self):
+        prefixes = ('abc', 'abd', 'ab.c', 'ab', '', 'xyz', '', '', '', '', '',
+                    '', 'ab', '', '')
+        for pattern, prefix in zip(self.PATTERNS, prefixes):
+            self.assertEqual(_literal_prefix(re.compile(pattern)), prefix)
+        self.assertEqual(_literal_prefix(re.compile('ab', re.I)), '')
+        self.assertEqual(_literal_prefix(re.compile(r'a\-b\d')), 'a-b')
+        self.assertEqual(_literal_prefix(re.compile('ab{2}')), 'a')
+
+    def test_build(self):
+        l = IndexedRuleList(self.rules)
+        self.assertEqual(len(l.indexes), 1)
+        index = list(l.indexes.values())[0]
+        self.assertTrue(isinstance(index, PatternIndex))
+        self.assertEqual(len(index.positions), len(self.PATTERNS) + 1)
+        self.assertEqual(len(l.unindexed), 1)
+
+    def test_consistent(self):
+        indexed, plain = IndexedRuleList(self.rules), RuleList(self.rules)
+        for v in self.values:
+            self.assertEqual(indexed.matches(v, 1), plain.matches(v, 1))
+            self.assertEqual(indexed.matches(v, 0), plain.matches(v, 0))
+
+    def test_candidates(self):
+        l = IndexedRuleList(self.rules)
+        c = l._candidates({'objects': ('abc',), 'extra': {}})
+        matched = [r for r in self.rules if r.match('abc', 1)]
+        self.assertTrue(set(matched) <= set(c))
+        self.assertTrue(len(c) < len(self.rules))
+        c = l._candidates({'objects': ('zzz',), 'extra': {}})
+        # Only the unindexed rule, the "match anything" pattern, and the
+        # patterns which can't be combined with the others (due to the
+        # backreference and the inline flag) remain.
+        self.assertEqual(len(c), 4)
+
+    def test_uncombinable(self):
+        rules = [R('object:0 like regex("(?P<x>a)")'),
+                 R('object:0 like regex("(?P<x>b)")')]
+        indexed, plain = IndexedRuleList(rules), RuleList(rules)
+        for v in ('a', 'b', 'c'):
+            self.assertEqual(indexed.matches(v), plain.matches(v))
+
+
+class TestSubstringIndex(TestCase):
+    KEYWORDS = ('fraud', 'he', 'she', 'his', 'hers', 'ushers', 'raud', 'a',
+                'fraud', '')
+
+    def setUp(self):
+        self.rules = [R('{} in object:0'.format(_json(k)), i)
+                      for i, k in enumerate(self.KEYWORDS)]
+        self.rules.append(R('"x" in object:0 AND object:1 bool'))
+        self.rules.append(R('"x" not in object:0'))
+        self.values = ['', 'fraud', 'ushers', 'this is fraudulent', 'sh',
+                       'ahishers', 'x', None, 5, b'fraud', ['he'], ('fraud',),
+                       {'fraud': 1}]
+
+    def test_automaton(self):
+        a = _Automaton((k, i) for i, k in enumerate(self.KEYWORDS) if k)
+        for text in self.values[:6]:
+            expected = {i for i, k in enumerate(self.KEYWORDS)
+                        if k and k in text}
+            self.assertEqual(set(a.search(text)), expected, text)
+
+    def test_build(self):
+        l = IndexedRuleList(self.rules)
+        self.assertEqual(len(l.indexes), 1)
+        index = list(l.indexes.values())[0]
+        self.assertTrue(isinstance(index, SubstringIndex))
+        self.assertEqual(len(l.unindexed), 1)
+        # Built lazily.
+        self.assertIs(index._automaton, None)
+        l.matches('abc')
+        automaton = index._automaton
+        self.assertTrue(isinstance(automaton, _Automaton))
+        l.matches('def')
+        self.assertIs(index._automaton, automaton)
+
+    def test_consistent(self):
+        indexed, plain = IndexedRuleList(self.rules), RuleList(self.rules)
+        for v in self.values:
+            self.assertEqual(indexed.matches(v, 1), plain.matches(v, 1))
+            self.assertEqual(indexed.matches(v, 0), plain.matches(v, 0))
+
+    def test_candidates(self):
+        l = IndexedRuleList(self.rules)
+        c = l._candidates({'objects': ('ushers',), 'extra': {}})
+        # he, she, hers, ushers, the empty string and the unindexed rule.
+        self.assertEqual(len(c), 6)
+        self.assertEqual(list(c), sorted(c, key=lambda r: r.weight))
+        c = l._candidates({'objects': (['he'],), 'extra': {}})
+        self.assertEqual(len(c), len(self.rules))
+
+
+def _json(s):
+    return json.dumps(s)
+
+
+class TestGuards(TestCase):
+    def test_guards(self):
+        self.assertEqual(len(list(guards(R('object:0 == 1')))), 1)
+        r = R('object:0 == 1 AND object:1 bool')
+        self.assertEqual(len(list(guards(r))), 2)
+        self.assertEqual(list(guards(R('object:0 == 1 OR object:1 bool'))), [])
+        self.assertEqual(list(guards(Dummy(True))), [])
+
+    def test_equality_guard(self):
+        g = lambda s: EqualityIndex.guard(parse_rule(s).children[0])
+        self.assertEqual(g('object:0 == 1'), (Selector(0, ()), (1,)))
+        self.assertEqual(g('1 == object:0'), (Selector(0, ()), (1,)))
+        self.assertEqual(g('object:0 in [1, 2]'), (Selector(0, ()), (1, 2)))
+        self.assertIs(g('object:0 in "abc"'), None)
+        self.assertIs(g('1 in object:0'), None)
+        self.assertIs(g('object:0 == object:1'), None)
+        self.assertIs(g('object:0 != 1'), None)
+        self.assertIs(g('object:0 not in [1]'), None)
+        self.assertIs(g('object:0 == [1]'), None)
+        self.assertIs(g('object:0 == nan'), None)
+        self.assertIs(g('1 == 1'), None)
+
+    def test_range_guard(self):
+        g = lambda s: RangeIndex.guard(parse_rule(s).children[0])
+        self.assertEqual(g('object:0 > 1'), (Selector(0, ()), ('>', 1)))
+        self.assertEqual(g('1 > object:0'), (Selector(0, ()), ('<', 1)))
+        self.assertEqual(g('1 <= object:0'), (Selector(0, ()), ('>=', 1)))
+        self.assertIs(g('object:0 > nan'), None)
+        self.assertIs(g('object:0 > [1]'), None)
+        self.assertIs(g('object:0 == 1'), None)
+        self.assertIs(g('NOT object:0 > 1'), None)
+
+    def test_pattern_guard(self):
+        g = lambda s: PatternIndex.guard(parse_rule(s).children[0])
+        self.assertEqual(g('object:0 like regex("a")'),
+                         (Selector(0, ()), re.compile('a')))
+        self.assertEqual(g('object:0 re regex("a")')[1], re.compile('a'))
+        self.assertIs(g('object:0 like object:1'), None)
+        self.assertIs(g('object:0 not like regex("a")'), None)
+        self.assertIs(g('regex("a") like object:0'), None)
+
+    def test_substring_guard(self):
+        g = lambda s: SubstringIndex.guard(parse_rule(s).children[0])
+        self.assertEqual(g('"a" in object:0'), (Selector(0, ()), 'a'))
+        self.assertIs(g('object:0 in "a"'), None)
+        self.assertIs(g('"a" not in object:0'), None)
+        self.assertIs(g('1 in object:0'), None)
+        self.assertIs(g('"a" == object:0'), None)
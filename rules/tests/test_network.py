@@ -0,0 +1,131 @@
+from django.test import TestCase
+
+from rules.cache import RuleCache, RuleList, RuleMutex
+from rules.core import Condition, Rule
+from rules.deferred import Selector
+from rules.context import RuleChecker
+from rules.network import AlphaNode, SharedNode, RuleNetwork
+from . import Dummy
+
+CALLS = []
+
+
+class CountingCondition(Condition):
+    OPERATOR_MAP = dict(Condition.OPERATOR_MAP)
+    OPERATOR_MAP['=='] = lambda l, r: CALLS.append((l, r)) or l == r
+
+
+class NetworkCache(RuleCache):
+    List = RuleNetwork
+
+
+class TestRuleNetwork(TestCase):
+    def setUp(self):
+        del CALLS[:]
+        self.rules = [
+            Rule('t', conditions='object:0.status == "closed"', weight=2),
+            Rule('t', conditions='object:0.status == "closed" AND '
+                                 'object:0.amount > 10'),
+            Rule('t', conditions='object:0.amount > 10 OR '
+                                 'NOT object:0.status == "closed"'),
+            Rule('t', conditions='object:0.status == "open"', weight=1),
+            Dummy(True, weight=3),
+        ]
+
+    def test_init(self):
+        n = RuleNetwork(self.rules)
+        self.assertEqual(tuple(n), tuple(RuleList(self.rules)))
+        self.assertEqual(len(n.alphas), 4)
+        shared = n.shared
+        self.assertEqual(len(shared), 2)
+        for alpha in shared:
+            self.assertTrue(isinstance(alpha, AlphaNode))
+        # The rules' own trees are left untouched.
+        self.assertTrue(isinstance(self.rules[0].conditions.children[0],
+                                   Condition))
+
+    def test_empty(self):
+        n = RuleNetwork()
+        self.assertEqual(len(n), 0)
+        self.assertEqual(n.matches(), [])
+
+    def test_matches(self):
+        n = RuleNetwork(self.rules)
+        l = RuleList(self.rules)
+        objects = ({'status': 'closed', 'amount': 5},
+                   {'status': 'closed', 'amount': 50},
+                   {'status': 'open', 'amount': 50},
+                   {'status': 'open'},
+                   None)
+        for obj in objects:
+            self.assertEqual(n.matches(obj), l.matches(obj))
+
+    def test_shared_evaluated_once(self):
+        kwargs = {'left': Selector(0, ('x',)), 'operator': '==',
+                  'right': Selector(('const', 1), ())}
+        conds = [CountingCondition.C(dict(kwargs)) for i in range(5)]
+        rules = [Rule('t', conditions=c) for c in conds]
+        n = RuleNetwork(rules)
+        self.assertEqual(len(n.alphas), 1)
+        self.assertEqual(len(n.matches({'x': 1})), 5)
+        self.assertEqual(len(CALLS), 1)
+        del CALLS[:]
+        self.assertEqual(len(RuleList(rules).matches({'x': 1})), 5)
+        self.assertEqual(len(CALLS), 5)
+
+    def test_shared_subtrees(self):
+        # Near-duplicates sharing everything but the first condition.
+        common = ('(object:0.status == "closed" OR object:0.x == 1) AND '
+                  'object:0.amount > 10')
+        rules = [Rule('t', conditions='object:0.tenant == {} AND ({})'
+                      .format(i, common)) for i in range(4)]
+        rules.append(Rule('t', conditions=common, weight=1))
+        n = RuleNetwork(rules)
+        self.assertEqual(len(n.subtrees), 1)
+        shared = list(n.subtrees.values())[0]
+        self.assertTrue(isinstance(shared, SharedNode))
+        self.assertEqual(len(shared.rules), 5)
+        info = {'objects': ({'tenant': 2, 'status': 'closed', 'amount': 50},),
+                'extra': {}}
+        self.assertEqual(n._matches(info), [rules[2], rules[4]])
+        self.assertIs(info[shared], True)
+        for obj in ({'tenant': 1, 'status': 'open', 'x': 1, 'amount': 5},
+                    {'tenant': 3, 'amount': 50, 'x': 1}, None):
+            self.assertEqual(n.matches(obj), RuleList(rules).matches(obj))
+
+    def test_subtree_evaluated_once(self):
+        kwargs = {'left': Selector(0, ('x',)), 'operator': '==',
+                  'right': Selector(('const', 1), ())}
+        d = Dummy(True)
+        tree = lambda: CountingCondition.C(dict(kwargs), d)
+        rules = [Rule('t', conditions=tree()) for i in range(3)]
+        rules.append(Rule('t', conditions=Condition.Node(
+            [Dummy(False), tree()], 'OR')))
+        n = RuleNetwork(rules)
+        self.assertEqual(len(n.subtrees), 1)
+        self.assertEqual(len(n.matches({'x': 1})), 4)
+        self.assertEqual(len(CALLS), 1)
+
+    def test_checker(self):
+        c = NetworkCache(None)
+        c['t'] = [Rule('t', conditions='object:0.a == 1 AND object:0.b bool'),
+                  Rule('t', conditions='object:0.a == 1 AND object:0.b bool '
+                                       'AND object:0.c bool')]
+        with RuleChecker(cache=c) as checker:
+            self.assertEqual(len(checker.check('t', {'a': 1, 'b': 1})), 1)
+            self.assertEqual(len(checker.check('t', {'a': 1, 'b': 1,
+                                                      'c': 1})), 2)
+
+    def test_mutex(self):
+        m = RuleMutex(self.rules[:2])
+        n = RuleNetwork([m, self.rules[3]])
+        self.assertEqual(n.matches({'status': 'closed', 'amount': 50}),
+                         [self.rules[1]])
+
+    def test_cache(self):
+        c = NetworkCache(None)
+        c['t'] = self.rules
+        self.assertTrue(isinstance(c['t'], RuleNetwork))
+        c['u'] = self.rules[0]
+        self.assertTrue(isinstance(c['u'], RuleNetwork))
+        self.assertTrue(isinstance(RuleCache(None).List(), RuleList))
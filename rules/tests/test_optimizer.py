@@ -0,0 +1,133 @@
+from django.test import TestCase
+
+from rules.cache import RuleList, RuleMutex
+from rules.core import AND, OR, ConditionNode, Condition, Rule
+from rules.formatter import format_rule
+from rules.optimizer import Unsatisfiable, optimize
+from rules.parser import parse_rule
+from . import Dummy
+from .test_compile import RULES, _objects
+
+EQUIVALENT = (
+    '1 == 1 AND object:0.a == 1',
+    '1 == 2 OR object:0.a == 1',
+    'len([1, 2]) > 1 AND NOT "a" in "abc" OR object:0.a == 1',
+    'object:0.a == 1 AND object:0.a == 1',
+    'object:0.a == 1 AND (object:0.b == 2 OR object:0.a == 1)',
+    'object:0.a == 1 OR (object:0.a == 1 AND object:0.b == 2)',
+    '(object:0.a == 1 AND object:0.a == 2) OR object:0.b == 2',
+    '(object:0.a == 1 AND (object:0.b == 2 AND object:0.c bool))',
+    '(object:0.a == 1 OR object:0.b == 2) AND (object:0.b == 2 OR '
+    'object:0.a == 1)',
+)
+
+UNSATISFIABLE = (
+    '1 == 2',
+    '1 == 2 AND object:0.a == 1',
+    'object:0.a == 1 AND object:0.a == 2',
+    'object:0.a == 1 AND object:0.a in [2, 3]',
+    'object:0.a in [1, 2] AND object:0.b bool AND object:0.a in [3, 4]',
+    '3 == object:0.a AND object:0.a == 1',
+    'object:0.a == 1 AND NOT object:0.a == 1',
+    '(object:0.a == 1 AND object:0.a == 2) OR 1 > 2',
+)
+
+SATISFIABLE = (
+    'object:0.a == 1 AND object:0.a in [1, 2]',
+    'object:0.a == 1 AND object:0.a == 1.0',
+    'object:0.a == 1 AND object:0.b == 2',
+    'object:0.a == 1 OR object:0.a == 2',
+    'object:0.a == 1 OR NOT object:0.a == 1',
+    'object:0.a != 1 AND object:0.a != 2',
+    'object:0.a == [1] AND object:0.a == [2]',
+)
+
+
+class TestOptimize(TestCase):
+    def assertEquivalent(self, tree, optimized):
+        for objects, extra in _objects():
+            expected = tree._evaluate({'objects': objects, 'extra': extra})
+            actual = optimized._evaluate({'objects': objects, 'extra': extra})
+            self.assertIs(actual, expected, '{} with {!r}'.format(tree,
+                                                                 objects))
+
+    def test_equivalent(self):
+        for string in RULES + EQUIVALENT + SATISFIABLE:
+            tree = parse_rule(string)
+            optimized = optimize(tree)
+            self.assertTrue(isinstance(optimized, ConditionNode))
+            self.assertFalse(isinstance(optimized, Unsatisfiable), string)
+            self.assertEquivalent(tree, optimized)
+            self.assertEquivalent(tree, optimize(optimized))
+        # The original is left alone.
+        tree = parse_rule(EQUIVALENT[0])
+        optimize(tree)
+        self.assertEqual(len(tree.children), 2)
+
+    def test_unsatisfiable(self):
+        for string in UNSATISFIABLE:
+            tree = parse_rule(string)
+            optimized = optimize(tree)
+            self.assertTrue(isinstance(optimized, Unsatisfiable), string)
+            self.assertEquivalent(tree, optimized)
+
+    def test_simplified(self):
+        cases = (
+            (EQUIVALENT[0], 'object:0.a == 1'),
+            (EQUIVALENT[1], 'object:0.a == 1'),
+            (EQUIVALENT[2], 'object:0.a == 1'),
+            (EQUIVALENT[3], 'object:0.a == 1'),
+            (EQUIVALENT[4], 'object:0.a == 1'),
+            (EQUIVALENT[5], 'object:0.a == 1'),
+            (EQUIVALENT[6], 'object:0.b == 2'),
+            (EQUIVALENT[7], 'object:0.a == 1 AND object:0.b == 2 AND '
+                            'object:0.c bool'),
+            (EQUIVALENT[8], 'object:0.a == 1 OR object:0.b == 2'),
+        )
+        for string, expected in cases:
+            self.assertEqual(format_rule(optimize(parse_rule(string))),
+                             format_rule(parse_rule(expected)))
+
+    def test_constant(self):
+        self.assertEqual(optimize(parse_rule('1 == 1')).children, [])
+        self.assertEqual(optimize(parse_rule('1 == 1')).connector, AND)
+        self.assertEqual(optimize(parse_rule('')).children, [])
+        # Errors while evaluating are left until the rule is checked.
+        self.assertEqual(len(optimize(parse_rule('min() bool')).children), 1)
+
+    def test_other_children(self):
+        d = Dummy(False)
+        tree = ConditionNode([d, ConditionNode([d, Dummy(True)], OR)])
+        optimized = optimize(tree)
+        self.assertEqual(len(optimized.children), 2)
+        self.assertIs(optimize(d), d)
+
+    def test_subclasses(self):
+        class Node(ConditionNode):
+            pass
+        tree = Node([parse_rule('1 == 1').children[0]])
+        self.assertIs(optimize(tree), tree)
+
+
+class TestRules(TestCase):
+    def test_build_tree(self):
+        r = Rule('t', conditions='1 == 1 AND object:0 == 1')
+        self.assertTrue(isinstance(r.conditions.children[0], Condition))
+        self.assertEqual(len(r.conditions.children), 1)
+        r = Rule('t', conditions=UNSATISFIABLE[2])
+        self.assertTrue(isinstance(r.conditions, Unsatisfiable))
+        self.assertFalse(r.match({'a': 1}))
+        # Trees given directly are used as they are.
+        tree = parse_rule(UNSATISFIABLE[2])
+        self.assertIs(Rule('t', conditions=tree).conditions, tree)
+
+    def test_rule_lists(self):
+        rules = [Rule('t', conditions=UNSATISFIABLE[1]),
+                 Rule('t', conditions='object:0 == 1'),
+                 Rule('t'),
+                 Dummy(True)]
+        for cls in (RuleList, RuleMutex):
+            l = cls(rules)
+            self.assertEqual(len(l), 3)
+            self.assertNotIn(rules[0], l)
+        self.assertEqual(len(RuleList(rules[:1])), 0)
@@ -1,6 +1,9 @@
 import datetime
+import os
+import threading
 from collections import OrderedDict
-from django.test import TestCase
+from django.conf import settings
+from django.test import TestCase, override_settings
 from django.contrib.contenttypes.models import ContentType as CT
 
 from madlibs.parser import parseloop
@@ -8,7 +11,7 @@ from rules.parser import (
     parse_number, parse_const, parse_string, parse_array, parse_object,
     parse_function, parse_selector, _parse_selector_chain, parse_value,
     parse_deferred, parse_deferred_list, parse_operator, parse_condition,
-    parse_tree, parse_rule
+    parse_tree, parse_rule, parse_many, parse_executor
 )
 from rules.deferred import *
 from rules.core import *
@@ -712,8 +715,13 @@ class TestParseConditionTree(TestCase):
 
 
 class TestParseRule(TestCase):
+    parser = 'madlibs'
+
+    def p(self, string):
+        return parse_rule(string, self.parser)
+
     def test_collapse(self):
-        d = parse_rule('    NOT (object:0 bool AND min() bool)    ')
+        d = self.p('    NOT (object:0 bool AND min() bool)    ')
         self.assertEqual(len(d), 2)
         self.assertFalse(d.negated)
         self.assertEqual(d.connector, 'OR')
@@ -721,10 +729,125 @@ class TestParseRule(TestCase):
         self.assertTrue(d.children[1].negated)
 
     def test_deferred_list(self):
-        self.assertRaises(ValueError, parse_rule, 'with() ()')
-        d = parse_rule(' with( object:0 )  ')
+        self.assertRaises(ValueError, self.p, 'with() ()')
+        d = self.p(' with( object:0 )  ')
         self.assertEqual(len(d), 0)
-        d = parse_rule(r'with(object:0) \0 bool AND \0 bool AND \0.0 bool')
+        d = self.p(r'with(object:0) \0 bool AND \0 bool AND \0.0 bool')
         self.assertEqual(len(d), 3)
         self.assertIs(d.children[0].left, d.children[1].left)
         self.assertIs(d.children[0].left, d.children[2].left.stype)
+
+
+RULES = (
+    'object:0 == 1',
+    '  NOT (object:0.a.b == "x" OR object:1.c:{"d":[1,2.5]};.e < 2)  ',
+    r'with(object:0.a,len(\0)) \1 > 2 AND \0 in [1,2,3] AND extra.x:"y"; '
+    'exists',
+    r'with(extra.a:[1,{"b":object:0}], max(\0, 1)) \1.x:\0; bool',
+    'object:0 == null OR object:0 == true OR object:0 != -Infinity',
+    'object:0 like regex("^a") AND object:0.x not like regex("b")',
+    'object:0 in const:[1,[2]] OR object:0 == const:{"a":1}',
+    'object:0.d == 2014-01-02 OR object:0.w == 2014-01-02T03:04:05.12 '
+    'OR object:0.t == 03:04:05',
+    'sum([1, 2]) == 3 AND (object:0 bool OR (object:1 bool AND ()))',
+    'model:contenttypes.contenttype.objects.count; > 0',
+    'NOT NOT object:0.-1 does not exist',
+    '',
+)
+
+BAD_RULES = (
+    'with() ()', 'object:0 ==', 'object:0 == AND ()', '(object:0 bool',
+    'object:0 bool AND x', r'\0 bool', '[min()] bool', 'object:0bool',
+    'object:0 == [1,]', 'object:0 == {"a" 1}', 'object:0 == "x',
+    'model:x bool', 'const:x bool', 'object:0.a: bool', 'NOT(object:0 bool)',
+)
+
+
+class TestDescentParser(TestParseRule):
+    parser = 'descent'
+
+    def test_same(self):
+        for string in RULES:
+            tree = parse_rule(string, 'madlibs')
+            self.assertEqual(self.p(string), tree, string)
+        for string in BAD_RULES:
+            self.assertRaises(ValueError, parse_rule, string, 'madlibs')
+            self.assertRaises(ValueError, self.p, string)
+
+
+def _parser_name(string):
+    return settings.RULES_PARSER
+
+
+class TestParseMany(TestCase):
+    def _parse_many(self, *args, **kwargs):
+        # Hanging would be a failure too.
+        results = []
+
+        def run():
+            try:
+                results.append((True, parse_many(*args, **kwargs)))
+            except Exception as e:
+                results.append((False, e))
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(60)
+        self.assertEqual(len(results), 1, 'parse_many timed out')
+        ok, result = results[0]
+        if not ok:
+            raise result
+        return result
+
+    def test_parse_many(self):
+        strings = [s for s in RULES if not s.startswith('model:')] * 3
+        expected = [parse_rule(s) for s in strings]
+        self.assertEqual(parse_many(strings, 1), expected)
+        # Pickled trees back from other processes.
+        self.assertEqual(self._parse_many(strings, 2, chunksize=4), expected)
+
+    def test_in_process(self):
+        strings = ['object:0 bool', 'object:1 bool'] * 3
+        expected = [parse_rule(s) for s in strings]
+        # A lambda can't be sent to other processes.
+        parse = lambda s: parse_rule(s)
+        for workers in (1, 0, -1):
+            self.assertEqual(parse_many(strings, workers, 2, parse), expected)
+
+    def test_executor(self):
+        strings = ['object:0 bool', 'object:1 bool'] * 3
+        expected = [parse_rule(s) for s in strings]
+        executor = parse_executor(2)
+        try:
+            for i in range(2):
+                # Left running for the next batch.
+                self.assertEqual(self._parse_many(strings, chunksize=2,
+                                                  executor=executor),
+                                 expected)
+        finally:
+            executor.shutdown()
+
+    def test_settings(self):
+        with override_settings(RULES_PARSER='madlibs'):
+            self.assertEqual(
+                self._parse_many(['x'] * 4, 2, 1, _parser_name),
+                ['madlibs'] * 4)
+
+    def test_workers_fail(self):
+        # As if Django were set up with settings.configure().
+        strings = ['object:0 bool', 'object:1 bool'] * 3
+        expected = [parse_rule(s) for s in strings]
+        old = os.environ['DJANGO_SETTINGS_MODULE']
+        os.environ['DJANGO_SETTINGS_MODULE'] = 'no.such.settings'
+        try:
+            self.assertEqual(self._parse_many(strings, 2, 2), expected)
+        finally:
+            os.environ['DJANGO_SETTINGS_MODULE'] = old
+
+    def test_errors(self):
+        strings = ['object:0 bool', 'object:0 ==', 'object:1 bool']
+        self.assertRaises(ValueError, self._parse_many, strings, 2, 1)
+        results = self._parse_many(strings, 2, 1, return_exceptions=True)
+        self.assertEqual(results[0], parse_rule(strings[0]))
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2], parse_rule(strings[2]))
@@ -0,0 +1,100 @@
+import datetime
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from rules.cache import RuleList
+from rules.models import Rule, RuleGuard
+from rules.percolator import (Percolator, _encode, rebuild_guards,
+                              update_guards)
+
+TREES = (
+    'object:0.status == "open" AND object:0.amount > 10',
+    'object:0.status in ["closed", "void"]',
+    'object:0.amount >= 100 AND object:0.status bool',
+    '1000 > object:0.amount',
+    'object:0.kind == 2 OR object:0.kind == 3',
+    'object:0.name like regex("a")',
+    'object:0.flag == true AND object:0.status != "open"',
+    'extra.user == "bob" AND object:0.amount < 0',
+    'object:0.missing.x == 1',
+)
+
+OBJECTS = (
+    {'status': 'open', 'amount': 50, 'kind': 2, 'name': 'abc'},
+    {'status': 'closed', 'amount': 150, 'flag': 1},
+    {'status': 'void', 'amount': 5000.5, 'kind': 3},
+    {'status': None, 'amount': -1, 'name': 'x'},
+    {'status': ['open'], 'amount': 'lots', 'flag': True},
+    {},
+)
+
+
+@override_settings(RULES_PERCOLATOR=True)
+class TestPercolator(TestCase):
+    def setUp(self):
+        self.rules = [Rule.objects.create(trigger='t', tree=tree, weight=i)
+                      for i, tree in enumerate(TREES)]
+        Rule.objects.create(trigger='u', tree=TREES[1])
+        self.percolator = Percolator(Rule.objects.all())
+
+    def test_guards(self):
+        guards = RuleGuard.objects.filter(rule=self.rules[1])
+        self.assertEqual(sorted(g.value for g in guards),
+                         ['s:closed', 's:void'])
+        guard = RuleGuard.objects.get(rule=self.rules[3])
+        self.assertEqual((guard.operator, guard.number), ('<', 1000))
+        guard = RuleGuard.objects.get(rule=self.rules[6])
+        self.assertEqual((guard.operator, guard.value), ('==', 'n:1'))
+        for i in (4, 5):
+            self.assertFalse(RuleGuard.objects.filter(rule=self.rules[i]))
+        # Updated along with the rule, and deleted with it.
+        rule = self.rules[1]
+        rule.conditions = 'object:0.kind == 4'
+        rule.save()
+        self.assertEqual([g.value for g in rule.guards.all()], ['n:4'])
+        rule.delete()
+        self.assertFalse(RuleGuard.objects.filter(rule_id=rule.pk))
+
+    def test_candidates(self):
+        # The guards' paths are loaded once.
+        self.percolator.paths(self.percolator._expandkey('t'))
+        for obj in OBJECTS:
+            with self.assertNumQueries(1):
+                candidates = list(self.percolator.candidates('t', obj,
+                                                             user='bob'))
+            self.assertTrue(all(r.trigger == 't' for r in candidates))
+            all_rules = RuleList(self.rules)
+            expected = all_rules.matches(obj, user='bob')
+            self.assertTrue(set(expected) <= set(candidates), obj)
+            self.assertEqual(self.percolator.matches('t', obj, user='bob'),
+                             expected)
+        names = lambda rules: sorted(r.tree for r in rules)
+        candidates = self.percolator.candidates('t', OBJECTS[0])
+        self.assertEqual(names(candidates), names(
+            self.rules[i] for i in (0, 3, 4, 5)))
+
+    def test_unknown_paths(self):
+        with override_settings(RULES_PERCOLATOR=False):
+            rule = Rule.objects.create(trigger='t', tree='object:0.new == 1')
+        update_guards(rule)
+        self.percolator.paths(self.percolator._expandkey('t'))
+        # Saved elsewhere, so this process doesn't know about the path.
+        RuleGuard.objects.filter(rule=rule).update(path='object:0.newer')
+        self.assertIn(rule, self.percolator.candidates('t', {}))
+
+    def test_rebuild(self):
+        RuleGuard.objects.all().delete()
+        rebuild_guards(Rule.objects.filter(trigger='t'))
+        self.assertEqual(RuleGuard.objects.values('rule').distinct().count(),
+                         len(TREES) - 2)
+
+    def test_encode(self):
+        self.assertEqual(_encode(1), _encode(1.0))
+        self.assertEqual(_encode(True), _encode(1))
+        self.assertNotEqual(_encode(1), _encode('1'))
+        self.assertNotEqual(_encode(1.5), _encode(1))
+        self.assertEqual(_encode(datetime.date(2020, 1, 2)), 'd:2020-01-02')
+        self.assertIsNone(_encode(float('nan')))
+        self.assertIsNone(_encode([1]))
+        self.assertIsNone(_encode('x' * 300))
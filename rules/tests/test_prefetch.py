@@ -0,0 +1,100 @@
+from django.contrib.auth.models import Permission, User
+from django.contrib.contenttypes.models import ContentType
+from django.test import TestCase
+
+from rules.cache import RuleCache, RuleList
+from rules.context import RuleChecker
+from rules.core import Rule
+from rules.prefetch import PrefetchPlanner
+
+RULES = (
+    'object:0.content_type.app_label == "auth" AND object:0.codename bool',
+    'object:0.content_type.model != "user" OR object:0.missing.x bool',
+    'object:0.user_permissions.all exists',
+    'object:0.groups.all exists OR object:0.username == "x"',
+    'object:0.permission_set.all exists',
+    'object:1.content_type bool',
+)
+
+
+class TestPlanner(TestCase):
+    def setUp(self):
+        self.planner = PrefetchPlanner([Rule('t', conditions=s)
+                                        for s in RULES])
+
+    def test_plan(self):
+        plan = self.planner.plan(Permission)
+        self.assertEqual(plan.select_related, ('content_type',))
+        self.assertEqual(plan.prefetch_related, ())
+        self.assertIs(self.planner.plan(Permission), plan)
+        plan = self.planner.plan(User)
+        self.assertEqual(plan.select_related, ())
+        self.assertEqual(plan.prefetch_related,
+                         ('groups', 'user_permissions'))
+        plan = self.planner.plan(ContentType)
+        self.assertEqual(plan.prefetch_related, ('permission_set',))
+        self.assertEqual(plan.attributes, ('permission_set',))
+        self.assertTrue(plan)
+        self.assertFalse(self.planner.plan(ContentType, 1))
+        self.assertTrue(self.planner.plan(Permission, 1))
+
+    def test_queryset(self):
+        perms = self.planner.queryset(Permission.objects.all())
+        with self.assertNumQueries(1):
+            self.assertTrue(all(p.content_type.app_label for p in perms))
+        types = self.planner.queryset(ContentType.objects.all())
+        with self.assertNumQueries(2):
+            self.assertTrue(any(t.permission_set.all() for t in types))
+
+    def test_prefetch(self):
+        perms = list(Permission.objects.all())
+        items = [(p,) for p in perms] + [(), (None, perms[0])]
+        with self.assertNumQueries(1):
+            self.planner.prefetch(items)
+        with self.assertNumQueries(0):
+            for p in perms:
+                p.content_type.model
+
+
+class TestCaching(TestCase):
+    def test_planner(self):
+        cache = RuleCache(None)
+        cache['t'] = [Rule('t', conditions=RULES[0])]
+        planner = cache.planner('t')
+        self.assertIs(cache.planner('t'), planner)
+        self.assertIs(planner.rules, cache['t'])
+        cache['t'] = [Rule('t', conditions=RULES[2])]
+        self.assertIsNot(cache.planner('t'), planner)
+        self.assertEqual(cache.planner('t').lookups,
+                         {0: {'user_permissions__all'}})
+        del cache['t']
+        self.assertNotIn('t', cache.planners)
+        cache['t'] = []
+        cache.planner('t')
+        cache.clear()
+        self.assertEqual(cache.planners, {})
+
+    def test_checker(self):
+        cache = RuleCache(None)
+        cache['t'] = [Rule('t', conditions=RULES[0])]
+        perm = Permission.objects.get(codename='add_user')
+        with RuleChecker(cache=cache, prefetch=True) as checker:
+            self.assertEqual(len(checker.check('t', perm)), 1)
+            self.assertNotIn('prefetch', checker.context)
+        self.assertTrue(Permission.content_type.is_cached(perm))
+
+    def test_checker_caches(self):
+        perm = Permission.objects.get(codename='add_user')
+        rules = RuleList([Rule('t', conditions=RULES[0])])
+        # Caches without planners get one each time.
+        with RuleChecker(cache={'t': rules}, prefetch=True) as checker:
+            self.assertEqual(len(checker.check('t', perm)), 1)
+
+        class Cache(RuleCache):
+            def planner(self, key):
+                raise AttributeError('broken')
+        cache = Cache(None)
+        cache['t'] = rules
+        # Errors in the planner aren't mistaken for there being none.
+        with RuleChecker(cache=cache, prefetch=True) as checker:
+            self.assertRaises(AttributeError, checker.check, 't', perm)
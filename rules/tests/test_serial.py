@@ -0,0 +1,201 @@
+import datetime
+import decimal
+import pickle
+from unittest import SkipTest
+
+from django.core.management import call_command
+from django.test import TestCase
+from six import StringIO
+
+from rules.conf import settings
+from rules.core import Condition, ConditionNode, Rule as CoreRule
+from rules.deferred import Selector
+from rules.formatter import format_rule
+from rules.models import Rule
+from rules.optimizer import Unsatisfiable, optimize
+from rules.parser import parse_rule
+from rules.serial import (VERSION, dump_rules, dumps, is_current, load_rules,
+                          loads)
+from rules.trees import TreeCache, _build
+from . import Dummy
+
+TREES = (
+    'object:0 == 1',
+    'NOT object:0.a.b == "x" OR object:1.c:{"d":[1,2.5]};.e < 2',
+    'with(object:0.a,len(\\0)) \\1 > 2 AND \\0 in [1,2,3] AND '
+    'extra.x:"y"; exists',
+    'object:0 == null OR object:0 == true OR object:0 != 1e100',
+    'object:0 like regex("^a")',
+    'object:0 in const:[1,[2]] OR object:0 == const:{"a":1}',
+    'object:0.day == 2014-01-02 OR object:0.when == 2014-01-02T03:04:05 '
+    'OR object:0.at == 03:04:05',
+    'sum([1, 2]) == 3',
+)
+
+
+class TestSerial(TestCase):
+    def test_round_trip(self):
+        for string in TREES:
+            tree = parse_rule(string)
+            loaded = loads(dumps(tree, string), string)
+            self.assertEqual(loaded, tree, string)
+            self.assertEqual(format_rule(loaded), format_rule(tree))
+
+    def test_shared(self):
+        string = format_rule(parse_rule('object:0.a == 1 OR object:0.a == 2'))
+        tree = loads(dumps(parse_rule(string), string), string)
+        self.assertIs(tree.children[0].left, tree.children[1].left)
+
+    def test_values(self):
+        values = (datetime.datetime(2014, 1, 2, 3, 4, 5, 6),
+                  datetime.date(2014, 1, 2), datetime.time(3, 4, 5),
+                  decimal.Decimal('1.5'), (1, [2]), {'a': set([1])})
+        for value in values[:-1]:
+            tree = ConditionNode([Condition(Selector(('const', value), ()),
+                                            '==', Selector(0, ()))])
+            self.assertEqual(loads(dumps(tree, ''), ''), tree)
+        tree = ConditionNode([Condition(Selector(('const', values[-1]), ()),
+                                        'bool')])
+        self.assertRaises(TypeError, dumps, tree, '')
+        self.assertRaises(TypeError, dumps, ConditionNode([Dummy(True)]), '')
+
+    def test_unsatisfiable(self):
+        self.assertIsInstance(loads(dumps(Unsatisfiable(), 'x'), 'x'),
+                              Unsatisfiable)
+
+    def test_stale(self):
+        data = dumps(parse_rule(TREES[0]), TREES[0])
+        self.assertTrue(is_current(data, TREES[0]))
+        self.assertFalse(is_current(data, TREES[1]))
+        self.assertRaises(ValueError, loads, data, TREES[1])
+        old = data[:2] + bytearray([VERSION + 1]) + data[3:]
+        self.assertFalse(is_current(bytes(old), TREES[0]))
+        self.assertRaises(ValueError, loads, data[:-3], TREES[0])
+        self.assertFalse(is_current(b'', TREES[0]))
+        self.assertFalse(is_current(None, TREES[0]))
+
+
+class TestRuleModel(TestCase):
+    def setUp(self):
+        if not settings.RULES_SERIALIZED_TREES:
+            raise SkipTest
+        TreeCache.default.clear()
+
+    def tearDown(self):
+        TreeCache.default.clear()
+
+    def test_setter(self):
+        rule = Rule(trigger='t', description='d')
+        rule.conditions = 'object:0.a == 1'
+        self.assertTrue(is_current(rule.serialized_tree, rule.tree))
+        rule.conditions = parse_rule('object:0.a == 2')
+        self.assertTrue(is_current(rule.serialized_tree, rule.tree))
+        self.assertEqual(loads(rule.serialized_tree, rule.tree),
+                         rule.conditions)
+
+    def test_unsatisfiable(self):
+        rule = Rule(trigger='t', description='d')
+        rule.conditions = 'object:0.a == 1 AND object:0.a == 2'
+        self.assertEqual(rule.tree, 'object:0.a == 1 AND object:0.a == 2')
+        rule.conditions = optimize(parse_rule(rule.tree))
+        self.assertIsInstance(_build(rule.tree), Unsatisfiable)
+        self.assertTrue(is_current(rule.serialized_tree, rule.tree))
+
+    def test_load(self):
+        rule = Rule(trigger='t', description='d')
+        rule.conditions = 'object:0.a == 1'
+        rule.save()
+        TreeCache.default.clear()
+        loaded = Rule.objects.get(pk=rule.pk)
+        build = TreeCache.default.build
+        TreeCache.default.build = None
+        try:
+            # Not parsed.
+            self.assertEqual(loaded.conditions,
+                             parse_rule('object:0.a == 1'))
+        finally:
+            TreeCache.default.build = build
+        self.assertTrue(loaded.conditions.frozen)
+        # Changed without the setter, so the data is stale.
+        Rule.objects.filter(pk=rule.pk).update(tree='object:0.a == 2')
+        TreeCache.default.clear()
+        loaded = Rule.objects.get(pk=rule.pk)
+        self.assertEqual(loaded.conditions, parse_rule('object:0.a == 2'))
+
+    def test_pickle(self):
+        rule = Rule.objects.create(trigger='t', description='d')
+        rule.conditions = 'object:0.a == 1'
+        rule.save()
+        rule.compile()
+        data = pickle.dumps(rule)
+        TreeCache.default.clear()
+        build = TreeCache.default.build
+        TreeCache.default.build = None
+        try:
+            # Not parsed.
+            loaded = pickle.loads(data)
+        finally:
+            TreeCache.default.build = build
+        # Shared through the tree cache, and compiled again.
+        self.assertTrue(loaded.conditions.frozen)
+        self.assertIs(pickle.loads(data).conditions, loaded.conditions)
+        self.assertEqual(loaded.conditions, rule.conditions)
+        self.assertIs(loaded._compiled[0], loaded.conditions)
+        self.assertEqual(loaded.pk, rule.pk)
+        # Trees that could have been changed go with the rule.
+        rule.conditions = parse_rule('object:0.a == 2')
+        loaded = pickle.loads(pickle.dumps(rule))
+        self.assertEqual(loaded.conditions, rule.conditions)
+        self.assertIsNot(loaded.conditions, rule.conditions)
+
+    def test_snapshot(self):
+        rule = Rule.objects.create(trigger='t', description='d',
+                                   value={'a': [1, 2.5]})
+        rule.conditions = 'object:0.a == 1'
+        rule.save()
+        s = Selector(0, ('b',))
+        core = CoreRule('u', conditions=ConditionNode([Condition(s, 'bool')]),
+                        continuation='c', value=s, weight=2)
+        data = dump_rules([rule, core])
+        TreeCache.default.clear()
+        build = TreeCache.default.build
+        TreeCache.default.build = None
+        try:
+            # Not parsed.
+            loaded, loaded_core = load_rules(data)
+        finally:
+            TreeCache.default.build = build
+        self.assertEqual((loaded.pk, loaded.value, loaded.tree),
+                         (rule.pk, {'a': [1, 2.5]}, rule.tree))
+        self.assertTrue(loaded.conditions.frozen)
+        self.assertFalse(loaded._state.adding)
+        self.assertEqual(loaded_core.conditions, core.conditions)
+        self.assertIs(loaded_core.conditions.children[0].left,
+                      loaded_core.value)
+        self.assertEqual((loaded_core.trigger, loaded_core.continuation,
+                          loaded_core.weight), ('u', 'c', 2))
+        self.assertFalse(hasattr(load_rules(dump_rules([CoreRule('u')]))[0],
+                                 'weight'))
+        # Model rules with unusual trees are parsed instead.
+        rule._tree = ConditionNode([Dummy(True)])
+        self.assertEqual(load_rules(dump_rules([rule]))[0].tree, rule.tree)
+        self.assertRaises(TypeError, dump_rules, [CoreRule('u', conditions=
+                                                  ConditionNode([Dummy(1)]))])
+        old = data[:2] + bytearray([VERSION + 1]) + data[3:]
+        self.assertRaises(ValueError, load_rules, bytes(old))
+        self.assertRaises(ValueError, load_rules, data[:-3])
+
+    def test_command(self):
+        rule = Rule.objects.create(trigger='t', description='d',
+                                   tree='object:0 == 1')
+        Rule.objects.create(trigger='t', description='d', tree='object:0 ==')
+        out = StringIO()
+        call_command('serialize_rule_trees', stdout=out)
+        self.assertIn('Serialized 1 rules (1 can only be parsed)',
+                      out.getvalue())
+        rule = Rule.objects.get(pk=rule.pk)
+        self.assertTrue(is_current(rule.serialized_tree, rule.tree))
+        out = StringIO()
+        call_command('serialize_rule_trees', stdout=out)
+        self.assertIn('Serialized 0 rules (1 can only be parsed)',
+                      out.getvalue())
@@ -0,0 +1,137 @@
+from django.contrib.auth.models import Group, Permission, User
+from django.test import TestCase
+
+from rules.core import Rule
+from rules.models import Rule as RuleModel, RuleSet
+from rules.parser import parse_rule
+from rules.sql import filter_queryset, translate
+
+EXACT = (
+    'object:0.username == "alice"',
+    'object:0.username != "alice"',
+    'NOT object:0.username in ["alice", "bob"]',
+    'object:0.is_staff bool',
+    'NOT object:0.first_name bool',
+    'object:0.last_login does not exist',
+    'object:0.id > 1 AND object:0.id <= 3',
+    '2 < object:0.id OR object:0.is_staff bool',
+    'object:0.username == extra.name',
+    'object:0.username in []',
+    '1 == 2 OR object:0.username == "bob"',
+)
+
+INEXACT = (
+    '"li" in object:0.username',
+    'object:0.username == "alice" OR len(object:0.username) == 3',
+    'object:0.is_staff bool AND len(object:0.first_name) > 3',
+    'object:0.id == "1"',
+    'object:0.missing == 1',
+    'object:0.username like regex("(?i)ALICE")',
+    'object:0.username like regex("a.*e")',
+    'object:0.username re regex("b")',
+    'NOT object:0.username like regex("c")',
+    # Python-only syntax, which only the prefix is taken from.
+    'object:0.username like regex("ca(?=r)\\\\w+")',
+    'object:0.username like regex("(?P<x>d)a\\\\D")',
+    'object:0.username == extra.missing.name',
+)
+
+RELATED = (
+    'object:0.content_type.app_label == "auth"',
+    'NOT object:0.content_type.model == "user"',
+    'object:0.content_type.model != "user"',
+    'object:0.content_type_id > 1',
+)
+
+
+class TestFilterQueryset(TestCase):
+    def setUp(self):
+        User.objects.create(username='alice', first_name='Alice',
+                            is_staff=True)
+        User.objects.create(username='bob', first_name='')
+        User.objects.create(username='carol', first_name='Carol')
+        User.objects.create(username='dave', first_name='Dave',
+                            last_login='2020-01-01 00:00')
+
+    def assertSame(self, rule, queryset, exact, **extra):
+        q, residual = translate(rule.conditions, queryset.model, **extra)
+        self.assertIs(residual is None, exact, str(rule.conditions))
+        expected = [o.pk for o in queryset if rule.match(o, **extra)]
+        actual = rule.filter_queryset(queryset, **extra)
+        self.assertEqual(sorted(o.pk for o in actual), sorted(expected),
+                         str(rule.conditions))
+
+    def test_users(self):
+        for string in EXACT:
+            self.assertSame(Rule('t', conditions=parse_rule(string)),
+                            User.objects.all(), True, name='carol')
+        for string in INEXACT:
+            self.assertSame(Rule('t', conditions=parse_rule(string)),
+                            User.objects.all(), False, name='carol')
+
+    def test_related(self):
+        for string in RELATED:
+            self.assertSame(Rule('t', conditions=parse_rule(string)),
+                            Permission.objects.all(), True)
+        self.assertSame(Rule('t', conditions=parse_rule(
+            'object:0.content_type_id > 1 AND '
+            'object:0.codename like regex("add")')),
+            Permission.objects.all(), False)
+
+    def test_regex_prefix(self):
+        tree = parse_rule('object:0.username like regex("ca(?=r)\\\\w+")')
+        q, residual = translate(tree, User)
+        self.assertEqual(q.children, [('username__startswith', 'ca')])
+        self.assertIs(residual, tree.children[0])
+        with self.assertNumQueries(2):
+            self.assertEqual([u.username for u in filter_queryset(
+                User.objects.all(), tree)], ['carol'])
+
+    def test_queries(self):
+        rule = Rule('t', conditions=EXACT[6])
+        with self.assertNumQueries(1):
+            self.assertEqual(len(rule.filter_queryset(User.objects.all())), 2)
+        rule = Rule('t', conditions=INEXACT[2])
+        # The narrowed rows are checked in Python.
+        with self.assertNumQueries(2):
+            users = list(rule.filter_queryset(User.objects.all()))
+        self.assertEqual([u.username for u in users], ['alice'])
+
+    def test_to_many(self):
+        group = Group.objects.create(name='g')
+        for user in User.objects.filter(username__in=['alice', 'bob']):
+            user.groups.add(group)
+        User.objects.get(username='alice').groups.add(
+            Group.objects.create(name='h'))
+        rule = Rule('t', conditions='object:0.groups.all exists')
+        self.assertIsNone(translate(rule.conditions, User)[1])
+        self.assertEqual(sorted(u.username for u in
+                                rule.filter_queryset(User.objects.all())),
+                         ['alice', 'bob'])
+        rule = Rule('t', conditions='object:0.groups.all does not exist')
+        self.assertEqual(sorted(u.username for u in
+                                rule.filter_queryset(User.objects.all())),
+                         ['carol', 'dave'])
+        rule = Rule('t', conditions='object:0.groups.name == "g"')
+        self.assertIsNotNone(translate(rule.conditions, User)[1])
+
+    def test_other_conditions(self):
+        class Condition(object):
+            @staticmethod
+            def _evaluate(info):
+                return info['objects'][0].username.startswith('c')
+        self.assertEqual([u.username for u in filter_queryset(
+            User.objects.all(), Condition)], ['carol'])
+        self.assertEqual(translate(Condition, User), (None, Condition))
+
+    def test_rule_set(self):
+        for i, tree in enumerate(('object:0.username == "alice"',
+                                  'object:0.first_name == "Carol"',
+                                  'len(object:0.username) == 3')):
+            RuleModel.objects.create(trigger='t', tree=tree, weight=i)
+        rules = RuleSet(RuleModel)
+        self.assertEqual(sorted(u.username for u in rules.filter_queryset(
+            User.objects.all())), ['alice', 'bob', 'carol'])
+        self.assertEqual(sorted(u.username for u in rules.filter(
+            weight__lt=2).filter_queryset(User.objects.all())),
+            ['alice', 'carol'])
@@ -0,0 +1,87 @@
+import copy
+import threading
+
+from django.test import TestCase
+
+from rules.core import ConditionNode, Rule
+from rules.trees import TreeCache, _build, freeze
+
+
+class TestTreeCache(TestCase):
+    def setUp(self):
+        self.cache = TreeCache(_build, maxsize=2)
+
+    def test_hits(self):
+        t = self.cache.get('object:0 == 1')
+        self.assertIs(self.cache.get('object:0 == 1'), t)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertIsNot(self.cache.get('object:0 == 2'), t)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+        self.assertEqual(len(self.cache), 2)
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 0))
+
+    def test_eviction(self):
+        self.cache.get('object:0 == 1')
+        self.cache.get('object:0 == 2')
+        # The least recently used is 2 now.
+        self.cache.get('object:0 == 1')
+        self.cache.get('object:0 == 3')
+        self.assertEqual(list(self.cache.trees),
+                         ['object:0 == 1', 'object:0 == 3'])
+
+    def test_errors(self):
+        self.assertRaises(Exception, self.cache.get, 'object:0 ==')
+        self.assertEqual(len(self.cache), 0)
+
+    def test_preload(self):
+        cache = TreeCache(_build, maxsize=10)
+        strings = ['object:0 == {}'.format(i) for i in range(3)]
+        self.assertEqual(cache.preload(strings + ['object:0 =='], 1), 3)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.preload(strings[1:], 1), 0)
+        tree = cache.get(strings[2])
+        self.assertTrue(tree.frozen)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_threads(self):
+        cache = TreeCache(_build, maxsize=10)
+        strings = ['object:0 == {}'.format(i % 20) for i in range(400)]
+
+        def work(n):
+            for s in strings[n::4]:
+                cache.get(s)
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(cache.hits + cache.misses, 400)
+        self.assertLessEqual(len(cache), 10)
+
+
+class TestFrozen(TestCase):
+    def test_shared(self):
+        r1 = Rule('t', conditions='object:0 == 1 AND object:1 == 2')
+        r2 = Rule('t', conditions='object:0 == 1 AND object:1 == 2')
+        self.assertIs(r1.conditions, r2.conditions)
+        self.assertTrue(r1.conditions.frozen)
+
+    def test_frozen(self):
+        t = freeze(_build('object:0 == 1 AND '
+                          '(object:1 == 2 OR object:2 bool)'))
+        self.assertRaises(TypeError, t.negate)
+        self.assertRaises(TypeError, t.collapse)
+        self.assertRaises(TypeError, t.add, ConditionNode(), 'AND')
+        self.assertRaises(TypeError, t.children[1].negate)
+
+    def test_copies(self):
+        t = freeze(_build('object:0 == 1 AND object:1 == 2'))
+        c = copy.deepcopy(t)
+        self.assertFalse(c.frozen)
+        c.negate()
+        self.assertTrue((~t).evaluate(1, 3))
+        self.assertFalse(t.evaluate(1, 3))
+        self.assertTrue((t | c).evaluate(1, 3))
@@ -0,0 +1,93 @@
+from unittest import skipIf
+
+from django.test import TestCase
+
+from rules.core import Rule
+from rules.parser import parse_rule
+from rules.vectorized import match_matrix, np
+from . import Dummy
+from .test_compile import RULES, Obj
+
+ROWS = (
+    {'a': 1, 'b': 2, 'c': 0, 'name': 'abc', 'items': [1, 2, 3]},
+    {'a': 3, 'b': 1.5, 'c': None, 'name': '123', 'items': []},
+    Obj(a=2, b=2, c=True, name='xab', items=[3, 2, 2, 1], missing=1),
+    Obj(a=None, name=None, items=None),
+    {'a': '1', 'name': 5},
+    {'a': 2, 'b': -1, 'c': 1, 'name': 'ab', 'items': [2]},
+    {'a': 2.5, 'b': 3, 'c': 0.0, 'name': u'\xe9b', 'items': (1, 2, 3, 4)},
+    {},
+)
+
+EXTRAS = ({}, {'user': {'name': 'bob'}}, {'user': Obj(name='alice')})
+
+MORE = (
+    'object:0.a in [1, 2.5]',
+    'object:0.a > 1 AND object:0.b < 3',
+    'object:0.b >= object:0.a OR object:0.c bool',
+    'object:0.c bool OR NOT object:0.c bool',
+    'object:0.name == "ab" OR object:0.name in ["abc", "123"]',
+    'NOT object:0.a == 2',
+    'object:0.a != extra.user.name',
+)
+
+
+@skipIf(np is None, 'NumPy is not installed')
+class TestMatchMatrix(TestCase):
+    def assertSame(self, rules, rows, **extra):
+        matrix = match_matrix(rules, rows, **extra)
+        self.assertEqual(matrix.shape, (len(rules), len(rows)))
+        for r, rule in enumerate(rules):
+            for i, row in enumerate(rows):
+                self.assertIs(bool(matrix[r, i]), bool(rule.match(row, **extra)),
+                              '{} with {!r}'.format(rule.conditions, row))
+
+    def test_rules(self):
+        rules = [Rule('t', conditions=parse_rule(s)) for s in RULES + MORE]
+        for extra in EXTRAS:
+            self.assertSame(rules, ROWS, **extra)
+            self.assertSame(rules, [row for row in ROWS if
+                                    isinstance(row, dict)], **extra)
+
+    def test_other_rules(self):
+        rules = [Dummy(True), Dummy(False),
+                 Rule('t', conditions=parse_rule(MORE[0])), Rule('t')]
+        matrix = match_matrix(rules, ROWS)
+        self.assertTrue(matrix[0].all())
+        self.assertFalse(matrix[1].any())
+        self.assertFalse(matrix[3].any())
+        self.assertEqual(match_matrix(rules, []).shape, (4, 0))
+
+    def test_structured(self):
+        rows = np.array([(1, 2.5, 'x'), (2, 0., 'y'), (3, -1., 'xy')],
+                        dtype=[('a', 'i8'), ('b', 'f8'), ('name', 'U4')])
+        rules = [Rule('t', conditions=s) for s in (
+            'object:0.a >= 2 AND object:0.b bool',
+            'object:0.name == "x" OR object:0.a == 3',
+            'object:0.name like regex("y$")',
+            'object:0.a in [1, 3]',
+            'object:0.missing bool',
+        )]
+        self.assertEqual(match_matrix(rules, rows).tolist(), [
+            [False, False, True],
+            [True, False, True],
+            [False, True, False],
+            [True, False, True],
+            [False, False, False],
+        ])
+
+    def test_fallback_rows(self):
+        # Conditions which aren't vectorized only see the undecided rows.
+        seen = []
+
+        class Probe(object):
+            def _evaluate(self, info):
+                seen.append(info['objects'][0]['a'])
+                return True
+
+        tree = parse_rule('object:0.a > 1')
+        tree.add(Probe(), 'AND')
+        rows = [{'a': a} for a in range(5)]
+        matrix = match_matrix([Rule('t', conditions=tree)], rows)
+        self.assertEqual(matrix.tolist(), [[False, False, True, True, True]])
+        self.assertEqual(seen, [2, 3, 4])
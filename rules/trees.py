@@ -0,0 +1,106 @@
+"""
+A process-wide cache of parsed condition trees.
+
+Every rule loaded from the database would otherwise parse (and optimize) its
+tree string again, though most of them were parsed moments ago for another
+instance, query or owner.  :class:`TreeCache` maps strings to their trees, up
+to a maximum size, evicting the least recently used.  Trees from it are shared
+between rules, so they're frozen: adding to or negating them in place raises
+``TypeError``, and copies (``copy.deepcopy``, ``~tree``, ``tree & other``) are
+free to be changed.
+"""
+import threading
+from collections import OrderedDict
+
+import six
+
+from .conf import settings
+from .core import ConditionNode
+
+__all__ = ['TreeCache', 'freeze']
+
+
+def freeze(tree):
+    """Marks the nodes of ``tree`` as not to be changed in place."""
+    if isinstance(tree, ConditionNode):
+        tree.frozen = True
+        for child in tree.children:
+            freeze(child)
+    return tree
+
+
+class TreeCache(object):
+    """A thread-safe LRU cache of condition trees, keyed by string."""
+
+    def __init__(self, build, maxsize=1024):
+        self.build = build
+        self.maxsize = maxsize
+        self.trees = OrderedDict()
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.trees)
+
+    def get(self, string, build=None):
+        """
+        Returns the frozen tree built from ``string``, by ``build`` if given
+        and it's not cached yet.
+        """
+        with self._lock:
+            try:
+                tree = self.trees.pop(string)
+            except KeyError:
+                self.misses += 1
+            else:
+                # Most recently used goes last.
+                self.trees[string] = tree
+                self.hits += 1
+                return tree
+        # Built outside the lock; two threads may both build a new string, but
+        # the trees are equivalent and only one is kept.
+        tree = freeze((build or self.build)(string))
+        with self._lock:
+            return self._add(string, tree)
+
+    def _add(self, string, tree):
+        tree = self.trees.setdefault(string, tree)
+        while len(self.trees) > self.maxsize:
+            self.trees.popitem(last=False)
+        return tree
+
+    def preload(self, strings, workers=None):
+        """
+        Builds the trees for strings which aren't cached yet in a pool of
+        processes (see :func:`~rules.parser.parse_many`), returning how many
+        were added.  Strings which fail are left to fail when used.
+        """
+        from .parser import parse_many
+        with self._lock:
+            todo = [s for s in set(strings)
+                    if isinstance(s, six.string_types) and s not in self.trees]
+        # Any more would only push each other out.
+        todo = todo[:self.maxsize]
+        results = parse_many(todo, workers, parse=self.build,
+                             return_exceptions=True)
+        added = 0
+        with self._lock:
+            for string, tree in zip(todo, results):
+                if not isinstance(tree, Exception):
+                    self._add(string, freeze(tree))
+                    added += 1
+        return added
+
+    def clear(self):
+        with self._lock:
+            self.trees.clear()
+            self.hits = self.misses = 0
+
+
+def _build(string):
+    from .optimizer import optimize
+    from .parser import parse_rule
+    return optimize(parse_rule(string))
+
+
+TreeCache.default = TreeCache(_build, settings.RULES_TREE_CACHE_SIZE)
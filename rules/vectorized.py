@@ -0,0 +1,287 @@
+"""
+Columnar evaluation of rules against large batches of rows, using NumPy.
+
+Checking rules against each row of, say, a ``values()`` query or a structured
+array one at a time means evaluating every condition in Python once per row.
+:func:`match_matrix` instead gathers each distinct selector's values into a
+column once, evaluates comparisons (``==``, ``<``, ``in``, ``bool`` and so on)
+as array operations, and combines them with boolean masks, giving a matrix of
+which rules match which rows.  Conditions it can't handle this way, such as
+regular expressions, functions or chains with calls, are evaluated one row at a
+time as usual, but only for the rows which the rest of their node hasn't
+already decided.
+
+Each row is the first object (``object:0``) for the rules; keyword arguments
+are available as ``extra``, as with :meth:`~rules.core.Rule.match`.
+"""
+import datetime
+import decimal
+import logging
+import operator
+
+import six
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+from .cache import _rule_conditions
+from .core import AND, Condition, ConditionNode, _exists
+from .deferred import ChainError, Deferred, Selector, _follow
+from .index import _const
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['match_matrix']
+
+_SCALARS = six.string_types + six.integer_types + (
+    six.text_type, six.binary_type, float, bool, type(None), decimal.Decimal,
+    datetime.date, datetime.datetime, datetime.time, datetime.timedelta,
+)
+
+_CONTAINERS = (list, tuple, set, frozenset)
+
+_COMPARISONS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<=': operator.le,
+    '<': operator.lt,
+    '>=': operator.ge,
+    '>': operator.gt,
+}
+
+
+def _unbound(cls, name):
+    return six.get_unbound_function(getattr(cls, name))
+
+
+def _column(values, missing):
+    """Returns an array of ``values``, typed if they all have one type."""
+    present = values
+    if missing is not None:
+        present = [v for v, m in zip(values, missing) if not m]
+    types = set(type(v) for v in present)
+    if types:
+        for kinds, dtype, blank in ((set([bool]), bool, False),
+                                    (set(six.integer_types), 'int64', 0),
+                                    (set([float]), 'float64', 0.)):
+            if not types <= kinds:
+                continue
+            if missing is not None:
+                values = [blank if m else v for v, m in zip(values, missing)]
+            try:
+                return np.array(values, dtype=dtype)
+            except (OverflowError, TypeError, ValueError):
+                break
+    if missing is not None and present:
+        # Something which compares like the rest; missing rows are masked.
+        values = [present[0] if m else v for v, m in zip(values, missing)]
+    column = np.empty(len(values), dtype=object)
+    for i, v in enumerate(values):
+        column[i] = v
+    return column
+
+
+class _Batch(object):
+    """The rows being checked, with their columns and per-row ``info``."""
+
+    def __init__(self, rows, extra):
+        if not isinstance(rows, np.ndarray):
+            rows = list(rows)
+        self.rows = rows
+        self.extra = extra
+        self.size = len(rows)
+        self.names = getattr(getattr(rows, 'dtype', None), 'names', None) or ()
+        self.columns = {}
+        self.infos = {}
+
+    def info(self, i):
+        try:
+            return self.infos[i]
+        except KeyError:
+            info = self.infos[i] = {'objects': (self.rows[i],),
+                                    'extra': self.extra}
+            return info
+
+    def mask(self, value=False):
+        return np.full(self.size, value, dtype=bool)
+
+    def column(self, selector):
+        """Returns ``(values, missing)`` for a selector, or ``None``."""
+        try:
+            return self.columns[selector]
+        except KeyError:
+            pass
+        except TypeError:
+            return None
+        result = self.columns[selector] = self._gather(selector)
+        return result
+
+    def _gather(self, selector):
+        stype, chain = selector.stype, selector.chain
+        if not isinstance(chain, tuple) or any(
+                isinstance(link, (Deferred, tuple)) for link in chain):
+            # Calls with arguments and the like are left to each row.
+            return None
+        links = tuple(chain)
+        get_chain = lambda info: links
+        hops = selector._hops
+        if stype == 'extra':
+            # The same for every row.
+            column = np.empty(self.size, dtype=object)
+            try:
+                column.fill(_follow(self.extra, get_chain, None, hops))
+            except ChainError:
+                return column, self.mask(True)
+            return column, None
+        elif stype != 0 or isinstance(stype, bool):
+            return None
+        if len(links) == 1 and links[0] in self.names:
+            return self.rows[links[0]], None
+        values = [None] * self.size
+        missing = self.mask()
+        for i, row in enumerate(self.rows):
+            try:
+                values[i] = _follow(row, get_chain, None, hops)
+            except ChainError:
+                missing[i] = True
+        if not missing.any():
+            missing = None
+        return _column(values, missing), missing
+
+    def operand(self, deferred):
+        """
+        Returns ``(value, missing, is_column)`` for an operand which is either
+        constant or a column, else ``None``.
+        """
+        if deferred is None:
+            return None, None, False
+        const, value = _const(deferred)
+        if const:
+            return value, None, False
+        if isinstance(deferred, Selector):
+            column = self.column(deferred)
+            if column is not None:
+                return column[0], column[1], True
+        return None
+
+
+def _vector_condition(batch, cond):
+    """Returns a mask of the rows matching ``cond``, or ``None``."""
+    if _unbound(type(cond), '_evaluate') is not \
+            _unbound(Condition, '_evaluate') or \
+            cond._eval is not Condition.OPERATOR_MAP.get(cond.operator):
+        return None
+    left = batch.operand(cond.left)
+    right = batch.operand(cond.right)
+    if left is None or right is None or not (left[2] or right[2]):
+        return None
+    (lvalue, lmissing, lcolumn), (rvalue, rmissing, rcolumn) = left, right
+    op = cond.operator
+    try:
+        if cond.is_unary:
+            if lvalue.dtype.kind in 'biuf':
+                result = lvalue != 0
+            else:
+                result = np.fromiter((bool(_exists(v, None)) for v in lvalue),
+                                     bool, batch.size)
+        elif op == 'in':
+            if lcolumn and not rcolumn:
+                if not isinstance(rvalue, _CONTAINERS):
+                    return None
+                if lvalue.dtype.kind in 'biuf' and \
+                        all(type(v) in (bool, int, float) for v in rvalue):
+                    result = np.isin(lvalue, list(rvalue))
+                else:
+                    result = np.fromiter((v in rvalue for v in lvalue),
+                                         bool, batch.size)
+            elif rcolumn and not lcolumn:
+                result = np.fromiter((lvalue in v for v in rvalue),
+                                     bool, batch.size)
+            else:
+                result = np.fromiter((l in r for l, r in zip(lvalue, rvalue)),
+                                     bool, batch.size)
+        elif op in _COMPARISONS:
+            if (not lcolumn and not isinstance(lvalue, _SCALARS)) or \
+                    (not rcolumn and not isinstance(rvalue, _SCALARS)):
+                # Would be broadcast as an array, not compared as a whole.
+                return None
+            result = np.asarray(_COMPARISONS[op](lvalue, rvalue), dtype=bool)
+        else:
+            return None
+    except Exception:
+        logger.debug('Exception while vectorizing condition "{}"'
+                     .format(cond), exc_info=True)
+        return None
+    if result.shape != (batch.size,):
+        return None
+    if cond.negated:
+        result = ~result
+    if cond.is_unary:
+        if lmissing is not None:
+            # As if the value were None.
+            result[lmissing] = cond.negated
+    else:
+        for missing in (lmissing, rmissing):
+            if missing is not None:
+                result[missing] = False
+    return result
+
+
+def _evaluate(batch, node, todo):
+    """
+    Returns a mask which is correct for the rows in ``todo``, evaluating rows
+    one at a time only where needed.
+    """
+    if isinstance(node, ConditionNode) and _unbound(
+            type(node), '_evaluate') is _unbound(ConditionNode, '_evaluate'):
+        if node.connector == AND:
+            live = todo.copy()
+            for child in node.children:
+                if not live.any():
+                    break
+                live &= _evaluate(batch, child, live)
+            return live
+        found, live = batch.mask(), todo.copy()
+        for child in node.children:
+            if not live.any():
+                break
+            hit = _evaluate(batch, child, live) & live
+            found |= hit
+            live &= ~hit
+        return found
+    elif isinstance(node, Condition):
+        result = _vector_condition(batch, node)
+        if result is not None:
+            return result
+    result = batch.mask()
+    for i in np.flatnonzero(todo):
+        try:
+            result[i] = bool(node._evaluate(batch.info(i)))
+        except Exception:
+            logger.debug('Exception while evaluating {}'.format(node),
+                         exc_info=True)
+    return result
+
+
+def match_matrix(rules, rows, **extra):
+    """
+    Returns a boolean array with a row for each rule and a column for each
+    row in ``rows`` (an iterable, or a NumPy array), true where the rule
+    matches that row.
+    """
+    if np is None:
+        raise ImportError('match_matrix requires NumPy.')
+    rules = list(rules)
+    batch = _Batch(rows, extra)
+    matrix = np.zeros((len(rules), batch.size), dtype=bool)
+    everything = batch.mask(True)
+    for r, rule in enumerate(rules):
+        conditions = _rule_conditions(rule)
+        if isinstance(conditions, (Condition, ConditionNode)):
+            matrix[r] = _evaluate(batch, conditions, everything)
+            continue
+        for i in range(batch.size):
+            matrix[r, i] = bool(rule._match(batch.info(i)))
+    return matrix